@@ -3,17 +3,41 @@ import shutil
 from flask import Flask, request, render_template, jsonify, send_file, flash, url_for, session
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from openai import AzureOpenAI
 import io
+import re
 import uuid
+import gzip
+import json
+import time
+import hmac
+import socket
+import hashlib
+import threading
+import functools
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from scheduler import GradingScheduler, PRIORITY_CLASSES
+from profiling import start_request_profiler, PROFILE_ARTIFACTS, NULL_PROFILER
+from grade_store import GradeWarehouse
+from single_flight import SingleFlight, IdempotencyKeyMismatchError
+from job_checkpoints import JobCheckpoints, save_job, load_job, update_job
+from workspace import WorkspaceManager, WorkspaceFullError
+from requirements_digest import RequirementsDigestCache, load_requirements_text
+from cancellation import CancelToken, JobCancelled, cancellation_scope, check_cancelled, current_token
+from chunked_uploads import ChunkedUploads, UploadError
+from project_summaries import SummaryCache, summarize_overflow, preview_summaries
 
 # Import all necessary functions and constants from utils.py
 from utils import (
-    read_docx, read_pdf, read_pptx, process_rubric_excel,
+    process_rubric_excel, create_azure_chat_client, file_sha256,
     unzip_file,
     collect_project_content,
-    generate_grading_with_openai,
+    prepare_grading_request, apply_admission_control, grade_prepared_request,
     generate_styled_excel_report,
+    build_report_dataframe, report_dataframe_to_compact_json,
     # DOCUMENT_PROJECT_EXTENSIONS is still used from utils for requirements file validation
     DOCUMENT_PROJECT_EXTENSIONS 
 )
@@ -26,49 +50,140 @@ app.secret_key = os.urandom(24)
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 1000 * 1024 * 1024 # 1 GB total limit
-app.config['DOWNLOAD_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'downloads')
+app.config['PROFILE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'profiles')
+app.config['JOBS_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs')
 
 # Constants for file size limits
 MAX_RUBRIC_SIZE_BYTES = 25 * 1024 * 1024 # 25 MB
 MAX_REQUIREMENT_SIZE_BYTES = 25 * 1024 * 1024 # 25 MB
 
+# Response compression (brotli is used when installed, gzip otherwise)
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/css', 'text/javascript', 'application/javascript'}
+MIN_COMPRESS_BYTES = 1024
+
+# Per-request profiling is available only when PROFILING_ADMIN_TOKEN is set; callers opt in by sending
+# the token in the X-Profile-Token header or the ?profile= query parameter.
+PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN")
+
+# The /analytics endpoints expose every student's scores, so they are available only when ANALYTICS_ADMIN_TOKEN
+# is set and the caller sends it in the X-Analytics-Token header or the ?token= query parameter.
+ANALYTICS_ADMIN_TOKEN = os.getenv("ANALYTICS_ADMIN_TOKEN")
+
+# Jobs that fail with a server-side error keep their uploads and stage checkpoints for this long so
+# POST /jobs/<job_id>/retry can resume them; successful and rejected jobs are removed immediately.
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 60 * 60)))
+# Profile artifacts are current output, not legacy leftovers: the workspace sweeper removes each profile
+# PROFILE_RETENTION_SECONDS after it was written.
+PROFILE_RETENTION_SECONDS = int(os.getenv("PROFILE_RETENTION_SECONDS", str(7 * 24 * 60 * 60)))
+
+# Job directories are allocated and reclaimed by the workspace manager: optionally on a tmpfs
+# (WORKSPACE_TMPFS_DIR, while it has WORKSPACE_TMPFS_MIN_FREE_MB left), deleted in the background, swept
+# every WORKSPACE_SWEEP_INTERVAL_SECONDS, and capped at WORKSPACE_QUOTA_MB (0: unlimited). A job is
+# reserved WORKSPACE_EXTRACTION_FACTOR times its upload size (uploads plus the extracted project).
+WORKSPACE_EXTRACTION_FACTOR = float(os.getenv("WORKSPACE_EXTRACTION_FACTOR", "4"))
+
+# Running jobs can be cancelled with POST /jobs/<job_id>/cancel, and (CANCEL_ON_DISCONNECT) when the client
+# closes the connection, which is checked every DISCONNECT_POLL_SECONDS. Cancellation stops the pipeline at
+# the next stage boundary, abandons an in-flight OpenAI call and reclaims the job's workspace right away.
+# Clients may choose the job id themselves (X-Job-Id) so they can cancel before the response arrives.
+CANCEL_ON_DISCONNECT = os.getenv("CANCEL_ON_DISCONNECT", "1").lower() not in ('0', 'false', 'no')
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "1"))
+CLIENT_JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+JOB_CANCELLED_STATUS = 499 # "Client Closed Request", as nginx logs it
+
 # Define ALLOWED_RUBRIC_EXTENSIONS directly in app.py as it's primarily used here for validation
 ALLOWED_RUBRIC_EXTENSIONS = {'.xlsx', '.xls', '.csv'}
 
 # Ensure the upload folder and its subdirectories exist on startup
 def ensure_upload_dirs():
-    """Creates necessary directories for file uploads and downloads if they don't exist."""
+    """Creates the upload, profile and job directories if they don't exist."""
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'rubrics'), exist_ok=True)
-    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'projects'), exist_ok=True)
-    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'requirements'), exist_ok=True)
+    os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['JOBS_FOLDER'], exist_ok=True)
 
 
-# Azure OpenAI configuration
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
-AZURE_OPENAI_CHAT_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")
-AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+ensure_upload_dirs()
+workspace = WorkspaceManager(
+    app.config['JOBS_FOLDER'], app.config['UPLOAD_FOLDER'], JOB_RETENTION_SECONDS,
+    quota_bytes=int(float(os.getenv("WORKSPACE_QUOTA_MB", "0")) * 1024 * 1024),
+    tmpfs_root=os.getenv("WORKSPACE_TMPFS_DIR") or None,
+    tmpfs_min_free_bytes=int(float(os.getenv("WORKSPACE_TMPFS_MIN_FREE_MB", "256")) * 1024 * 1024),
+    quota_wait_seconds=float(os.getenv("WORKSPACE_QUOTA_WAIT_SECONDS", "10")),
+    sweep_interval_seconds=float(os.getenv("WORKSPACE_SWEEP_INTERVAL_SECONDS", "600")),
+)
+workspace.add_expiring_root(app.config['PROFILE_FOLDER'], PROFILE_RETENTION_SECONDS)
 
-# Initialize Azure OpenAI clients
-chat_client = None
+# Large project archives can be uploaded in resumable, checksummed chunks of UPLOAD_CHUNK_MB (see
+# chunked_uploads.py) and then analyzed by id; unfinished uploads expire after UPLOAD_SESSION_TTL_SECONDS.
+# Created before the workspace starts so that uploads resumed from an earlier run are not swept as stale.
+chunked_uploads = ChunkedUploads(
+    workspace, app.config['MAX_CONTENT_LENGTH'],
+    chunk_bytes=int(float(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 * 1024),
+    reserve_factor=WORKSPACE_EXTRACTION_FACTOR,
+    session_ttl_seconds=int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", "3600")),
+)
+workspace.start()
 
-if all([AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY, AZURE_OPENAI_CHAT_DEPLOYMENT_NAME, AZURE_OPENAI_API_VERSION]):
-    try:
-        chat_client = AzureOpenAI(
-            azure_endpoint=AZURE_OPENAI_ENDPOINT,
-            api_key=AZURE_OPENAI_API_KEY,
-            api_version=AZURE_OPENAI_API_VERSION
-        )
-        print("Azure OpenAI chat client initialized successfully.")
-    except Exception as e:
-        print(f"Error initializing Azure OpenAI chat client: {e}")
-        chat_client = None
-else:
-    print("Azure OpenAI chat credentials are not fully set in .env file. AI chat features will be disabled.")
+# Azure OpenAI configuration (AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY,
+# AZURE_OPENAI_CHAT_DEPLOYMENT_NAME, AZURE_OPENAI_API_VERSION)
+chat_client = create_azure_chat_client()
+
+# Grading runs through the scheduler so bulk uploads cannot starve interactive reviewers.
+grading_scheduler = GradingScheduler({
+    'interactive': int(os.getenv("GRADING_INTERACTIVE_CONCURRENCY", "4")),
+    'bulk': int(os.getenv("GRADING_BULK_CONCURRENCY", "2")),
+})
+
+# Duplicate submissions (same uploads, or same Idempotency-Key) share one in-flight execution; successful
+# results are replayed to repeats arriving within SINGLE_FLIGHT_REPLAY_SECONDS.
+analysis_flights = SingleFlight(replay_seconds=int(os.getenv("SINGLE_FLIGHT_REPLAY_SECONDS", "300")))
 
-session_download_files = {}
+# Requirements documents are digested once per document hash (headers/footers, page numbers and repeated
+# lines dropped, numbered requirements one per line) and the compact form is what prompts carry. The workspace
+# sweeper removes digests not used for REQUIREMENTS_DIGEST_RETENTION_SECONDS.
+requirements_digests = RequirementsDigestCache(os.path.join(app.config['UPLOAD_FOLDER'], 'requirements_digests'))
+workspace.add_expiring_root(requirements_digests.cache_dir, int(os.getenv("REQUIREMENTS_DIGEST_RETENTION_SECONDS", str(30 * 24 * 60 * 60))))
+
+# Code beyond the raw prompt budget is summarized map-reduce style by a cheap deployment (see
+# project_summaries.py); summaries are cached on disk by input hash and shared by every job. The workspace
+# sweeper removes cached summaries not used for SUMMARY_CACHE_RETENTION_SECONDS.
+project_summary_cache = SummaryCache(os.path.join(app.config['UPLOAD_FOLDER'], 'project_summaries'))
+workspace.add_expiring_root(project_summary_cache.cache_dir, int(os.getenv("SUMMARY_CACHE_RETENTION_SECONDS", str(30 * 24 * 60 * 60))))
+
+# Every finished grading is also stored in the SQLite grade warehouse (GRADE_WAREHOUSE_PATH) for cohort analytics.
+grade_warehouse = GradeWarehouse()
+
+# Finished analyses keyed by result id: the compact JSON payload plus what is needed to build the
+# Excel report on demand. Entries expire after RESULT_RETENTION_SECONDS. Request threads share the dict,
+# so it is only touched under analysis_results_lock.
+analysis_results = {}
+analysis_results_lock = threading.Lock()
+RESULT_RETENTION_SECONDS = 60 * 60
+
+# Ids of jobs whose pipeline is running in this process (a retry of one of them is refused with 409).
+active_job_ids = set()
+# Job id -> (CancelToken, (user_id, cohort)) of the request currently serving it; POST /jobs/<job_id>/cancel
+# cancels it when sent by the same user and cohort.
+job_cancel_tokens = {}
+
+def _store_analysis_result(result_id, result):
+    now = time.time()
+    result['created_at'] = now
+    with analysis_results_lock:
+        for expired_id in [rid for rid, r in analysis_results.items() if now - r['created_at'] > RESULT_RETENTION_SECONDS]:
+            del analysis_results[expired_id]
+        analysis_results[result_id] = result
+
+def _get_analysis_result(result_id):
+    with analysis_results_lock:
+        return analysis_results.get(result_id)
+
+def _upload_path(job_dir, role, filename):
+    """
+    Where an uploaded file is saved: named after its role, keeping the (already validated) extension the readers
+    dispatch on. secure_filename() would turn a non-ASCII name such as "文档.docx" into "docx", losing it.
+    """
+    return os.path.join(job_dir, role + os.path.splitext(filename)[1].lower())
 
 def _validate_uploaded_file(file_obj, allowed_extensions, max_size_bytes, file_type_name):
     """
@@ -84,6 +199,15 @@ def _validate_uploaded_file(file_obj, allowed_extensions, max_size_bytes, file_t
         return f"{file_type_name} file exceeds the {max_size_bytes / (1024*1024):.0f} MB limit.", 413
     return None, None
 
+def _requester():
+    """(user_id, cohort) of the current request; it owns the jobs it starts, which only it may cancel or retry."""
+    return (request.headers.get('X-User-Id') or request.form.get('userId') or request.remote_addr,
+            request.headers.get('X-Cohort') or request.form.get('cohort') or None)
+
+def _profiling_requested():
+    supplied_token = request.headers.get('X-Profile-Token') or request.args.get('profile')
+    return bool(PROFILING_ADMIN_TOKEN and supplied_token and hmac.compare_digest(supplied_token, PROFILING_ADMIN_TOKEN))
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -98,105 +222,557 @@ def analyze_project():
     if error_msg:
         flash(error_msg, 'error')
         return jsonify({"error": error_msg}), status_code
-    error_msg, status_code = _validate_uploaded_file(project_zip_file_upload, {'.zip'}, app.config['MAX_CONTENT_LENGTH'], "project zip")
-    if error_msg:
-        flash(error_msg, 'error')
-        return jsonify({"error": error_msg}), status_code
+    # A project archive uploaded in chunks beforehand is referred to by its upload id instead
+    project_upload_id = request.form.get('projectUploadId')
+    if not project_upload_id:
+        error_msg, status_code = _validate_uploaded_file(project_zip_file_upload, {'.zip'}, app.config['MAX_CONTENT_LENGTH'], "project zip")
+        if error_msg:
+            flash(error_msg, 'error')
+            return jsonify({"error": error_msg}), status_code
     error_msg, status_code = _validate_uploaded_file(requirements_file, DOCUMENT_PROJECT_EXTENSIONS, MAX_REQUIREMENT_SIZE_BYTES, "requirements")
     if error_msg:
         flash(error_msg, 'error')
         return jsonify({"error": error_msg}), status_code
 
-    request_id = str(uuid.uuid4())
-    temp_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], f"request_{request_id}")
-    os.makedirs(temp_upload_dir, exist_ok=True)
-    rubric_path = os.path.join(temp_upload_dir, secure_filename(rubric_file.filename))
-    project_zip_path = os.path.join(temp_upload_dir, secure_filename(project_zip_file_upload.filename))
-    requirements_path = os.path.join(temp_upload_dir, secure_filename(requirements_file.filename))
+    # Scheduling identity: reviewers are fair-shared by user id; 'bulk' marks cohort uploads.
+    user_id, cohort = _requester()
+    priority_class = (request.headers.get('X-Grading-Priority') or request.form.get('priority') or 'interactive').lower()
+    if priority_class not in PRIORITY_CLASSES:
+        return jsonify({"error": f"Unknown priority '{priority_class}'. Allowed: {', '.join(PRIORITY_CLASSES)}."}), 400
+    # Dry run: run every local stage and report what grading would cost, without calling the AI.
+    dry_run = (request.args.get('dry_run') or request.form.get('dryRun') or '').lower() in ('1', 'true', 'yes')
+    idempotency_key = request.headers.get('Idempotency-Key') or request.form.get('idempotencyKey')
+
+    # A chunked upload was assembled in its own job directory and becomes that job
+    job_id = project_upload_id or request.headers.get('X-Job-Id') or request.form.get('jobId') or str(uuid.uuid4())
+    if not CLIENT_JOB_ID_PATTERN.match(job_id):
+        return jsonify({"error": "A client job id must be 8 to 64 letters, digits, '-' or '_'."}), 400
+    cancel_token = CancelToken()
+    if (not project_upload_id and workspace.find(job_id)) or job_cancel_tokens.setdefault(job_id, (cancel_token, (user_id, cohort)))[0] is not cancel_token:
+        return jsonify({"error": f"Job id '{job_id}' is already in use."}), 409
     try:
-        rubric_file.save(rubric_path)
-        project_zip_file_upload.save(project_zip_path)
-        requirements_file.save(requirements_path)
-        if not unzip_file(project_zip_path, temp_upload_dir): 
+        if project_upload_id:
+            project_upload = chunked_uploads.claim(project_upload_id)
+            job_dir, project_zip_path, project_file_name = project_upload['job_dir'], project_upload['path'], project_upload['filename']
+        else:
+            job_dir = workspace.allocate(job_id, int((request.content_length or 0) * WORKSPACE_EXTRACTION_FACTOR))
+            project_zip_path, project_file_name = _upload_path(job_dir, 'project', project_zip_file_upload.filename), project_zip_file_upload.filename
+    except UploadError as e:
+        job_cancel_tokens.pop(job_id, None)
+        return jsonify({"error": str(e)}), e.status_code
+    except WorkspaceFullError as e:
+        job_cancel_tokens.pop(job_id, None)
+        return jsonify({"error": str(e)}), 503, {'Retry-After': str(e.retry_after_seconds)}
+    _watch_for_disconnect(job_id, cancel_token)
+    submission = {
+        'job_id': job_id, 'job_dir': job_dir,
+        'rubric_path': _upload_path(job_dir, 'rubric', rubric_file.filename),
+        'project_zip_path': project_zip_path,
+        'requirements_path': _upload_path(job_dir, 'requirements', requirements_file.filename),
+        'original_name': os.path.splitext(project_file_name)[0],
+        'user_id': user_id, 'cohort': cohort, 'priority_class': priority_class, 'dry_run': dry_run,
+    }
+    profiler = start_request_profiler(_profiling_requested(), job_id, os.path.join(app.config['PROFILE_FOLDER'], job_id))
+    response_body, status_code = {"error": "Analysis did not complete."}, 500
+    try:
+        with profiler.stage('save_uploads'):
+            rubric_file.save(submission['rubric_path'])
+            if not project_upload_id: project_zip_file_upload.save(submission['project_zip_path'])
+            requirements_file.save(submission['requirements_path'])
+        submission['sha256'] = {'rubric': file_sha256(submission['rubric_path']), 'project_zip': file_sha256(submission['project_zip_path']),
+                                'requirements': file_sha256(submission['requirements_path'])}
+        save_job(job_dir, {'job_id': job_id, 'status': 'running', 'created_at': time.time(), 'updated_at': time.time(), 'submission': submission})
+        run_pipeline = lambda: _run_analysis_pipeline(submission, profiler)
+        if profiler.enabled: # A profiled run must do its own work rather than attach to someone else's
+            with cancellation_scope(cancel_token):
+                (response_body, status_code), coalesced = run_pipeline(), False
+        else:
+            # Identical in-flight submissions of one user and cohort share one execution (and its warehouse row);
+            # a client idempotency key narrows this to its own retries.
+            content_key = _submission_content_key(submission)
+            flight_key = f"idempotency:{user_id}:{idempotency_key}" if idempotency_key else content_key
+            (response_body, status_code), coalesced = analysis_flights.run(
+                flight_key, run_pipeline, fingerprint=content_key, replayable=lambda outcome: outcome[1] == 200, cancel_token=cancel_token)
+        if coalesced:
+            print(f"Request {job_id} coalesced onto an identical submission; no new grading was started.")
+            response_body = dict(response_body, coalesced=True)
+    except IdempotencyKeyMismatchError as e:
+        response_body, status_code = {"error": str(e)}, 422
+    except JobCancelled as e:
+        print(f"Job {job_id} was cancelled: {e}")
+        response_body, status_code = {"error": f"Analysis cancelled: {e}", "cancelled": True}, JOB_CANCELLED_STATUS
+    except Exception as e:
+        print(f"An unexpected error occurred during analysis: {e}")
+        flash(f"An unexpected error occurred: {e}", 'error')
+        import traceback
+        traceback.print_exc() 
+        response_body, status_code = {"error": f"An unexpected error occurred: {e}"}, 500
+    finally:
+        job_cancel_tokens.pop(job_id, None)
+        profiler.finish()
+        job_kept = _finish_job(job_dir, status_code, response_body.get('error'))
+    if job_kept:
+        response_body = dict(response_body, job_id=job_id, retry_url=url_for('retry_job', job_id=job_id, _external=True))
+    return jsonify(response_body), status_code
+
+def _finish_job(job_dir, status_code, error=None):
+    """
+    Hands a finished job's directory back to the workspace manager, which deletes it in the background. Jobs
+    that failed with a server-side error (5xx) are kept, with their checkpoints, until JOB_RETENTION_SECONDS
+    pass so they can be retried. Returns True when the job was kept.
+    """
+    if status_code >= 500 and os.path.isdir(job_dir):
+        job = update_job(job_dir, status='failed', error=error, completed_stages=JobCheckpoints(job_dir).completed_stages())
+        if job is not None:
+            print(f"Job {job['job_id']} failed after stages {job['completed_stages']}; kept for retry.")
+            workspace.release(job_dir, keep=True)
+            return True
+    workspace.release(job_dir)
+    return False
+
+def _watch_for_disconnect(job_id, cancel_token):
+    """
+    Cancels cancel_token when the client of the current request closes its connection (a zero-byte peek at
+    the socket is EOF), for as long as job_id is registered with it. Needs a server that exposes the client
+    socket in the WSGI environ (the werkzeug dev server, gunicorn sync workers) and a plain-TCP connection.
+    """
+    client_socket = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    if not CANCEL_ON_DISCONNECT or client_socket is None or not hasattr(socket, 'MSG_DONTWAIT'): return
+    def watch():
+        while not cancel_token.wait(DISCONNECT_POLL_SECONDS) and job_cancel_tokens.get(job_id, (None, None))[0] is cancel_token:
+            try:
+                if client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b'':
+                    print(f"Client of job {job_id} disconnected; cancelling it.")
+                    cancel_token.cancel("the client disconnected")
+                    return
+            except (BlockingIOError, InterruptedError):
+                continue # Still connected, nothing buffered
+            except (OSError, ValueError):
+                return # Closed by the server, or a socket that cannot be peeked (TLS)
+    threading.Thread(target=watch, daemon=True, name=f"disconnect-watch-{job_id[:8]}").start()
+
+def _submission_content_key(submission):
+    """
+    Identity of a submission for coalescing: the content hashes of the three uploads plus the mode, and who
+    submitted it. Each user and cohort gets a grading of their own, so each is recorded in the grade warehouse.
+    """
+    hashes = submission['sha256']
+    identity = f"{hashes['rubric']}|{hashes['project_zip']}|{hashes['requirements']}|dry_run={submission['dry_run']}|user={submission['user_id']}|cohort={submission['cohort']}"
+    return "content:" + hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+def _run_analysis_pipeline(submission, profiler):
+    """
+    Runs unzip -> rubric -> extraction -> grading -> report for saved uploads. Returns (response_body, status_code).
+    Each stage's output is checkpointed in the job directory, and stages that already have a checkpoint
+    (a retried job) are loaded instead of run again.
+    """
+    active_job_ids.add(submission['job_id'])
+    try:
+        return _run_job_stages(submission, profiler)
+    finally:
+        active_job_ids.discard(submission['job_id'])
+
+def _extracted_files(project_dir):
+    return sorted(os.path.relpath(os.path.join(root, name), project_dir) for root, _, names in os.walk(project_dir) for name in names)
+
+def _prune_to_manifest(project_dir, manifest_files):
+    """Removes what an interrupted extraction stage added to the project tree (nested archive extractions)."""
+    keep = set(manifest_files)
+    for root, _, names in os.walk(project_dir, topdown=False):
+        for name in names:
+            if os.path.relpath(os.path.join(root, name), project_dir) not in keep: os.remove(os.path.join(root, name))
+        if root != project_dir and not os.listdir(root): os.rmdir(root)
+
+def _run_job_stages(submission, profiler):
+    job_dir, rubric_path, requirements_path = submission['job_dir'], submission['rubric_path'], submission['requirements_path']
+    project_zip_path, original_project_file_name = submission['project_zip_path'], submission['original_name']
+    user_id, cohort, priority_class = submission['user_id'], submission['cohort'], submission['priority_class']
+    project_dir = os.path.join(job_dir, 'project')
+    checkpoints = JobCheckpoints(job_dir)
+    extract_manifest = checkpoints.load('extract')
+    if extract_manifest is None:
+        check_cancelled()
+        with profiler.stage('unzip'):
+            shutil.rmtree(project_dir, ignore_errors=True) # Left over from an extraction that was interrupted
+            unzipped = unzip_file(project_zip_path, project_dir)
+        if not unzipped:
             flash("Failed to unzip project archive.", 'error')
-            return jsonify({"error": "Failed to unzip project archive."}), 400
-        rubric_data_markdown_for_ai, original_rubric_dataframe = process_rubric_excel(rubric_path)
+            return {"error": "Failed to unzip project archive."}, 400
+        extract_manifest = {'files': _extracted_files(project_dir)}
+        checkpoints.save('extract', extract_manifest)
+    rubric_checkpoint = checkpoints.load('rubric')
+    if rubric_checkpoint is None:
+        check_cancelled()
+        with profiler.stage('rubric'):
+            rubric_data_markdown_for_ai, original_rubric_dataframe = process_rubric_excel(rubric_path)
         if rubric_data_markdown_for_ai is None or original_rubric_dataframe is None:
             flash("Failed to process rubric.", 'error')
-            return jsonify({"error": "Failed to process evaluation rubric."}), 400
-        project_text_files_content, image_messages_for_ai, video_files_detected = collect_project_content(temp_upload_dir)
-        if requirements_file.filename.lower().endswith('.docx'):
-            requirements_text = read_docx(requirements_path)
-        elif requirements_file.filename.lower().endswith('.pdf'):
-            requirements_text = read_pdf(requirements_path)
-        elif requirements_file.filename.lower().endswith('.pptx'):
-            requirements_text = read_pptx(requirements_path)
+            return {"error": "Failed to process evaluation rubric."}, 400
+        # The detected column map is a plain attribute, which pickling a DataFrame does not keep
+        checkpoints.save('rubric', (rubric_data_markdown_for_ai, original_rubric_dataframe, getattr(original_rubric_dataframe, '_identified_columns', {})))
+    else:
+        rubric_data_markdown_for_ai, original_rubric_dataframe, original_rubric_dataframe._identified_columns = rubric_checkpoint
+    content_checkpoint = checkpoints.load('content')
+    if content_checkpoint is None:
+        check_cancelled()
+        with profiler.stage('collect_project_content'):
+            _prune_to_manifest(project_dir, extract_manifest['files'])
+            content_checkpoint = collect_project_content(project_dir)
+        checkpoints.save('content', content_checkpoint)
+    project_text_files_content, image_messages_for_ai, video_files_detected, collection_report = content_checkpoint
+    summaries = checkpoints.load('summaries')
+    if submission['dry_run']: # A dry run makes no AI calls; it reports what the summaries would cost
+        summaries = preview_summaries(collection_report)
+    elif summaries is None:
+        check_cancelled()
+        with profiler.stage('summaries'):
+            # Summary calls share the grading scheduler's class caps and fair share with the grading calls
+            summaries = summarize_overflow(chat_client, project_dir, collection_report, project_summary_cache,
+                                           submit=functools.partial(grading_scheduler.submit, user_id, priority_class))
+        checkpoints.save('summaries', summaries)
+    requirements_text = checkpoints.load('requirements')
+    if requirements_text is None:
+        check_cancelled()
+        with profiler.stage('requirements'):
+            requirements_text = load_requirements_text(requirements_path, requirements_digests, submission['sha256']['requirements'])
         if requirements_text is None:
             flash("Failed to read requirements file.", 'error')
-            return jsonify({"error": "Failed to read requirements file."}), 500
-        error_message, grading_breakdown_list, overall_parsed_result = generate_grading_with_openai(
-            chat_client, original_rubric_dataframe, rubric_data_markdown_for_ai,
-            requirements_text, project_text_files_content, image_messages_for_ai, bool(video_files_detected)
-        )
+            return {"error": "Failed to read requirements file."}, 500
+        checkpoints.save('requirements', requirements_text)
+    prompt_checkpoint = checkpoints.load('prompt')
+    if prompt_checkpoint is None:
+        check_cancelled()
+        with profiler.stage('prepare_grading'):
+            error_message, grading_request = prepare_grading_request(
+                original_rubric_dataframe, rubric_data_markdown_for_ai, requirements_text,
+                project_text_files_content, image_messages_for_ai, bool(video_files_detected),
+                duplicate_aliases=collection_report['duplicate_aliases'],
+                project_file_paths=collection_report['file_paths'], project_base_dir=project_dir,
+                project_summaries_text=summaries['text'], summary_usage=_summary_usage(summaries)
+            )
         if error_message:
             flash(error_message, 'error')
-            return jsonify({"error": error_message}), 500
-        original_project_file_name = os.path.splitext(project_zip_file_upload.filename)[0]
-        excel_filename = f"{original_project_file_name}_Grading_Report.xlsx" 
-        excel_bytes, report_df_for_html = generate_styled_excel_report(
-            original_rubric_dataframe, grading_breakdown_list, overall_parsed_result
-        )
-        df_html = report_df_for_html.to_html(classes='table table-striped table-bordered table-hover responsive-table', index=False)
-        download_file_id = str(uuid.uuid4())
-        temp_excel_filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], f"report_{download_file_id}.xlsx")
-        with open(temp_excel_filepath, 'wb') as f:
-            f.write(excel_bytes)
-        
-        # --- FIX for 403 Forbidden error ---
-        # Store the absolute path to the file for the security check.
-        session_download_files[download_file_id] = {
-            'filepath': os.path.abspath(temp_excel_filepath), 
-            'original_name': original_project_file_name
-        }
-        return jsonify({
-            'success': True, 'message': "Analysis complete!", 'table_html': df_html,
-            'download_url': url_for('download_evaluated_report', file_id=download_file_id, _external=True)
-        })
+            return {"error": error_message}, 400
+        with profiler.stage('admission'):
+            admission = apply_admission_control(grading_request)
+        checkpoints.save('prompt', (grading_request, admission))
+    else:
+        grading_request, admission = prompt_checkpoint
+    if submission['dry_run']:
+        return {
+            'success': True, 'dry_run': True, 'message': "Dry run complete; no AI calls were made.",
+            'rubric_columns': grading_request['rubric_columns'],
+            'criteria_count': len(grading_request['all_criteria']),
+            'local_check_criteria': {str(criterion_id): grade['comments'] for criterion_id, grade in grading_request['local_grades'].items()},
+            'selected_files': [{'path': filename, 'chars': len(content)} for filename, content in grading_request['project_text_files_content'].items()],
+            'collection_report': {key: value for key, value in collection_report.items() if key not in ('file_paths', 'overflow_files')},
+            'project_summaries': {key: value for key, value in summaries.items() if key != 'text'},
+            'admission': admission,
+            'profile': _profile_response(profiler),
+        }, 200
+    if not admission['admitted']:
+        error_message = "Submission exceeds the grading admission limits: " + "; ".join(admission['violations']) + "."
+        flash(error_message, 'error')
+        return {"error": error_message, 'admission': admission}, 413
+    llm_response = checkpoints.load('llm_response')
+    grading_job = None
+    if llm_response is None:
+        check_cancelled()
+        with profiler.stage('grading'):
+            (error_message, grading_breakdown_list, overall_parsed_result), grading_job = grading_scheduler.run(
+                user_id, priority_class, profiler.wrap(grade_prepared_request), chat_client, grading_request, cancel_token=current_token()
+            )
+        if error_message:
+            flash(error_message, 'error')
+            return {"error": error_message}, 500
+        checkpoints.save('llm_response', (grading_breakdown_list, overall_parsed_result))
+    else:
+        grading_breakdown_list, overall_parsed_result = llm_response
+    check_cancelled()
+    # Only the table is built here; the styled Excel workbook is generated when it is downloaded.
+    with profiler.stage('report'):
+        report_df = build_report_dataframe(original_rubric_dataframe, grading_breakdown_list, overall_parsed_result)
+        result_id = str(uuid.uuid4())
+        result_payload = {'result_id': result_id, 'report': report_dataframe_to_compact_json(report_df, original_rubric_dataframe)}
+    _store_analysis_result(result_id, {
+        'payload': result_payload,
+        'etag': hashlib.sha256(json.dumps(result_payload, sort_keys=True).encode('utf-8')).hexdigest()[:32],
+        'original_name': original_project_file_name,
+        'rubric_dataframe': original_rubric_dataframe,
+        'grading_breakdown': grading_breakdown_list,
+        'overall_result': overall_parsed_result,
+    })
+    try:
+        grade_warehouse.record_result(
+            result_id, submission['sha256']['rubric'], grading_request['all_criteria'], grading_breakdown_list, overall_parsed_result,
+            requirements_sha256=submission['sha256']['requirements'], cohort=cohort, user_id=user_id,
+            submission_name=original_project_file_name, grading_seconds=grading_job.run_seconds if grading_job else None)
     except Exception as e:
-        print(f"An unexpected error occurred during analysis: {e}")
-        flash(f"An unexpected error occurred: {e}", 'error')
+        print(f"Warning: could not store result {result_id} in the grade warehouse: {e}")
+    return {
+        'success': True, 'message': "Analysis complete!", 'result': result_payload,
+        'collection_report': {key: value for key, value in collection_report.items() if key not in ('file_paths', 'overflow_files')},
+        'project_summaries': {key: value for key, value in summaries.items() if key != 'text'},
+        'grading_stats': overall_parsed_result.get('grading_stats', {}),
+        'admission': {key: admission[key] for key in ('policy', 'violations', 'actions', 'estimate')},
+        'profile': _profile_response(profiler),
+        'queue': {'priority_class': priority_class, 'queue_wait_seconds': grading_job.queue_wait_seconds, 'grading_seconds': grading_job.run_seconds} if grading_job else None,
+        'resumed_stages': checkpoints.resumed_stages,
+        'result_url': url_for('get_analysis_result', result_id=result_id, _external=True),
+        'download_url': url_for('download_evaluated_report', file_id=result_id, _external=True)
+    }, 200
+
+def _summary_usage(summaries):
+    """The calls and tokens of a job's project summaries, for the admission estimate."""
+    return dict({key: summaries.get(key, 0) for key in ('calls', 'prompt_tokens', 'completion_tokens')}, estimated=bool(summaries.get('estimated')))
+
+def _profile_response(profiler):
+    """Stops a profiled request and returns its per-stage summary and artifact URLs (None when not profiled)."""
+    summary = profiler.finish()
+    if summary is None: return None
+    return dict(summary, downloads={artifact: url_for('download_profile_artifact', profile_id=profiler.profile_id, artifact=artifact, _external=True)
+                                    for artifact in PROFILE_ARTIFACTS})
+
+@app.route('/profiles/<profile_id>/<artifact>')
+def download_profile_artifact(profile_id, artifact):
+    """Serves a stored profile artifact (pstats, stacks or summary); requires the profiling admin token."""
+    if not _profiling_requested():
+        return jsonify({"error": "Profiling is not enabled or the profile token is missing."}), 403
+    if artifact not in PROFILE_ARTIFACTS:
+        return jsonify({"error": f"Unknown profile artifact '{artifact}'. Allowed: {', '.join(PROFILE_ARTIFACTS)}."}), 404
+    artifact_path = os.path.join(app.config['PROFILE_FOLDER'], secure_filename(profile_id), PROFILE_ARTIFACTS[artifact])
+    if not os.path.isfile(artifact_path):
+        return jsonify({"error": "Profile not found."}), 404
+    return send_file(os.path.abspath(artifact_path), as_attachment=True, download_name=f"{profile_id}_{PROFILE_ARTIFACTS[artifact]}")
+
+def _job_dir(job_id):
+    job_id = secure_filename(job_id)
+    return workspace.find(job_id) or os.path.join(app.config['JOBS_FOLDER'], job_id)
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Status of a retained (failed) job: its error, the stages already checkpointed and when it expires."""
+    job = load_job(_job_dir(job_id))
+    if job is None:
+        return jsonify({"error": "Job not found or expired."}), 404
+    return jsonify(dict({key: job.get(key) for key in ('job_id', 'status', 'error', 'created_at', 'updated_at')},
+                        completed_stages=JobCheckpoints(_job_dir(job_id)).completed_stages(),
+                        expires_at=job['updated_at'] + JOB_RETENTION_SECONDS,
+                        retry_url=url_for('retry_job', job_id=job_id, _external=True)))
+
+@app.route('/jobs/<job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """Re-runs a failed job from its first stage without a checkpoint, reusing the stored uploads."""
+    job_dir = _job_dir(job_id)
+    job = load_job(job_dir)
+    if job is None:
+        return jsonify({"error": "Job not found or expired."}), 404
+    if (job['submission'].get('user_id'), job['submission'].get('cohort')) != _requester():
+        return jsonify({"error": "This job was submitted by another user."}), 403
+    if job['job_id'] in active_job_ids:
+        return jsonify({"error": "This job is still running."}), 409
+    update_job(job_dir, status='running', error=None)
+    workspace.activate(job_dir)
+    cancel_token = job_cancel_tokens.setdefault(job['job_id'], (CancelToken(), _requester()))[0] # Concurrent retries share one token
+    _watch_for_disconnect(job['job_id'], cancel_token)
+    response_body, status_code = {"error": "Analysis did not complete."}, 500
+    try:
+        # Concurrent retries of the same job share one run
+        (response_body, status_code), _ = analysis_flights.run(
+            f"job:{job['job_id']}", lambda: _run_analysis_pipeline(job['submission'], NULL_PROFILER), replayable=lambda outcome: False,
+            cancel_token=cancel_token)
+    except JobCancelled as e:
+        print(f"Retry of job {job_id} was cancelled: {e}")
+        response_body, status_code = {"error": f"Analysis cancelled: {e}", "cancelled": True}, JOB_CANCELLED_STATUS
+    except Exception as e:
+        print(f"An unexpected error occurred while retrying job {job_id}: {e}")
         import traceback
-        traceback.print_exc() 
-        return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
+        traceback.print_exc()
+        response_body, status_code = {"error": f"An unexpected error occurred: {e}"}, 500
     finally:
-        if os.path.exists(temp_upload_dir):
-            try:
-                shutil.rmtree(temp_upload_dir)
-            except OSError as e:
-                print(f"Error removing temporary directory {temp_upload_dir}: {e}")
+        if job_cancel_tokens.get(job['job_id'], (None, None))[0] is cancel_token: job_cancel_tokens.pop(job['job_id'], None)
+        job_kept = _finish_job(job_dir, status_code, response_body.get('error'))
+    if job_kept:
+        response_body = dict(response_body, job_id=job['job_id'], retry_url=url_for('retry_job', job_id=job['job_id'], _external=True))
+    return jsonify(response_body), status_code
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Cancels a running job: it stops at the next stage boundary (or leaves the grading queue), an in-flight
+    OpenAI call is abandoned, and its workspace is reclaimed. A submission shared by coalesced requests keeps
+    running until all of them are cancelled. Only the user and cohort that started the job may cancel it.
+    """
+    cancel_token, owner = job_cancel_tokens.get(job_id, (None, None))
+    if cancel_token is None:
+        return jsonify({"error": "No running job with this id."}), 404
+    if owner != _requester():
+        return jsonify({"error": "This job was submitted by another user."}), 403
+    cancel_token.cancel("cancelled by the client")
+    return jsonify({"job_id": job_id, "status": "cancelling"}), 202
+
+@app.route('/uploads', methods=['POST'])
+def start_chunked_upload():
+    """
+    Starts a resumable upload of a project archive (JSON body {"filename", "size"}). The size is checked and
+    the job workspace reserved before any data is sent; the response gives the upload id and chunk size.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        return jsonify(chunked_uploads.init(body.get('filename'), body.get('size'))), 201
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except WorkspaceFullError as e:
+        return jsonify({"error": str(e)}), 503, {'Retry-After': str(e.retry_after_seconds)}
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'DELETE'])
+def chunked_upload(upload_id):
+    """GET: the chunks received so far (to resume an interrupted upload). DELETE: abandons the upload."""
+    if request.method == 'DELETE':
+        if not chunked_uploads.abort(upload_id):
+            return jsonify({"error": "Upload not found or expired."}), 404
+        return jsonify({"upload_id": upload_id, "aborted": True})
+    try:
+        return jsonify(chunked_uploads.status(upload_id))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def put_upload_chunk(upload_id, index):
+    """Stores one chunk; the raw body must match the X-Chunk-Offset and X-Chunk-SHA256 headers."""
+    try:
+        offset = int(request.headers.get('X-Chunk-Offset', ''))
+    except ValueError:
+        return jsonify({"error": "X-Chunk-Offset must be the chunk's byte offset."}), 400
+    try:
+        return jsonify(chunked_uploads.put_chunk(upload_id, index, offset, request.get_data(cache=False), request.headers.get('X-Chunk-SHA256')))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Verifies that every chunk arrived and the archive is a ZIP; /analyze then takes projectUploadId=<upload_id>."""
+    try:
+        return jsonify(chunked_uploads.complete(upload_id))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+
+@app.route('/results/<result_id>')
+def get_analysis_result(result_id):
+    """Returns the compact JSON result; clients revalidate with If-None-Match and get 304 when unchanged."""
+    result = _get_analysis_result(result_id)
+    if not result:
+        return jsonify({"error": "Result not found or expired."}), 404
+    etag = result['etag']
+    # The compression hook suffixes the ETag with the content coding, so accept those variants too.
+    if any(request.if_none_match.contains(etag + suffix) for suffix in ('', '-gzip', '-br')):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(result['payload'])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/deployments/stats')
+def deployment_stats():
+    """Per-deployment request, error, throttle, latency and circuit state (deployment pool) and hedging metrics."""
+    if not hasattr(chat_client, 'stats'):
+        return jsonify({"error": "No deployment pool or request hedging configured (set AZURE_OPENAI_DEPLOYMENT_POOL or GRADING_HEDGE_BUDGET_PERCENT)."}), 404
+    return jsonify(chat_client.stats())
+
+@app.route('/workspace/stats')
+def workspace_stats():
+    """Disk used by running, retained and reclaiming job directories, the quota and sweep/reclaim counters."""
+    return jsonify(dict(workspace.stats(), chunked_uploads=chunked_uploads.stats()))
+
+@app.route('/scheduler/stats')
+def scheduler_stats():
+    return jsonify(dict(grading_scheduler.stats(), coalescing=analysis_flights.stats()))
+
+def _analytics_authorized():
+    supplied_token = request.headers.get('X-Analytics-Token') or request.args.get('token')
+    return bool(ANALYTICS_ADMIN_TOKEN and supplied_token and hmac.compare_digest(supplied_token, ANALYTICS_ADMIN_TOKEN))
+
+ANALYTICS_FORBIDDEN = {"error": "Analytics are not enabled or the analytics token is missing."}
+
+def _analytics_scope():
+    """(rubric_sha256, cohort) from the query string; defaults to the most recently graded rubric."""
+    rubric_sha256 = request.args.get('rubric')
+    if not rubric_sha256:
+        rubrics = grade_warehouse.rubrics()
+        rubric_sha256 = rubrics[0]['rubric_sha256'] if rubrics else None
+    return rubric_sha256, request.args.get('cohort') or None
+
+@app.route('/analytics/rubrics')
+def analytics_rubrics():
+    if not _analytics_authorized():
+        return jsonify(ANALYTICS_FORBIDDEN), 403
+    return jsonify(grade_warehouse.rubrics())
+
+@app.route('/analytics/distribution')
+def analytics_distribution():
+    """Total-score statistics, percentiles and histogram for ?rubric=<sha256>&cohort=<name>&bins=<n>."""
+    if not _analytics_authorized():
+        return jsonify(ANALYTICS_FORBIDDEN), 403
+    rubric_sha256, cohort = _analytics_scope()
+    bins = max(1, min(request.args.get('bins', 10, type=int), 100))
+    return jsonify(dict(grade_warehouse.cohort_distribution(rubric_sha256, cohort, bins), rubric_sha256=rubric_sha256, cohort=cohort))
+
+@app.route('/analytics/criteria')
+def analytics_criteria():
+    """Per-criterion averages for ?rubric=<sha256>&cohort=<name>."""
+    if not _analytics_authorized():
+        return jsonify(ANALYTICS_FORBIDDEN), 403
+    rubric_sha256, cohort = _analytics_scope()
+    return jsonify({'rubric_sha256': rubric_sha256, 'cohort': cohort, 'criteria': grade_warehouse.criterion_averages(rubric_sha256, cohort)})
+
+@app.route('/analytics/outliers')
+def analytics_outliers():
+    """Submissions more than ?z=<threshold> (default 2) standard deviations from the cohort mean."""
+    if not _analytics_authorized():
+        return jsonify(ANALYTICS_FORBIDDEN), 403
+    rubric_sha256, cohort = _analytics_scope()
+    z_threshold = request.args.get('z', 2.0, type=float)
+    return jsonify(dict(grade_warehouse.outliers(rubric_sha256, cohort, z_threshold), rubric_sha256=rubric_sha256, cohort=cohort))
 
 @app.route('/download_evaluated_report/<file_id>')
 def download_evaluated_report(file_id):
-    file_info = session_download_files.pop(file_id, None) 
-    if file_info and os.path.exists(file_info['filepath']):
-        filepath = file_info['filepath']
-        # --- FIX for 403 Forbidden error ---
-        # This check will now work correctly with absolute paths.
-        if not filepath.startswith(os.path.abspath(app.config['DOWNLOAD_FOLDER'])):
-            print(f"Security Warning: Attempted download outside allowed folder: {filepath}")
-            return "Invalid file path.", 403
-        try:
-            download_name = f"{file_info.get('original_name', 'report')}_Grading_Report.xlsx"
-            return send_file(filepath, as_attachment=True, download_name=download_name)
-        except Exception as e:
-            print(f"Error sending file {filepath}: {e}")
-            return "Error downloading file.", 500
-        finally:
-            if os.path.exists(filepath):
-                try: os.remove(filepath)
-                except OSError as e: print(f"Error removing temp file {filepath}: {e}")
-    else:
+    result = _get_analysis_result(file_id)
+    if not result:
         return "File not found or expired.", 404
+    try:
+        if 'excel_bytes' not in result: # Generated lazily, on the first download only
+            result['excel_bytes'], _ = generate_styled_excel_report(result['rubric_dataframe'], result['grading_breakdown'], result['overall_result'])
+        download_name = f"{result.get('original_name', 'report')}_Grading_Report.xlsx"
+        return send_file(io.BytesIO(result['excel_bytes']), as_attachment=True, download_name=download_name,
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    except Exception as e:
+        print(f"Error generating report for {file_id}: {e}")
+        return "Error downloading file.", 500
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-compresses JSON and HTML responses for clients that accept it."""
+    accept_encoding = request.headers.get('Accept-Encoding', '').lower()
+    if (response.direct_passthrough or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+    if brotli and 'br' in accept_encoding:
+        encoding, compressed = 'br', brotli.compress(data, quality=5)
+    elif 'gzip' in accept_encoding:
+        encoding, compressed = 'gzip', gzip.compress(data, compresslevel=6)
+    else:
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
 
 if __name__ == '__main__':
     ensure_upload_dirs()
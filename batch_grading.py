@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import time
+import uuid
+import threading
+
+# --- Deferred (Batch API) Grading ---
+# Bulk grading where latency does not matter goes through the OpenAI/Azure OpenAI Batch API instead of
+# synchronous chat calls: grading requests are written to a JSONL file, uploaded, graded within the
+# 24h completion window at the batch discount and on a separate quota, and the results are fanned back
+# into per-submission reports (see grade_cli.py --deferred). LocalBatchClient implements the same client
+# surface offline with canned grades, for exercising the whole workflow without credentials.
+
+BATCH_ENDPOINT = os.getenv("GRADING_BATCH_ENDPOINT", "/chat/completions") # OpenAI (non-Azure) uses /v1/chat/completions
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_MAX_REQUESTS = 50000 # Per-file limits of the Batch API
+BATCH_MAX_FILE_BYTES = 190 * 1024 * 1024
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+def batch_deployment_name():
+    """Azure batch jobs need a Global-Batch deployment; defaults to the regular chat deployment."""
+    return os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT_NAME") or os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")
+
+def batch_request_line(custom_id, deployment_name, messages, max_tokens=4000):
+    """One JSONL line of a batch input file: the same chat completion the synchronous grader would send."""
+    return json.dumps({
+        "custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+        "body": {"model": deployment_name, "messages": messages, "temperature": 0.4, "max_tokens": max_tokens, "response_format": {"type": "json_object"}},
+    }, separators=(',', ':'))
+
+def split_batch_requests(requests):
+    """Splits (custom_id, line) pairs into chunks that respect the per-file request and size limits."""
+    chunk, chunk_bytes = [], 0
+    for custom_id, line in requests:
+        line_bytes = len(line.encode('utf-8')) + 1
+        if chunk and (len(chunk) >= BATCH_MAX_REQUESTS or chunk_bytes + line_bytes > BATCH_MAX_FILE_BYTES):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append((custom_id, line))
+        chunk_bytes += line_bytes
+    if chunk: yield chunk
+
+def submit_batch(batch_client, lines):
+    """Uploads the JSONL input and creates the batch job. Returns the batch id."""
+    input_file = batch_client.files.create(file=(f"grading_{uuid.uuid4().hex[:8]}.jsonl", ("\n".join(lines) + "\n").encode('utf-8')), purpose="batch")
+    batch = batch_client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW)
+    print(f"Submitted batch {batch.id} with {len(lines)} grading requests (input file {input_file.id}).")
+    return batch.id
+
+def _request_counts(batch):
+    counts = getattr(batch, 'request_counts', None)
+    return {key: getattr(counts, key, None) for key in ('total', 'completed', 'failed')} if counts is not None else {}
+
+def poll_batch(batch_client, batch_id):
+    """Returns (status, batch); status is one of the Batch API statuses."""
+    batch = batch_client.batches.retrieve(batch_id)
+    return batch.status, batch
+
+def read_batch_results(batch_client, batch):
+    """
+    Downloads a finished batch's output and error files. Returns {custom_id: (content, usage, error)} where
+    content is the raw assistant message (None on error) and usage the token usage dict.
+    """
+    results = {}
+    for file_id in (getattr(batch, 'output_file_id', None), getattr(batch, 'error_file_id', None)):
+        if not file_id: continue
+        for line in batch_client.files.content(file_id).text.splitlines():
+            if not line.strip(): continue
+            record = json.loads(line)
+            response, error = record.get('response') or {}, record.get('error')
+            body = response.get('body') or {}
+            if error or response.get('status_code') != 200 or not body.get('choices'):
+                message = (error or {}).get('message') or (body.get('error') or {}).get('message') or f"HTTP {response.get('status_code')}"
+                results[record['custom_id']] = (None, None, message)
+            else:
+                results[record['custom_id']] = (body['choices'][0]['message']['content'], body.get('usage') or {}, None)
+    return results
+
+def describe_batch(batch):
+    counts = _request_counts(batch)
+    return f"{batch.status} ({counts.get('completed') or 0}/{counts.get('total') or 0} done, {counts.get('failed') or 0} failed)"
+
+# --- Local stand-in for the Batch API ---
+
+class _Record:
+    def __init__(self, **fields): self.__dict__.update(fields)
+
+class _LocalFiles:
+    def __init__(self, server): self._server = server
+
+    def create(self, file, purpose):
+        name, content = file if isinstance(file, tuple) else (os.path.basename(file.name), file.read())
+        return self._server.store_file(content if isinstance(content, bytes) else content.encode('utf-8'))
+
+    def content(self, file_id):
+        with open(self._server.file_path(file_id), 'r', encoding='utf-8') as f:
+            return _Record(text=f.read())
+
+class _LocalBatches:
+    def __init__(self, server): self._server = server
+
+    def create(self, input_file_id, endpoint, completion_window, **kwargs):
+        return self._server.start_batch(input_file_id, endpoint)
+
+    def retrieve(self, batch_id):
+        return self._server.batch(batch_id)
+
+class LocalBatchClient:
+    """
+    Offline stand-in exposing client.files and client.batches like the OpenAI SDK. Files live under root_dir;
+    each batch is processed on a background thread after processing_delay_seconds, answering every request
+    with a deterministic grade of half the max score, so deferred grading can be tested end to end.
+    """
+
+    def __init__(self, root_dir, processing_delay_seconds=1.0):
+        self.root_dir = root_dir
+        self.processing_delay_seconds = processing_delay_seconds
+        os.makedirs(root_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._batches = {}
+        self.files, self.batches = _LocalFiles(self), _LocalBatches(self)
+
+    def file_path(self, file_id):
+        return os.path.join(self.root_dir, f"{file_id}.jsonl")
+
+    def store_file(self, content):
+        file_id = f"file-local-{uuid.uuid4().hex[:12]}"
+        with open(self.file_path(file_id), 'wb') as f:
+            f.write(content)
+        return _Record(id=file_id)
+
+    def start_batch(self, input_file_id, endpoint):
+        batch_id = f"batch-local-{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._batches[batch_id] = {"status": "validating", "input_file_id": input_file_id, "output_file_id": None, "error_file_id": None, "counts": (0, 0, 0)}
+        threading.Thread(target=self._process, args=(batch_id,), daemon=True).start()
+        return self.batch(batch_id)
+
+    def batch(self, batch_id):
+        with self._lock:
+            state = dict(self._batches[batch_id])
+        total, completed, failed = state.pop("counts")
+        return _Record(id=batch_id, request_counts=_Record(total=total, completed=completed, failed=failed), **state)
+
+    def _process(self, batch_id):
+        with open(self.file_path(self.batch(batch_id).input_file_id), 'r', encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        with self._lock:
+            self._batches[batch_id].update(status="in_progress", counts=(len(requests), 0, 0))
+        time.sleep(self.processing_delay_seconds)
+        output_lines = [json.dumps({
+            "id": f"response-{index}", "custom_id": request["custom_id"], "error": None,
+            "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": _canned_completion(request["body"])},
+        }) for index, request in enumerate(requests)]
+        output_file = self.store_file(("\n".join(output_lines) + "\n").encode('utf-8'))
+        with self._lock:
+            self._batches[batch_id].update(status="completed", output_file_id=output_file.id, counts=(len(requests), len(requests), 0))
+
+def _canned_completion(body):
+    """Grades every criterion listed in the prompt with half its max score."""
+    prompt_text = next(part["text"] for part in body["messages"][-1]["content"] if part.get("type") == "text")
+    criteria_match = re.search(r'```json\n(.*?)\n```', prompt_text, re.DOTALL) # The first block lists the criteria
+    criteria = json.loads(criteria_match.group(1)) if criteria_match else []
+    if isinstance(criteria, dict): # Compact prompt layout: grouped rows under "columns"
+        criteria = [dict(zip(criteria["columns"], row)) for group in criteria.get("groups", []) for row in group.get("criteria", [])]
+    grades = [{"criterion_id": criterion["criterion_id"], "criterion_name": criterion.get("criterion_name"),
+               "score_achieved": (criterion.get("max_score") or 0) / 2, "comments": "Stand-in grade from the local batch server."} for criterion in criteria]
+    content = json.dumps({"overall_total_score": sum(grade["score_achieved"] for grade in grades),
+                          "overall_feedback": "Graded by the local batch stand-in.", "grades": grades})
+    return {"object": "chat.completion", "model": body.get("model"), "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": len(prompt_text) // 4, "completion_tokens": len(content) // 4, "total_tokens": (len(prompt_text) + len(content)) // 4}}
@@ -0,0 +1,102 @@
+"""
+Grading prompt size benchmark: builds the prompt for one submission in the legacy layout (rubric markdown
+table plus the pretty-printed criteria list, fenced files) and in the compact layout (each criterion once as
+minified grouped JSON, file manifest), and prints characters and tokens for both.
+
+Usage:
+    python bench_prompt.py                      # synthetic 80-criterion rubric and a 12-file project
+    python bench_prompt.py --rubric rubric.xlsx --requirements spec.docx --project path/to/extracted_project
+    python bench_prompt.py > bench_output.txt
+"""
+import sys
+import random
+import argparse
+import pandas as pd
+import utils
+from utils import (
+    process_rubric_excel, read_requirements_file, collect_project_content, prepare_grading_request, grading_prompt_for,
+    estimate_tokens, _identify_rubric_columns,
+)
+
+PROMPT_STYLES = ('legacy', 'compact')
+
+def synthetic_rubric(rows=80, seed=7):
+    """A rubric laid out like the ones reviewers upload: category/parameter groups, guidance text and grader-filled blanks."""
+    rng = random.Random(seed)
+    categories = ["Functionality", "Code Quality", "Testing", "Documentation", "Deployment", "Security", "UI/UX", "Performance"]
+    records = []
+    for index in range(rows):
+        category = categories[index * len(categories) // rows]
+        records.append({
+            "S.No": index + 1,
+            "Category": category,
+            "Parameters": f"{category} aspect {index % 3 + 1}",
+            "Evaluation Criteria": f"{category}: requirement {index + 1} is implemented as specified",
+            "Guidelines": " ".join(rng.choice(["The submission", "handles", "invalid input", "gracefully", "and", "documents", "the behaviour",
+                                                "with tests", "covering", "edge cases", "consistently"]) for _ in range(18)),
+            "Max Score": rng.choice([2, 3, 5]),
+            "Marks Obtained": None,
+            "Remarks": None,
+        })
+    df_rubric = pd.DataFrame(records)
+    col_map = _identify_rubric_columns(df_rubric)
+    df_rubric.reset_index(inplace=True)
+    df_rubric['is_summary_row'] = False
+    rubric_markdown = df_rubric.drop(columns=['is_summary_row', 'index']).to_markdown(index=False)
+    df_rubric.set_index('index', inplace=True, drop=False)
+    df_rubric._identified_columns = col_map
+    return rubric_markdown, df_rubric
+
+def synthetic_project(files=12, seed=11):
+    rng = random.Random(seed)
+    statements = ["result = parse(line)", "if not result:\n        continue", "totals[key] += value", "logger.info('processed %s', name)",
+                  "return sorted(items, key=lambda item: item.score)", "with open(path) as handle:\n        data = handle.read()"]
+    return {f"{rng.choice(['src', 'src/services', 'tests'])}/module_{index}.py":
+            "\n".join(f"def function_{index}_{n}(line):\n    " + "\n    ".join(rng.choice(statements) for _ in range(6)) for n in range(8))
+            for index in range(files)}
+
+def synthetic_requirements():
+    return "\n".join(f"[{n}] The system shall support capability {n} and report errors clearly." for n in range(1, 31))
+
+def measure(style, rubric_markdown, df_rubric, requirements_text, project_files):
+    """(prompt_chars, prompt_tokens, overhead_tokens, criteria_count) for one layout; overhead excludes requirements and project files."""
+    utils.GRADING_PROMPT_STYLE = style
+    _, grading_request = prepare_grading_request(df_rubric, rubric_markdown, requirements_text, project_files, [], False)
+    prompt_text = grading_prompt_for(grading_request, grading_request["criteria_for_ai"])
+    _, bare_request = prepare_grading_request(df_rubric, rubric_markdown, "", {}, [], False)
+    return len(prompt_text), estimate_tokens(prompt_text), estimate_tokens(grading_prompt_for(bare_request, bare_request["criteria_for_ai"])), len(grading_request["criteria_for_ai"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare grading prompt sizes for the legacy and compact layouts.")
+    parser.add_argument("--rubric", help="Rubric Excel/CSV (default: synthetic 80-criterion rubric).")
+    parser.add_argument("--requirements", help="Requirements document (default: synthetic).")
+    parser.add_argument("--project", help="Extracted project directory (default: synthetic 12-file project).")
+    args = parser.parse_args(argv)
+
+    rubric_markdown, df_rubric = process_rubric_excel(args.rubric) if args.rubric else synthetic_rubric()
+    if df_rubric is None:
+        print(f"Could not read rubric {args.rubric}.")
+        return 1
+    requirements_text = (read_requirements_file(args.requirements) or "") if args.requirements else synthetic_requirements()
+    project_files = collect_project_content(args.project)[0] if args.project else synthetic_project()
+
+    configured_style = utils.GRADING_PROMPT_STYLE
+    try:
+        results = {style: measure(style, rubric_markdown, df_rubric, requirements_text, project_files) for style in PROMPT_STYLES}
+    finally:
+        utils.GRADING_PROMPT_STYLE = configured_style
+    criteria_count = results['compact'][3]
+    token_source = "tiktoken o200k_base" if utils._TOKEN_ENCODER else f"~{utils.CHARS_PER_TOKEN_ESTIMATE} chars/token"
+    print(f"Grading prompt size: {criteria_count} criteria, {len(project_files)} files, {len(requirements_text)} requirement chars (tokens: {token_source})")
+    print(f"{'layout':<8} {'chars':>9} {'tokens':>8} {'rubric+instruction tokens':>26}")
+    for style in PROMPT_STYLES:
+        chars, tokens, overhead_tokens, _ = results[style]
+        print(f"{style:<8} {chars:>9} {tokens:>8} {overhead_tokens:>26}")
+    (_, legacy_tokens, legacy_overhead, _), (_, compact_tokens, compact_overhead, _) = results['legacy'], results['compact']
+    print(f"compact saves {legacy_tokens - compact_tokens} prompt tokens per grading call "
+          f"({(legacy_tokens - compact_tokens) / max(1, legacy_tokens):.1%} of the prompt, "
+          f"{(legacy_overhead - compact_overhead) / max(1, legacy_overhead):.1%} of the rubric and instruction overhead)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import os
+import time
+import types
+import threading
+import contextlib
+
+# --- Cooperative Cancellation ---
+# A CancelToken belongs to one running job. It is cancelled when the client disconnects or calls
+# POST /jobs/<job_id>/cancel, and the pipeline checks it between stages (check_cancelled()). The token of
+# the job a thread is working for is held in a thread-local scope, so deep helpers (the OpenAI call, the
+# retry back-off, content collection) find it without it being threaded through every signature, and
+# helpers that run nothing cancellable pay one attribute lookup. OpenAI calls are streamed
+# (streamed_completion()) and the token closes the stream's HTTP response on cancellation, so Azure stops
+# generating, and billing, the completion at once. Closing the socket does not wake a read already blocked
+# on it, so call_cancellable() runs the call on a daemon thread: the job's worker returns immediately and
+# makes no retries or follow-up calls, while the closed call fails on its next read.
+
+class JobCancelled(BaseException):
+    """
+    Raised inside a job whose CancelToken was cancelled. Like KeyboardInterrupt it derives from
+    BaseException, so the pipeline's `except Exception` error handling does not turn it into a grading error.
+    """
+
+class CancelToken:
+    """A one-shot cancellation flag with callbacks; cancel() may be called from any thread."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="Cancelled"):
+        """Cancels the token and runs its callbacks; returns False if it was already cancelled."""
+        with self._lock:
+            if self._event.is_set(): return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancellation callback failed: {e}")
+        return True
+
+    def on_cancel(self, callback):
+        """Runs callback() when the token is cancelled (right away if it already is)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout=None):
+        """Blocks until the token is cancelled or timeout passes; returns True if it was cancelled."""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set(): raise JobCancelled(self.reason)
+
+_local = threading.local()
+
+def current_token():
+    """The CancelToken of the job this thread is working for, or None outside a cancellation scope."""
+    return getattr(_local, 'token', None)
+
+@contextlib.contextmanager
+def cancellation_scope(token):
+    """Makes token the current token of this thread for the duration of the block."""
+    previous = current_token()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+def check_cancelled():
+    """Raises JobCancelled if the current job has been cancelled; a no-op outside a cancellation scope."""
+    token = current_token()
+    if token is not None: token.raise_if_cancelled()
+
+def cancellable_sleep(seconds):
+    """time.sleep that wakes up and raises JobCancelled as soon as the current job is cancelled."""
+    token = current_token()
+    if token is None:
+        time.sleep(seconds)
+    elif token.wait(seconds):
+        raise JobCancelled(token.reason)
+
+def call_cancellable(func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) and returns its result, or raises JobCancelled as soon as the current job is
+    cancelled. Inside a cancellation scope func runs on a daemon thread, in the same scope, and is no longer
+    waited for once the job is cancelled.
+    """
+    token = current_token()
+    if token is None: return func(*args, **kwargs)
+    token.raise_if_cancelled()
+    outcome = {}
+    finished = threading.Event()
+    def run():
+        try:
+            with cancellation_scope(token): # So func can register its own cleanup, e.g. closing a stream
+                outcome['result'] = func(*args, **kwargs)
+        except BaseException as e:
+            outcome['exception'] = e
+        finally:
+            finished.set()
+    threading.Thread(target=run, daemon=True, name="cancellable-call").start()
+    token.on_cancel(finished.set)
+    finished.wait()
+    if 'exception' in outcome: raise outcome['exception']
+    if 'result' in outcome: return outcome['result']
+    raise JobCancelled(token.reason)
+
+# Usage totals arrive in a last chunk only when asked for; API versions before 2024-09-01-preview reject
+# stream_options, so set STREAM_INCLUDE_USAGE=0 there (token counts are then reported as unknown).
+STREAM_INCLUDE_USAGE = os.getenv("STREAM_INCLUDE_USAGE", "1").lower() not in ('0', 'false', 'no')
+
+def read_completion_stream(stream):
+    """
+    Assembles a streamed chat completion into a ChatCompletion-shaped object (choices[0].message.content,
+    choices[0].finish_reason, usage). A response that is not a stream is returned unchanged.
+    """
+    if hasattr(stream, 'choices'): return stream
+    parts, finish_reason, usage = [], None, None
+    for chunk in stream:
+        usage = getattr(chunk, 'usage', None) or usage
+        for choice in getattr(chunk, 'choices', None) or []:
+            content = getattr(getattr(choice, 'delta', None), 'content', None)
+            if content: parts.append(content)
+            finish_reason = getattr(choice, 'finish_reason', None) or finish_reason
+    message = types.SimpleNamespace(role="assistant", content="".join(parts))
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(index=0, message=message, finish_reason=finish_reason)], usage=usage)
+
+def close_on_cancel(stream):
+    """Closes stream (its HTTP response) when the current job is cancelled, right away if it already is."""
+    token = current_token()
+    if token is not None and hasattr(stream, 'close'): token.on_cancel(stream.close)
+
+def streamed_completion(create, **kwargs):
+    """
+    create(stream=True, **kwargs) (a chat.completions.create), read to the end and assembled by
+    read_completion_stream(). The stream is closed if the current job is cancelled while it is being read.
+    """
+    if STREAM_INCLUDE_USAGE: kwargs['stream_options'] = {"include_usage": True}
+    stream = create(stream=True, **kwargs)
+    close_on_cancel(stream)
+    return read_completion_stream(stream)
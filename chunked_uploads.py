@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import zipfile
+import threading
+
+# --- Resumable Chunked Uploads ---
+# Large project archives are uploaded in fixed-size chunks instead of one multipart POST:
+#   POST   /uploads                      init: filename and total size are validated and the job workspace
+#                                        is allocated (quota applies) before any data is sent
+#   PUT    /uploads/<id>/chunks/<index>  one chunk, with its byte offset (X-Chunk-Offset) and SHA-256
+#                                        (X-Chunk-SHA256); it is verified and written in place
+#   GET    /uploads/<id>                 which chunks have arrived, so a client resumes with the rest
+#   POST   /uploads/<id>/complete        checks that every chunk arrived and that the result is a ZIP
+#   DELETE /uploads/<id>                 gives up and reclaims the workspace
+# Chunks may arrive in any order and in parallel; each is written at its offset into a preallocated
+# file inside the job directory, so the completed archive is already where /analyze expects it. The
+# completed upload is then claimed by /analyze (form field projectUploadId) and becomes that job. Each
+# session is also written to upload.json in its job directory after every change and reloaded at startup,
+# so a client can resume an upload across a server restart. Sessions idle for longer than the session
+# TTL are aborted, and their workspace reclaimed, on every workspace sweep and whenever an upload starts.
+
+DEFAULT_CHUNK_BYTES = 8 * 1024 * 1024
+DEFAULT_SESSION_TTL_SECONDS = 60 * 60
+SESSION_FILENAME = "upload.json"
+
+class UploadError(Exception):
+    """A rejected upload request; status_code is the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ChunkedUploads:
+    """Resumable upload sessions whose chunks are assembled in place in a job workspace."""
+
+    def __init__(self, workspace, max_upload_bytes, allowed_extensions=('.zip',), chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 reserve_factor=1.0, session_ttl_seconds=DEFAULT_SESSION_TTL_SECONDS):
+        self.workspace = workspace
+        self.max_upload_bytes = max_upload_bytes
+        self.allowed_extensions = tuple(allowed_extensions)
+        self.chunk_bytes = chunk_bytes
+        self.reserve_factor = reserve_factor # Workspace reserved per upload byte (the archive plus its extraction)
+        self.session_ttl_seconds = session_ttl_seconds
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self.started = self.completed = self.expired = self.resumed = self.chunks_received = self.chunk_checksum_failures = 0
+        self._load_sessions()
+        workspace.add_sweep_hook(self.expire_idle)
+
+    def _save_session(self, session):
+        """Writes the session to its job directory atomically (a unique temp file: chunks are saved concurrently)."""
+        with self._lock:
+            if self._sessions.get(session['upload_id']) is not session: return # Claimed or aborted meanwhile
+            state = dict(session, received=sorted(session['received']))
+        temp_path = os.path.join(session['job_dir'], f"{SESSION_FILENAME}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(temp_path, os.path.join(session['job_dir'], SESSION_FILENAME))
+        except FileNotFoundError:
+            pass # Aborted meanwhile; the directory is gone
+
+    def _load_sessions(self):
+        """Reloads the unclaimed sessions of an earlier run and reserves their workspace again."""
+        for root in self.workspace.roots:
+            if not os.path.isdir(root): continue
+            for entry in os.scandir(root):
+                try:
+                    with open(os.path.join(entry.path, SESSION_FILENAME), 'r', encoding='utf-8') as f:
+                        session = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    continue # Not an upload (or an unreadable one, which the workspace sweep reclaims)
+                session.update(job_dir=entry.path, path=os.path.join(entry.path, os.path.basename(session['path'])), received=set(session['received']))
+                self.workspace.activate(entry.path, int(session['total_bytes'] * self.reserve_factor))
+                self._sessions[session['upload_id']] = session
+                self.resumed += 1
+        if self.resumed: print(f"Resumed {self.resumed} chunked uploads from an earlier run.")
+
+    def init(self, filename, total_bytes):
+        """Validates an upload, allocates its job workspace and preallocates the file. Returns the session status."""
+        self.expire_idle()
+        # Judged by the original name: secure_filename() turns a non-ASCII name such as "项目.zip" into "zip"
+        extension = os.path.splitext(filename or '')[1].lower()
+        if extension not in self.allowed_extensions:
+            raise UploadError(f"Unsupported project file type. Allowed: {', '.join(self.allowed_extensions)}.")
+        if not isinstance(total_bytes, int) or total_bytes <= 0:
+            raise UploadError("The upload size must be a positive number of bytes.")
+        if total_bytes > self.max_upload_bytes:
+            raise UploadError(f"The project archive exceeds the {self.max_upload_bytes / (1024 * 1024):.0f} MB limit.", 413)
+        upload_id = uuid.uuid4().hex
+        job_dir = self.workspace.allocate(upload_id, int(total_bytes * self.reserve_factor)) # May raise WorkspaceFullError
+        path = os.path.join(job_dir, 'project' + extension)
+        with open(path, 'wb') as f:
+            f.truncate(total_bytes)
+        session = {
+            'upload_id': upload_id, 'filename': filename, 'path': path, 'job_dir': job_dir, 'total_bytes': total_bytes,
+            'chunk_bytes': self.chunk_bytes, 'chunk_count': -(-total_bytes // self.chunk_bytes), 'received': set(),
+            'complete': False, 'created_at': time.time(), 'updated_at': time.time(),
+        }
+        with self._lock:
+            self._sessions[upload_id] = session
+            self.started += 1
+        self._save_session(session)
+        print(f"Chunked upload {upload_id} started: {filename}, {total_bytes} bytes in {session['chunk_count']} chunks.")
+        return self._status(session)
+
+    def _session(self, upload_id):
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if session is None:
+            raise UploadError("Upload not found or expired.", 404)
+        return session
+
+    def _status(self, session):
+        with self._lock:
+            received = sorted(session['received'])
+        return dict({key: session[key] for key in ('upload_id', 'filename', 'total_bytes', 'chunk_bytes', 'chunk_count', 'complete')},
+                    received_chunks=received, received_bytes=sum(self._chunk_length(session, index) for index in received))
+
+    def status(self, upload_id):
+        return self._status(self._session(upload_id))
+
+    def _chunk_length(self, session, index):
+        return min(session['chunk_bytes'], session['total_bytes'] - index * session['chunk_bytes'])
+
+    def put_chunk(self, upload_id, index, offset, data, sha256):
+        """Verifies one chunk (position, length and SHA-256) and writes it at its offset. Re-sent chunks are accepted."""
+        session = self._session(upload_id)
+        if session['complete']:
+            raise UploadError("This upload is already complete.", 409)
+        if not 0 <= index < session['chunk_count']:
+            raise UploadError(f"Chunk index {index} is out of range (0-{session['chunk_count'] - 1}).")
+        if offset != index * session['chunk_bytes']:
+            raise UploadError(f"Chunk {index} must start at offset {index * session['chunk_bytes']}, not {offset}.")
+        if len(data) != self._chunk_length(session, index):
+            raise UploadError(f"Chunk {index} must be {self._chunk_length(session, index)} bytes, got {len(data)}.")
+        if not sha256 or hashlib.sha256(data).hexdigest() != sha256.lower():
+            with self._lock: self.chunk_checksum_failures += 1
+            raise UploadError(f"Chunk {index} failed its SHA-256 check; send it again.", 422)
+        try:
+            with open(session['path'], 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+        except FileNotFoundError:
+            raise UploadError("Upload not found or expired.", 404) # Aborted while this chunk was in transit
+        with self._lock:
+            session['received'].add(index)
+            session['updated_at'] = time.time()
+            self.chunks_received += 1
+        self._save_session(session)
+        return {'upload_id': upload_id, 'index': index, 'received_chunks': len(session['received']), 'chunk_count': session['chunk_count']}
+
+    def complete(self, upload_id):
+        """Checks that every chunk arrived and that the assembled file is a ZIP archive."""
+        session = self._session(upload_id)
+        with self._lock:
+            missing = [index for index in range(session['chunk_count']) if index not in session['received']]
+        if missing:
+            raise UploadError(f"{len(missing)} chunks are still missing (first: {missing[0]}).", 409)
+        if not session['complete']:
+            if not zipfile.is_zipfile(session['path']):
+                self.abort(upload_id)
+                raise UploadError("The uploaded file is not a valid ZIP archive.")
+            with self._lock:
+                session['complete'] = True
+                session['updated_at'] = time.time()
+                self.completed += 1
+            self._save_session(session)
+        return self._status(session)
+
+    def claim(self, upload_id):
+        """Hands a completed upload over to a job: the session ends, the workspace stays. Returns the session."""
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            claimed = session is not None and session['complete']
+            if claimed: self._sessions.pop(upload_id)
+        if claimed:
+            try: os.remove(os.path.join(session['job_dir'], SESSION_FILENAME)) # It is a job now, not a resumable upload
+            except FileNotFoundError: pass
+            return session
+        if session is None:
+            raise UploadError("Upload not found or expired.", 404)
+        raise UploadError("This upload is not complete yet.", 409)
+
+    def abort(self, upload_id):
+        """Ends a session and reclaims its workspace; returns False if there was no such session."""
+        with self._lock:
+            session = self._sessions.pop(upload_id, None)
+        if session is None: return False
+        self.workspace.release(session['job_dir'])
+        return True
+
+    def expire_idle(self):
+        """Aborts sessions (complete or not) idle for longer than the session TTL. Returns the count."""
+        cutoff = time.time() - self.session_ttl_seconds
+        with self._lock:
+            idle = [upload_id for upload_id, session in self._sessions.items() if session['updated_at'] < cutoff]
+        expired = sum(self.abort(upload_id) for upload_id in idle)
+        if expired:
+            with self._lock: self.expired += expired
+            print(f"Expired {expired} idle chunked uploads.")
+        return expired
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._sessions), "started": self.started, "completed": self.completed, "expired": self.expired, "resumed": self.resumed,
+                    "chunks_received": self.chunks_received, "chunk_checksum_failures": self.chunk_checksum_failures}
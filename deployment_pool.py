@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import types
+import threading
+
+# --- Multi-Deployment Pool ---
+# Spreads chat completions over several Azure OpenAI deployments (or any OpenAI-compatible endpoint,
+# e.g. a local server) so aggregate throughput is the sum of their quotas. Routing is weighted
+# least-outstanding-requests; a deployment that keeps returning 429/5xx is taken out of rotation
+# (circuit open) for a cooldown, then retried with a single trial request (half-open).
+#
+# Configure with AZURE_OPENAI_DEPLOYMENT_POOL: either inline JSON or a path to a JSON file holding a list of
+#   {"name": "eastus", "kind": "azure", "endpoint": "...", "api_key_env": "EASTUS_KEY", "api_version": "2024-06-01",
+#    "deployment": "gpt-4o", "weight": 2, "serves": ["gpt-4o"]}
+#   {"name": "local", "kind": "openai", "base_url": "http://localhost:8000/v1", "deployment": "llama3", "serves": ["fast"]}
+# "serves" lists the model names (as passed by the grading code) a member may answer; omit it to serve all.
+# A streamed response keeps its request outstanding until the stream is read to the end or closed.
+
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_COOLDOWN_SECONDS = 30
+LATENCY_EWMA_ALPHA = 0.2
+
+class NoHealthyDeploymentError(Exception):
+    """Raised when every deployment able to serve a request is circuit-broken or has just failed."""
+
+def _is_retriable_error(error):
+    """429, 5xx, timeouts and connection errors move on to the next deployment; other errors (e.g. 400) do not."""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None: return status_code == 429 or status_code >= 500
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError', 'ConnectError', 'ReadTimeout')
+
+def _retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try: return float(headers.get('retry-after'))
+    except (TypeError, ValueError): return None
+
+class PoolMember:
+    def __init__(self, name, client, deployment, weight=1.0, serves=None):
+        self.name, self.client, self.deployment = name, client, deployment
+        self.weight = max(float(weight), 0.01)
+        self.serves = set(serves or [])
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.half_open_trial_in_flight = False
+        self.requests = self.errors = self.throttled = 0
+        self.latency_ewma = None
+
+    def can_serve(self, model):
+        return not self.serves or model in self.serves
+
+    def is_available(self, now):
+        if self.consecutive_failures < CIRCUIT_FAILURE_THRESHOLD: return True
+        return now >= self.circuit_open_until and not self.half_open_trial_in_flight
+
+class _PooledStream:
+    """A member's streamed response; the member is released once, when it is read to the end, fails or is closed."""
+
+    def __init__(self, stream, release, started):
+        self._stream, self._release, self._started, self._released = stream, release, started, False
+        self._lock = threading.Lock()
+
+    def _finish(self, **outcome):
+        with self._lock:
+            if self._released: return
+            self._released = True
+        self._release(**outcome)
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        except Exception as e:
+            self._finish(error=e)
+            raise
+        self._finish(latency_seconds=time.perf_counter() - self._started)
+
+    def close(self):
+        self._finish() # Closed early (cancelled or a hedging loser): no latency sample, no failure
+        self._stream.close()
+
+class DeploymentPool:
+    """Drop-in stand-in for an OpenAI client: exposes chat.completions.create(...) and routes each call."""
+
+    def __init__(self, members):
+        if not members: raise ValueError("A deployment pool needs at least one member.")
+        self.members = members
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create_chat_completion))
+
+    def _acquire(self, model, excluded_names):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [m for m in self.members if m.can_serve(model) and m.name not in excluded_names and m.is_available(now)]
+            if not candidates: return None
+            # Ties (e.g. an idle pool) are broken by requests served per unit of weight, keeping the split proportional
+            member = min(candidates, key=lambda m: ((m.outstanding + 1) / m.weight, m.requests / m.weight))
+            member.outstanding += 1
+            member.requests += 1
+            if member.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                member.half_open_trial_in_flight = True
+            return member
+
+    def _release(self, member, latency_seconds=None, error=None):
+        with self._lock:
+            member.outstanding -= 1
+            member.half_open_trial_in_flight = False
+            if error is None:
+                member.consecutive_failures = 0
+                if latency_seconds is None: return
+                member.latency_ewma = latency_seconds if member.latency_ewma is None else (
+                    LATENCY_EWMA_ALPHA * latency_seconds + (1 - LATENCY_EWMA_ALPHA) * member.latency_ewma)
+                return
+            member.errors += 1
+            if getattr(error, 'status_code', None) == 429: member.throttled += 1
+            if _is_retriable_error(error):
+                member.consecutive_failures += 1
+                if member.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                    member.circuit_open_until = time.monotonic() + max(CIRCUIT_COOLDOWN_SECONDS, _retry_after_seconds(error) or 0)
+                    print(f"Deployment pool: circuit opened for '{member.name}' after {member.consecutive_failures} consecutive failures.")
+
+    def _create_chat_completion(self, model=None, **kwargs):
+        tried, last_error = set(), None
+        while True:
+            member = self._acquire(model, tried)
+            if member is None:
+                if last_error is not None: raise last_error
+                raise NoHealthyDeploymentError(f"No healthy deployment available for model '{model}'.")
+            tried.add(member.name)
+            started = time.perf_counter()
+            try:
+                response = member.client.chat.completions.create(model=member.deployment, **kwargs)
+            except Exception as e:
+                self._release(member, error=e)
+                if not _is_retriable_error(e): raise
+                print(f"Deployment pool: '{member.name}' failed ({e}); trying another deployment.")
+                last_error = e
+                continue
+            if kwargs.get('stream'):
+                return _PooledStream(response, lambda **outcome: self._release(member, **outcome), started)
+            self._release(member, latency_seconds=time.perf_counter() - started)
+            return response
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {m.name: {
+                "deployment": m.deployment, "weight": m.weight, "outstanding": m.outstanding,
+                "requests": m.requests, "errors": m.errors, "throttled": m.throttled,
+                "latency_ewma_seconds": round(m.latency_ewma, 3) if m.latency_ewma is not None else None,
+                "circuit": "closed" if m.consecutive_failures < CIRCUIT_FAILURE_THRESHOLD else ("half-open" if now >= m.circuit_open_until else "open"),
+            } for m in self.members}
+
+def _build_member_client(config):
+    api_key = config.get('api_key') or (os.getenv(config['api_key_env']) if config.get('api_key_env') else None)
+    if config.get('kind', 'azure') == 'openai':
+        from openai import OpenAI
+        return OpenAI(base_url=config.get('base_url'), api_key=api_key or 'not-needed')
+    from openai import AzureOpenAI
+    return AzureOpenAI(azure_endpoint=config['endpoint'], api_key=api_key,
+                       api_version=config.get('api_version') or os.getenv("AZURE_OPENAI_API_VERSION"))
+
+def load_deployment_pool(pool_config):
+    """Builds a DeploymentPool from inline JSON or a JSON file path; returns None if nothing usable is configured."""
+    try:
+        if os.path.isfile(pool_config):
+            with open(pool_config, 'r', encoding='utf-8') as f: member_configs = json.load(f)
+        else:
+            member_configs = json.loads(pool_config)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error reading deployment pool configuration: {e}")
+        return None
+    members = []
+    for index, config in enumerate(member_configs):
+        name = config.get('name') or f"deployment-{index}"
+        try:
+            members.append(PoolMember(name, _build_member_client(config), config['deployment'], config.get('weight', 1), config.get('serves')))
+        except Exception as e:
+            print(f"Skipping deployment pool member '{name}': {e}")
+    if not members: return None
+    print(f"Deployment pool initialized with {len(members)} deployments: {', '.join(m.name for m in members)}.")
+    return DeploymentPool(members)
@@ -0,0 +1,533 @@
+"""
+Headless batch grader for whole cohorts.
+
+Grades every project ZIP in a directory against one rubric and requirements document,
+reusing the same utils pipeline as the web app, and writes one Excel report per submission.
+A checkpoint manifest is rewritten after each submission, so rerunning the same command after a
+crash or quota exhaustion skips the submissions that already finished.
+
+With --deferred, submissions are only prepared locally; the grading calls go out as one JSONL file
+through the Batch API (cheaper, separate quota, no competition with interactive traffic) and the
+reports are written once the batch completes. Outstanding batch ids are kept in the manifest, so a
+rerun resumes polling instead of resubmitting. --batch-backend local uses an offline stand-in.
+
+Usage:
+    python grade_cli.py SUBMISSIONS_DIR --rubric rubric.xlsx --requirements spec.docx --output-dir reports/
+    python grade_cli.py SUBMISSIONS_DIR --rubric rubric.xlsx --requirements spec.docx --output-dir reports/ --deferred
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import argparse
+import tempfile
+import concurrent.futures
+from dotenv import load_dotenv
+
+from grade_store import GradeWarehouse
+import batch_grading
+from requirements_digest import RequirementsDigestCache, load_requirements_text
+from project_summaries import SummaryCache, summarize_overflow
+from similarity import SimilarityIndex, file_signatures, baseline_shingles_for, FILE_MATCH_THRESHOLD
+from utils import (
+    process_rubric_excel, create_azure_chat_client, file_sha256,
+    unzip_file,
+    collect_project_content,
+    prepare_grading_request, grade_prepared_request,
+    build_grading_messages, grading_prompt_for, follow_up_grading_request, merge_grading_response, missing_ai_criteria, finalize_grading,
+    generate_styled_excel_report,
+    FOLLOW_UP_BASE_TOKENS, FOLLOW_UP_TOKENS_PER_CRITERION,
+)
+
+MANIFEST_FILENAME = "grading_manifest.json"
+DEFERRED_STATE_DIRNAME = "_deferred"
+BATCH_POLL_MAX_ERRORS = 5
+SIMILARITY_INDEX_FILENAME = "similarity_index.json"
+SIMILARITY_REPORT_FILENAME = "similarity_report.json"
+SIMILARITY_SAVE_INTERVAL_SECONDS = 30
+
+# Per-worker state: the rubric, requirements and chat client are loaded once per worker
+# (once in total for the thread pool, once per process for the process pool).
+_WORKER_STATE = {}
+
+def _submission_fingerprint(zip_path):
+    """Cheap identity for a submission ZIP; a changed size or mtime means it must be regraded."""
+    stat = os.stat(zip_path)
+    return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+def load_manifest(manifest_path, rubric_sha256, requirements_sha256):
+    """Loads the checkpoint manifest, discarding it when it was written for a different rubric/requirements."""
+    fresh_manifest = {"rubric_sha256": rubric_sha256, "requirements_sha256": requirements_sha256, "submissions": {}}
+    if not os.path.exists(manifest_path): return fresh_manifest
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f: manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Warning: could not read checkpoint manifest {manifest_path} ({e}); starting fresh.")
+        return fresh_manifest
+    if manifest.get("rubric_sha256") != rubric_sha256 or manifest.get("requirements_sha256") != requirements_sha256:
+        print("Rubric or requirements changed since the last run; all submissions will be regraded.")
+        return fresh_manifest
+    return manifest
+
+def save_manifest(manifest_path, manifest):
+    """Writes the manifest atomically so a crash mid-write never corrupts the checkpoint."""
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def _starter_code_shingles(starter_code_path):
+    """Shingles of the starter code (a ZIP or directory) so code everyone was given never counts as copied."""
+    if not starter_code_path: return frozenset()
+    work_dir = tempfile.mkdtemp(prefix="starter_code_")
+    try:
+        if os.path.isdir(starter_code_path): # Copied, because collection extracts nested archives in place
+            shutil.copytree(starter_code_path, os.path.join(work_dir, "starter"))
+        elif not unzip_file(starter_code_path, work_dir):
+            print(f"Warning: could not read starter code {starter_code_path}; similarity will include it.")
+            return frozenset()
+        project_text_files_content, _, _, _ = collect_project_content(work_dir)
+        return baseline_shingles_for(project_text_files_content)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _init_worker(rubric_path, requirements_path, cohort=None, starter_code_path=None):
+    load_dotenv()
+    rubric_data_markdown_for_ai, original_rubric_dataframe = process_rubric_excel(rubric_path)
+    _WORKER_STATE.update({
+        "rubric_markdown": rubric_data_markdown_for_ai,
+        "rubric_dataframe": original_rubric_dataframe,
+        "requirements_text": load_requirements_text(requirements_path, RequirementsDigestCache()),
+        "chat_client": create_azure_chat_client(),
+        "rubric_sha256": file_sha256(rubric_path),
+        "requirements_sha256": file_sha256(requirements_path),
+        "cohort": cohort,
+        "warehouse": GradeWarehouse(),
+        "similarity_baseline": _starter_code_shingles(starter_code_path),
+        "summary_cache": SummaryCache(), # Starter code summarized for one submission is reused for the rest
+    })
+
+def _prepare_request(zip_path, work_dir, summarize=True):
+    """
+    Extracts one submission and assembles its grading request. Returns (error_message, grading_request,
+    similarity_signatures); the MinHash signatures of its files are computed here, where the content is at hand.
+    Code beyond the prompt budget is summarized unless summarize is False.
+    """
+    if not unzip_file(zip_path, work_dir):
+        return "Failed to unzip project archive.", None, None
+    project_text_files_content, image_messages_for_ai, video_files_detected, collection_report = collect_project_content(work_dir)
+    similarity_signatures = file_signatures(project_text_files_content, _WORKER_STATE["similarity_baseline"])
+    summaries = summarize_overflow(_WORKER_STATE["chat_client"], work_dir, collection_report, _WORKER_STATE["summary_cache"]) if summarize else {}
+    error_message, grading_request = prepare_grading_request(
+        _WORKER_STATE["rubric_dataframe"], _WORKER_STATE["rubric_markdown"],
+        _WORKER_STATE["requirements_text"], project_text_files_content, image_messages_for_ai, bool(video_files_detected),
+        duplicate_aliases=collection_report['duplicate_aliases'],
+        project_file_paths=collection_report['file_paths'], project_base_dir=work_dir,
+        project_summaries_text=summaries.get('text', ""), summary_usage={key: summaries.get(key, 0) for key in ('calls', 'prompt_tokens', 'completion_tokens')}
+    )
+    return error_message, grading_request, similarity_signatures
+
+def _write_graded_submission(submission_name, grading_request, grading_breakdown_list, overall_parsed_result, output_dir, grading_seconds):
+    """Stores the grades in the warehouse and writes the Excel report. Returns the manifest entry."""
+    try:
+        _WORKER_STATE["warehouse"].record_result(
+            f"{_WORKER_STATE['cohort']}/{submission_name}", _WORKER_STATE["rubric_sha256"], grading_request["all_criteria"],
+            grading_breakdown_list, overall_parsed_result, requirements_sha256=_WORKER_STATE["requirements_sha256"],
+            cohort=_WORKER_STATE["cohort"], submission_name=submission_name, grading_seconds=grading_seconds)
+    except Exception as e:
+        print(f"Warning: could not store grades for {submission_name} in the grade warehouse: {e}")
+    excel_bytes, _ = generate_styled_excel_report(_WORKER_STATE["rubric_dataframe"], grading_breakdown_list, overall_parsed_result)
+    report_path = os.path.join(output_dir, f"{submission_name}_Grading_Report.xlsx")
+    with open(report_path, 'wb') as f:
+        f.write(excel_bytes)
+    return {
+        "status": "done", "report": report_path,
+        "total_score": overall_parsed_result.get("total_score"),
+        "grading_stats": overall_parsed_result.get("grading_stats", {}),
+        "seconds": grading_seconds,
+    }
+
+def grade_submission(zip_path, output_dir, work_root):
+    """Grades one project ZIP and writes its Excel report. Returns a manifest entry dict."""
+    started = time.perf_counter()
+    submission_name = os.path.splitext(os.path.basename(zip_path))[0]
+    work_dir = tempfile.mkdtemp(prefix=f"{submission_name[:40]}_", dir=work_root)
+    try:
+        error_message, grading_request, similarity_signatures = _prepare_request(zip_path, work_dir)
+        if not error_message:
+            error_message, grading_breakdown_list, overall_parsed_result = grade_prepared_request(_WORKER_STATE["chat_client"], grading_request)
+        if error_message:
+            return {"status": "failed", "error": error_message, "similarity_signatures": similarity_signatures}
+        return dict(_write_graded_submission(submission_name, grading_request, grading_breakdown_list, overall_parsed_result,
+                                             output_dir, round(time.perf_counter() - started, 2)), similarity_signatures=similarity_signatures)
+    except Exception as e:
+        print(f"Unexpected error grading {zip_path}: {e}")
+        return {"status": "failed", "error": str(e)}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def prepare_deferred_submission(zip_path, state_dir, work_root):
+    """Deferred mode, first half: prepares one submission and pickles its grading request into state_dir."""
+    submission_name = os.path.splitext(os.path.basename(zip_path))[0]
+    work_dir = tempfile.mkdtemp(prefix=f"{submission_name[:40]}_", dir=work_root)
+    try:
+        # No summaries: deferred mode exists to avoid synchronous AI calls while preparing
+        error_message, grading_request, similarity_signatures = _prepare_request(zip_path, work_dir, summarize=False)
+        if error_message:
+            return {"status": "failed", "error": error_message, "similarity_signatures": similarity_signatures}
+        _save_deferred_state(state_dir, os.path.basename(zip_path), {
+            "grading_request": grading_request, "grades_by_id": {}, "overall_feedback": None,
+            "grading_stats": {"tiers": {}, "escalated_criteria": [], "local_check_criteria": list(grading_request["local_grades"]), "deferred": True},
+            "started_at": time.time(),
+        })
+        return {"status": "prepared", "similarity_signatures": similarity_signatures}
+    except Exception as e:
+        print(f"Unexpected error preparing {zip_path}: {e}")
+        return {"status": "failed", "error": str(e)}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+def _pending_submissions(submissions_dir, manifest, retry_failed, finished_statuses=("done",)):
+    """Returns (all ZIP paths, ZIP paths still to grade) given the checkpoint manifest."""
+    zip_paths = sorted(os.path.join(submissions_dir, name) for name in os.listdir(submissions_dir) if name.lower().endswith('.zip'))
+    pending = []
+    for zip_path in zip_paths:
+        entry = manifest["submissions"].get(os.path.basename(zip_path), {})
+        unchanged = entry.get("fingerprint") == _submission_fingerprint(zip_path)
+        if unchanged and (entry.get("status") in finished_statuses or (entry.get("status") == "failed" and not retry_failed)):
+            continue
+        pending.append(zip_path)
+    print(f"{len(zip_paths)} submissions found, {len(zip_paths) - len(pending)} already completed, {len(pending)} to grade.")
+    return zip_paths, pending
+
+def _make_executor(rubric_path, requirements_path, cohort, workers, use_processes, starter_code_path=None):
+    """Returns the worker pool, or None when the rubric or requirements cannot be read."""
+    if use_processes:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rubric_path, requirements_path, cohort, starter_code_path))
+    _init_worker(rubric_path, requirements_path, cohort, starter_code_path)
+    if _WORKER_STATE["rubric_dataframe"] is None or _WORKER_STATE["requirements_text"] is None:
+        print("Failed to read the rubric or requirements file; aborting.")
+        return None
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+class _CohortSimilarity:
+    """The output directory's incremental similarity index: fed as submissions finish, saved periodically, reported at the end."""
+
+    def __init__(self, output_dir, threshold):
+        self.index_path = os.path.join(output_dir, SIMILARITY_INDEX_FILENAME)
+        self.report_path = os.path.join(output_dir, SIMILARITY_REPORT_FILENAME)
+        self.threshold = threshold
+        self.index = SimilarityIndex.load(self.index_path)
+        self.last_saved = time.monotonic()
+
+    def add(self, zip_name, signatures):
+        for match in self.index.add_signatures(zip_name, signatures, self.threshold):
+            print(f"Similarity: {zip_name} resembles {match['submission_b']} ({match['similarity']:.0%} overall, {len(match['matched_files'])} matching files).")
+        if time.monotonic() - self.last_saved > SIMILARITY_SAVE_INTERVAL_SECONDS:
+            self.index.save(self.index_path)
+            self.last_saved = time.monotonic()
+
+    def finish(self):
+        self.index.save(self.index_path)
+        pairs = self.index.report(self.threshold)
+        with open(self.report_path, 'w', encoding='utf-8') as f:
+            json.dump({"threshold": self.threshold, "submissions_indexed": len(self.index.submissions), "pairs": pairs}, f, indent=2)
+        print(f"Similarity: {len(pairs)} flagged pairs among {len(self.index.submissions)} submissions. Report: {self.report_path}")
+
+def _finish_entry(manifest, manifest_path, zip_name, entry, fingerprint, similarity=None):
+    similarity_signatures = entry.pop("similarity_signatures", None)
+    if similarity is not None and similarity_signatures is not None:
+        similarity.add(zip_name, similarity_signatures)
+    entry["fingerprint"] = fingerprint
+    entry["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    manifest["submissions"][zip_name] = entry
+    save_manifest(manifest_path, manifest)
+
+def _print_summary(manifest, manifest_path, batch_started):
+    failed = [name for name, entry in manifest["submissions"].items() if entry.get("status") != "done"]
+    print(f"Batch finished in {_format_duration(time.perf_counter() - batch_started)}. "
+          f"{len(manifest['submissions']) - len(failed)} done, {len(failed)} failed. Manifest: {manifest_path}")
+
+def run_batch(submissions_dir, rubric_path, requirements_path, output_dir, workers=4, use_processes=False, retry_failed=True, cohort=None,
+              starter_code_path=None, similarity_threshold=FILE_MATCH_THRESHOLD):
+    os.makedirs(output_dir, exist_ok=True)
+    cohort = cohort or os.path.basename(os.path.normpath(submissions_dir))
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path, file_sha256(rubric_path), file_sha256(requirements_path))
+
+    zip_paths, pending = _pending_submissions(submissions_dir, manifest, retry_failed)
+    if not pending: return manifest
+    work_root = os.path.join(output_dir, "_work")
+    os.makedirs(work_root, exist_ok=True)
+    executor = _make_executor(rubric_path, requirements_path, cohort, workers, use_processes, starter_code_path)
+    if executor is None: return manifest
+    similarity = _CohortSimilarity(output_dir, similarity_threshold)
+
+    batch_started, completed = time.perf_counter(), 0
+    with executor:
+        futures = {executor.submit(grade_submission, zip_path, output_dir, work_root): zip_path for zip_path in pending}
+        for future in concurrent.futures.as_completed(futures):
+            zip_path = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e: # e.g. a worker process died
+                entry = {"status": "failed", "error": str(e)}
+            _finish_entry(manifest, manifest_path, os.path.basename(zip_path), entry, _submission_fingerprint(zip_path), similarity)
+
+            completed += 1
+            elapsed = time.perf_counter() - batch_started
+            per_minute = completed / elapsed * 60 if elapsed else 0.0
+            eta = (len(pending) - completed) * elapsed / completed
+            detail = f"score {entry.get('total_score')}" if entry["status"] == "done" else entry.get("error")
+            print(f"[{completed}/{len(pending)}] {os.path.basename(zip_path)}: {entry['status']} ({detail}) | "
+                  f"{per_minute:.2f} submissions/min | elapsed {_format_duration(elapsed)} | ETA {_format_duration(eta)}")
+
+    shutil.rmtree(work_root, ignore_errors=True)
+    similarity.finish()
+    _print_summary(manifest, manifest_path, batch_started)
+    return manifest
+
+# --- Deferred (Batch API) mode ---
+
+def _deferred_state_path(state_dir, zip_name):
+    return os.path.join(state_dir, f"{zip_name}.pkl")
+
+def _save_deferred_state(state_dir, zip_name, state):
+    os.makedirs(state_dir, exist_ok=True)
+    path = _deferred_state_path(state_dir, zip_name)
+    with open(path + ".tmp", 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+def _load_deferred_state(state_dir, zip_name):
+    try:
+        with open(_deferred_state_path(state_dir, zip_name), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+MISSING_DEFERRED_STATE_ERROR = "Deferred grading state is missing; rerun to regrade."
+
+def _discard_deferred_state(state_dir, zip_name):
+    try: os.remove(_deferred_state_path(state_dir, zip_name))
+    except FileNotFoundError: pass
+
+def _submit_deferred(batch_client, manifest, manifest_path, state_dir, criteria_by_zip_name, round_number):
+    """Writes one grading request per submission (round 1 = follow-ups for criteria still missing) and submits the batch(es)."""
+    deployment_name = batch_grading.batch_deployment_name()
+    requests = []
+    for zip_name, criteria_to_grade in criteria_by_zip_name.items():
+        state = _load_deferred_state(state_dir, zip_name)
+        if state is None:
+            manifest["submissions"][zip_name].update(status="failed", error=MISSING_DEFERRED_STATE_ERROR)
+            save_manifest(manifest_path, manifest)
+            continue
+        grading_request = state["grading_request"]
+        max_tokens = 4000 if round_number == 0 else min(4000, FOLLOW_UP_BASE_TOKENS + FOLLOW_UP_TOKENS_PER_CRITERION * len(criteria_to_grade))
+        if round_number: grading_request = follow_up_grading_request(grading_request, criteria_to_grade)
+        messages = build_grading_messages(grading_prompt_for(grading_request, criteria_to_grade), grading_request["image_messages"])
+        requests.append((zip_name, batch_grading.batch_request_line(zip_name, deployment_name, messages, max_tokens)))
+    for chunk in batch_grading.split_batch_requests(requests):
+        zip_names = [zip_name for zip_name, _ in chunk]
+        try:
+            batch_id = batch_grading.submit_batch(batch_client, [line for _, line in chunk])
+        except Exception as e:
+            print(f"Could not submit a batch of {len(chunk)} grading requests: {e}")
+            for zip_name in zip_names:
+                manifest["submissions"][zip_name].update(status="failed", error=f"Batch submission failed: {e}")
+            save_manifest(manifest_path, manifest)
+            continue
+        manifest["batches"][batch_id] = {"round": round_number, "custom_ids": zip_names, "submitted_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "poll_errors": 0}
+        for zip_name in zip_names:
+            manifest["submissions"][zip_name].update(status="submitted", batch_id=batch_id, round=round_number)
+        save_manifest(manifest_path, manifest)
+
+def _apply_batch_result(zip_name, result, round_number, state_dir, output_dir):
+    """Merges one batch response. Returns (manifest entry, None) when finished or (None, criteria) needing a follow-up."""
+    content, usage, error = result
+    state = _load_deferred_state(state_dir, zip_name)
+    if state is None:
+        return {"status": "failed", "error": MISSING_DEFERRED_STATE_ERROR}, None
+    if error:
+        _discard_deferred_state(state_dir, zip_name)
+        return {"status": "failed", "error": f"Batch request failed: {error}"}, None
+    grading_request = state["grading_request"]
+    parsed_result = merge_grading_response(content, grading_request, state["grades_by_id"], require_valid=(round_number == 0))
+    state["grading_stats"]["tiers"]["batch" if round_number == 0 else "batch_follow_up"] = {
+        "deployment": batch_grading.batch_deployment_name(), "latency_seconds": None,
+        "prompt_tokens": usage.get("prompt_tokens"), "completion_tokens": usage.get("completion_tokens"),
+    }
+    if state["overall_feedback"] is None: state["overall_feedback"] = parsed_result.get("overall_feedback")
+    missing_criteria = missing_ai_criteria(grading_request, state["grades_by_id"])
+    if missing_criteria and round_number == 0:
+        state["grading_stats"]["follow_up_criteria"] = [criterion['criterion_id'] for criterion in missing_criteria]
+        _save_deferred_state(state_dir, zip_name, state)
+        return None, missing_criteria
+    return _finish_deferred(zip_name, state, state_dir, output_dir), None
+
+def _finish_deferred(zip_name, state, state_dir, output_dir):
+    _, grading_breakdown_list, overall_parsed_result = finalize_grading(state["grading_request"], state["grades_by_id"], state["overall_feedback"], state["grading_stats"])
+    entry = _write_graded_submission(os.path.splitext(zip_name)[0], state["grading_request"], grading_breakdown_list, overall_parsed_result,
+                                     output_dir, round(time.time() - state["started_at"], 2))
+    _discard_deferred_state(state_dir, zip_name)
+    return entry
+
+def _collect_deferred(batch_client, manifest, manifest_path, state_dir, output_dir, poll_interval):
+    """Polls outstanding batches until all are terminal, fanning their results out into reports."""
+    while manifest["batches"]:
+        follow_ups = {}
+        for batch_id, batch_info in list(manifest["batches"].items()):
+            try:
+                status, batch = batch_grading.poll_batch(batch_client, batch_id)
+            except Exception as e:
+                batch_info["poll_errors"] = batch_info.get("poll_errors", 0) + 1
+                print(f"Could not poll batch {batch_id} (attempt {batch_info['poll_errors']}/{BATCH_POLL_MAX_ERRORS}): {e}")
+                if batch_info["poll_errors"] < BATCH_POLL_MAX_ERRORS: continue
+                status, batch = "lost", None
+            else:
+                batch_info["poll_errors"] = 0
+                print(f"Batch {batch_id}: {batch_grading.describe_batch(batch)}")
+                if status not in batch_grading.BATCH_TERMINAL_STATUSES: continue
+            # Expired or cancelled batches still return the requests they finished
+            results = batch_grading.read_batch_results(batch_client, batch) if batch is not None else {}
+            for zip_name in batch_info["custom_ids"]:
+                entry = manifest["submissions"].get(zip_name, {})
+                if entry.get("batch_id") != batch_id: continue # Regraded since this batch was submitted
+                result = results.get(zip_name, (None, None, f"no result returned (batch {status})"))
+                new_entry, missing_criteria = _apply_batch_result(zip_name, result, batch_info["round"], state_dir, output_dir)
+                if missing_criteria: # Recorded before the batch is dropped, so a run that dies first resubmits it on resume
+                    follow_ups[zip_name] = missing_criteria
+                    entry.update(status="follow_up_pending", batch_id=None)
+                else:
+                    print(f"{zip_name}: {new_entry['status']} ({new_entry.get('total_score') if new_entry['status'] == 'done' else new_entry.get('error')})")
+                    _finish_entry(manifest, manifest_path, zip_name, new_entry, entry.get("fingerprint"))
+            del manifest["batches"][batch_id]
+            save_manifest(manifest_path, manifest)
+        if follow_ups:
+            print(f"{len(follow_ups)} submissions lack valid grades for some criteria; submitting a follow-up batch for those criteria only.")
+            _submit_deferred(batch_client, manifest, manifest_path, state_dir, follow_ups, round_number=1)
+        if manifest["batches"]: time.sleep(poll_interval)
+
+def _pending_follow_ups(manifest, manifest_path, state_dir, output_dir):
+    """Criteria still missing for submissions whose follow-up batch was never submitted (the previous run stopped first)."""
+    follow_ups = {}
+    for zip_name, entry in list(manifest["submissions"].items()):
+        if entry.get("status") != "follow_up_pending": continue
+        state = _load_deferred_state(state_dir, zip_name)
+        missing_criteria = missing_ai_criteria(state["grading_request"], state["grades_by_id"]) if state is not None else None
+        if missing_criteria:
+            follow_ups[zip_name] = missing_criteria
+            continue
+        new_entry = _finish_deferred(zip_name, state, state_dir, output_dir) if state is not None else {"status": "failed", "error": MISSING_DEFERRED_STATE_ERROR}
+        _finish_entry(manifest, manifest_path, zip_name, new_entry, entry.get("fingerprint"))
+    return follow_ups
+
+def run_deferred_batch(submissions_dir, rubric_path, requirements_path, output_dir, batch_client, workers=4, use_processes=False,
+                       retry_failed=True, cohort=None, poll_interval=60, starter_code_path=None, similarity_threshold=FILE_MATCH_THRESHOLD):
+    """Prepares submissions locally, grades them through the Batch API and writes the reports when the batch completes."""
+    os.makedirs(output_dir, exist_ok=True)
+    cohort = cohort or os.path.basename(os.path.normpath(submissions_dir))
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path, file_sha256(rubric_path), file_sha256(requirements_path))
+    manifest.setdefault("batches", {})
+    state_dir = os.path.join(output_dir, DEFERRED_STATE_DIRNAME)
+    batch_started = time.perf_counter()
+    # Reports are written in this process, so it needs the rubric even when a process pool does the preparation
+    _init_worker(rubric_path, requirements_path, cohort, starter_code_path)
+    if _WORKER_STATE["rubric_dataframe"] is None or _WORKER_STATE["requirements_text"] is None:
+        print("Failed to read the rubric or requirements file; aborting.")
+        return manifest
+    similarity = _CohortSimilarity(output_dir, similarity_threshold)
+
+    zip_paths, pending = _pending_submissions(submissions_dir, manifest, retry_failed, finished_statuses=("done", "submitted", "follow_up_pending"))
+    if manifest["batches"]:
+        print(f"Resuming {len(manifest['batches'])} outstanding batches from the previous run.")
+    if pending:
+        work_root = os.path.join(output_dir, "_work")
+        os.makedirs(work_root, exist_ok=True)
+        executor = (concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rubric_path, requirements_path, cohort, starter_code_path))
+                    if use_processes else concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+        ready = {}
+        with executor:
+            futures = {executor.submit(prepare_deferred_submission, zip_path, state_dir, work_root): zip_path for zip_path in pending}
+            for future in concurrent.futures.as_completed(futures):
+                zip_path, zip_name = futures[future], os.path.basename(futures[future])
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    entry = {"status": "failed", "error": str(e)}
+                if entry["status"] == "prepared":
+                    state = _load_deferred_state(state_dir, zip_name)
+                    if state is None:
+                        entry = {"status": "failed", "error": MISSING_DEFERRED_STATE_ERROR}
+                    elif state["grading_request"]["criteria_for_ai"]:
+                        ready[zip_name] = state["grading_request"]["criteria_for_ai"]
+                    else: # Every criterion was settled by a local check
+                        state["overall_feedback"] = "All criteria were verified by local checks; no AI grading was needed."
+                        entry = _finish_deferred(zip_name, state, state_dir, output_dir)
+                _finish_entry(manifest, manifest_path, zip_name, entry, _submission_fingerprint(zip_path), similarity)
+        shutil.rmtree(work_root, ignore_errors=True)
+        print(f"Prepared {len(ready)} submissions for batch grading.")
+        if ready: _submit_deferred(batch_client, manifest, manifest_path, state_dir, ready, round_number=0)
+    follow_ups = _pending_follow_ups(manifest, manifest_path, state_dir, output_dir)
+    if follow_ups:
+        print(f"Resubmitting the follow-up batch for {len(follow_ups)} submissions from the previous run.")
+        _submit_deferred(batch_client, manifest, manifest_path, state_dir, follow_ups, round_number=1)
+    similarity.finish() # Copying is flagged as soon as everything is prepared, not after the batch returns
+    _collect_deferred(batch_client, manifest, manifest_path, state_dir, output_dir, poll_interval)
+    _print_summary(manifest, manifest_path, batch_started)
+    return manifest
+
+def create_batch_client(backend, output_dir):
+    """The Azure OpenAI client (its files/batches API) or the offline stand-in."""
+    if backend == "local":
+        return batch_grading.LocalBatchClient(os.path.join(output_dir, "_local_batches"))
+    client = create_azure_chat_client()
+    if client is None or not hasattr(client, "batches"):
+        return None
+    return client
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grade a directory of project ZIPs without the web UI.")
+    parser.add_argument("submissions_dir", help="Directory containing one ZIP per submission.")
+    parser.add_argument("--rubric", required=True, help="Evaluation rubric (.xlsx, .xls or .csv).")
+    parser.add_argument("--requirements", required=True, help="Requirements document (.docx, .pdf or .pptx).")
+    parser.add_argument("--output-dir", required=True, help="Where reports and the checkpoint manifest are written.")
+    parser.add_argument("--workers", type=int, default=4, help="Submissions graded concurrently (default: 4).")
+    parser.add_argument("--processes", action="store_true", help="Use a process pool instead of threads (CPU-heavy extraction).")
+    parser.add_argument("--cohort", help="Cohort label stored with the grades in the warehouse (default: submissions directory name).")
+    parser.add_argument("--starter-code", help="Starter code ZIP or directory handed out to everyone; ignored by the similarity check.")
+    parser.add_argument("--similarity-threshold", type=float, default=FILE_MATCH_THRESHOLD,
+                        help=f"Overall similarity at which two submissions are flagged (default: {FILE_MATCH_THRESHOLD}).")
+    parser.add_argument("--skip-failed", action="store_true", help="Do not retry submissions that failed in a previous run.")
+    parser.add_argument("--deferred", action="store_true", help="Grade through the Batch API (cheaper, up to 24h) instead of synchronous calls.")
+    parser.add_argument("--batch-backend", choices=("azure", "local"), default="azure", help="Batch API to use with --deferred; 'local' is an offline stand-in with canned grades.")
+    parser.add_argument("--poll-interval", type=float, default=60, help="Seconds between batch status checks (default: 60).")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    if not os.path.isdir(args.submissions_dir):
+        parser.error(f"Submissions directory not found: {args.submissions_dir}")
+    if args.deferred:
+        batch_client = create_batch_client(args.batch_backend, args.output_dir)
+        if batch_client is None:
+            parser.error("Deferred grading needs the Azure OpenAI settings of a single deployment (AZURE_OPENAI_ENDPOINT etc.); a deployment pool has no batch API.")
+        manifest = run_deferred_batch(args.submissions_dir, args.rubric, args.requirements, args.output_dir, batch_client,
+                                      workers=max(1, args.workers), use_processes=args.processes, retry_failed=not args.skip_failed,
+                                      cohort=args.cohort, poll_interval=max(0.1, args.poll_interval),
+                                      starter_code_path=args.starter_code, similarity_threshold=args.similarity_threshold)
+    else:
+        manifest = run_batch(args.submissions_dir, args.rubric, args.requirements, args.output_dir,
+                             workers=max(1, args.workers), use_processes=args.processes, retry_failed=not args.skip_failed, cohort=args.cohort,
+                             starter_code_path=args.starter_code, similarity_threshold=args.similarity_threshold)
+    return 0 if all(entry.get("status") == "done" for entry in manifest["submissions"].values()) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+import os
+import math
+import time
+import sqlite3
+import threading
+
+# --- Grade Warehouse ---
+# Every finished grading (web app and CLI) is appended to a local SQLite database so cohort statistics
+# are one indexed query away instead of dozens of Excel workbooks. One row per submission plus one row
+# per graded criterion; the rubric hash is denormalised onto the criterion rows so per-criterion
+# aggregates for one rubric never need a join. Location: GRADE_WAREHOUSE_PATH (default grades.sqlite3).
+
+DEFAULT_WAREHOUSE_PATH = "grades.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    submission_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    cohort TEXT,
+    user_id TEXT,
+    submission_name TEXT,
+    rubric_sha256 TEXT NOT NULL,
+    requirements_sha256 TEXT,
+    total_score REAL,
+    max_total_score REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    llm_latency_seconds REAL,
+    grading_seconds REAL,
+    overall_feedback TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_submissions_rubric ON submissions (rubric_sha256, cohort, total_score);
+CREATE INDEX IF NOT EXISTS idx_submissions_created ON submissions (created_at);
+CREATE TABLE IF NOT EXISTS criterion_grades (
+    submission_id TEXT NOT NULL REFERENCES submissions (submission_id) ON DELETE CASCADE,
+    rubric_sha256 TEXT NOT NULL,
+    cohort TEXT,
+    criterion_id INTEGER NOT NULL,
+    criterion_name TEXT,
+    score REAL,
+    max_score REAL,
+    graded_by TEXT,
+    comments TEXT,
+    PRIMARY KEY (submission_id, criterion_id)
+);
+CREATE INDEX IF NOT EXISTS idx_criterion_grades_rubric ON criterion_grades (rubric_sha256, criterion_id, score);
+-- Running per-criterion aggregates, maintained on every write, so criterion averages cost O(criteria)
+CREATE TABLE IF NOT EXISTS criterion_rollups (
+    rubric_sha256 TEXT NOT NULL,
+    cohort TEXT NOT NULL,
+    criterion_id INTEGER NOT NULL,
+    criterion_name TEXT,
+    max_score REAL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    total_of_squares REAL NOT NULL,
+    full_marks INTEGER NOT NULL,
+    local_checks INTEGER NOT NULL,
+    PRIMARY KEY (rubric_sha256, cohort, criterion_id)
+);
+"""
+
+ROLLUP_UPSERT = """
+INSERT INTO criterion_rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (rubric_sha256, cohort, criterion_id) DO UPDATE SET
+    criterion_name = COALESCE(excluded.criterion_name, criterion_name), max_score = COALESCE(excluded.max_score, max_score),
+    count = count + excluded.count, total = total + excluded.total, total_of_squares = total_of_squares + excluded.total_of_squares,
+    full_marks = full_marks + excluded.full_marks, local_checks = local_checks + excluded.local_checks
+"""
+
+def _to_float(value):
+    try:
+        number = float(value)
+        return number if math.isfinite(number) else None
+    except (TypeError, ValueError):
+        return None
+
+def _rollup_delta(rubric_sha256, cohort, criterion_id, criterion_name, score, max_score, graded_by, sign):
+    """One criterion grade as a row of increments (sign=-1 removes a previously stored grade)."""
+    scored = score is not None
+    return (rubric_sha256, cohort or '', criterion_id, criterion_name, max_score, sign * int(scored),
+            sign * (score or 0.0), sign * (score or 0.0) ** 2,
+            sign * int(scored and max_score is not None and score >= max_score), sign * int(graded_by == 'local_check'))
+
+def _mean_and_stddev(count, total, total_of_squares):
+    if not count: return None, None
+    mean = total / count
+    return mean, math.sqrt(max(total_of_squares / count - mean * mean, 0.0))
+
+class GradeWarehouse:
+    """Thread-safe wrapper around one SQLite connection (WAL mode, so readers never block the writer)."""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("GRADE_WAREHOUSE_PATH", DEFAULT_WAREHOUSE_PATH)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA foreign_keys=ON")
+            self._connection.executescript(SCHEMA)
+
+    def record_result(self, submission_id, rubric_sha256, criteria, grading_breakdown, overall_result,
+                      requirements_sha256=None, cohort=None, user_id=None, submission_name=None, grading_seconds=None):
+        """Stores one graded submission; criteria is the rubric criteria list (for max scores and names)."""
+        max_scores = {criterion['criterion_id']: _to_float(criterion.get('max_score')) for criterion in criteria}
+        tiers = overall_result.get('grading_stats', {}).get('tiers', {}).values()
+        rows = [(
+            submission_id, rubric_sha256, cohort, int(grade['criterion_id']), grade.get('criterion_name'),
+            _to_float(grade.get('score_achieved')), max_scores.get(grade['criterion_id']),
+            grade.get('graded_by', 'ai'), grade.get('comments'),
+        ) for grade in grading_breakdown if grade.get('criterion_id') is not None]
+        with self._lock, self._connection:
+            # Regrading a submission replaces its rows, so back its previous grades out of the rollups first
+            previous_rows = self._connection.execute(
+                "SELECT rubric_sha256, cohort, criterion_id, criterion_name, score, max_score, graded_by FROM criterion_grades WHERE submission_id = ?",
+                (submission_id,)).fetchall()
+            self._connection.executemany(ROLLUP_UPSERT, [_rollup_delta(*tuple(row), -1) for row in previous_rows])
+            self._connection.execute("DELETE FROM criterion_grades WHERE submission_id = ?", (submission_id,))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (submission_id, time.time(), cohort, user_id, submission_name, rubric_sha256, requirements_sha256,
+                 _to_float(overall_result.get('total_score')),
+                 sum(score for score in max_scores.values() if score is not None) if max_scores else None,
+                 sum(tier.get('prompt_tokens') or 0 for tier in tiers),
+                 sum(tier.get('completion_tokens') or 0 for tier in tiers),
+                 sum(tier.get('latency_seconds') or 0 for tier in tiers),
+                 grading_seconds, overall_result.get('overall_feedback')))
+            self._connection.executemany("INSERT INTO criterion_grades VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.executemany(ROLLUP_UPSERT, [_rollup_delta(row[1], row[2], row[3], row[4], row[5], row[6], row[7], 1) for row in rows])
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, parameters).fetchall()]
+
+    @staticmethod
+    def _filters(rubric_sha256, cohort):
+        clauses, parameters = ["rubric_sha256 = ?"], [rubric_sha256]
+        if cohort is not None:
+            clauses.append("cohort = ?")
+            parameters.append(cohort)
+        return " AND ".join(clauses), parameters
+
+    def rubrics(self):
+        """Rubrics seen so far with submission counts, newest first (the other queries are per rubric)."""
+        return self._query("""
+            SELECT rubric_sha256, COUNT(*) AS submissions, MAX(created_at) AS last_graded_at,
+                   GROUP_CONCAT(DISTINCT cohort) AS cohorts
+            FROM submissions GROUP BY rubric_sha256 ORDER BY last_graded_at DESC""")
+
+    def cohort_distribution(self, rubric_sha256, cohort=None, bins=10):
+        """Summary statistics, percentiles and a histogram of total scores."""
+        where, parameters = self._filters(rubric_sha256, cohort)
+        summary = self._query(f"""
+            SELECT COUNT(total_score) AS count, MIN(total_score) AS min, MAX(total_score) AS max,
+                   SUM(total_score) AS total, SUM(total_score * total_score) AS total_of_squares,
+                   AVG(max_total_score) AS max_total_score, SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(completion_tokens) AS completion_tokens, AVG(llm_latency_seconds) AS mean_llm_latency_seconds
+            FROM submissions WHERE {where}""", parameters)[0]
+        count = summary.pop('count')
+        mean, stddev = _mean_and_stddev(count, summary.pop('total') or 0.0, summary.pop('total_of_squares') or 0.0)
+        result = dict(summary, count=count, mean=mean, stddev=stddev, percentiles={}, histogram=[])
+        if not count: return result
+        scores = [row['total_score'] for row in self._query(
+            f"SELECT total_score FROM submissions WHERE {where} AND total_score IS NOT NULL ORDER BY total_score", parameters)]
+        result['percentiles'] = {f"p{p}": scores[min(len(scores) - 1, int(len(scores) * p / 100))] for p in (10, 25, 50, 75, 90)}
+        low, high = summary['min'], summary['max']
+        width = (high - low) / bins if high > low else 1.0
+        counts = {row['bucket']: row['count'] for row in self._query(f"""
+            SELECT MIN(CAST((total_score - ?) / ? AS INTEGER), ?) AS bucket, COUNT(*) AS count
+            FROM submissions WHERE {where} AND total_score IS NOT NULL GROUP BY bucket""", [low, width, bins - 1] + parameters)}
+        result['histogram'] = [{"from": low + index * width, "to": low + (index + 1) * width, "count": counts.get(index, 0)} for index in range(bins)]
+        return result
+
+    def criterion_averages(self, rubric_sha256, cohort=None):
+        """Per-criterion mean, spread and share of full marks, with how often a local check decided it."""
+        where, parameters = self._filters(rubric_sha256, cohort)
+        rows = self._query(f"""
+            SELECT criterion_id, MAX(criterion_name) AS criterion_name, MAX(max_score) AS max_score, SUM(count) AS count,
+                   SUM(total) AS total, SUM(total_of_squares) AS total_of_squares,
+                   SUM(full_marks) AS full_marks, SUM(local_checks) AS local_check_count
+            FROM criterion_rollups WHERE {where} GROUP BY criterion_id HAVING SUM(count) > 0 ORDER BY criterion_id""", parameters)
+        for row in rows:
+            row['mean'], row['stddev'] = _mean_and_stddev(row['count'], row.pop('total'), row.pop('total_of_squares'))
+            row['full_marks_rate'] = row.pop('full_marks') / row['count']
+            row['mean_fraction_of_max'] = row['mean'] / row['max_score'] if row['max_score'] else None
+        return rows
+
+    def outliers(self, rubric_sha256, cohort=None, z_threshold=2.0, limit=50):
+        """Submissions whose total score is more than z_threshold standard deviations from the mean."""
+        distribution = self.cohort_distribution(rubric_sha256, cohort, bins=1)
+        mean, stddev = distribution['mean'], distribution['stddev']
+        if not stddev: return {"mean": mean, "stddev": stddev, "submissions": []}
+        where, parameters = self._filters(rubric_sha256, cohort)
+        submissions = self._query(f"""
+            SELECT submission_id, submission_name, cohort, user_id, total_score, created_at,
+                   (total_score - ?) / ? AS z_score
+            FROM submissions WHERE {where} AND ABS(total_score - ?) > ? * ?
+            ORDER BY ABS(total_score - ?) DESC LIMIT ?""",
+            [mean, stddev] + parameters + [mean, z_threshold, stddev, mean, limit])
+        return {"mean": mean, "stddev": stddev, "z_threshold": z_threshold, "submissions": submissions}
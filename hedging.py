@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import queue
+import types
+import threading
+import collections
+from cancellation import current_token, read_completion_stream
+
+# --- Hedged Grading Calls ---
+# A few Azure calls hang until the client timeout and dominate p99 latency. HedgedChatClient wraps any
+# chat client (a single Azure client or a DeploymentPool) and, when a call has not returned by the p90
+# latency observed for its model and prompt-size bucket, sends one duplicate. With a pool the duplicate
+# lands on the least-loaded deployment, i.e. usually another one. The first response that is valid JSON
+# wins; the other attempt's stream is closed so Azure stops generating (and billing) it. A non-streamed
+# attempt cannot be interrupted, so it is abandoned and counted in stats(). Cancelling the job closes
+# every attempt. Hedges are capped at GRADING_HEDGE_BUDGET_PERCENT of all calls.
+
+HEDGE_PERCENTILE = 0.9
+LATENCY_WINDOW = 200 # Recent latencies kept per (model, prompt-size bucket)
+MIN_LATENCY_SAMPLES = 20 # Below this the configured default delay is used
+MIN_HEDGE_DELAY_SECONDS = 1.0
+CHARS_PER_TOKEN = 4
+TOKENS_PER_IMAGE = 1000
+
+def _prompt_size_bucket(messages):
+    """Power-of-two bucket of the estimated prompt tokens (0: <1k, 1: 1-2k, 2: 2-4k, ...)."""
+    tokens = 0
+    for message in messages:
+        content = message.get('content')
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            tokens += len(part.get('text') or "") // CHARS_PER_TOKEN if part.get('type') == 'text' else TOKENS_PER_IMAGE
+    return (tokens // 1000).bit_length()
+
+def _is_valid_response(response, expects_json):
+    try:
+        content = response.choices[0].message.content
+        if expects_json: json.loads(content)
+        return content is not None
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return False
+
+class _LatencyHistogram:
+    def __init__(self):
+        self.samples = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def percentile(self, fraction):
+        if len(self.samples) < MIN_LATENCY_SAMPLES: return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class _HedgedCall:
+    """The attempts of one hedged call whose streams are still being read, so the losers can be closed."""
+
+    def __init__(self, streamed):
+        self.streamed = streamed
+        self._lock = threading.Lock()
+        self._running = {} # attempt -> its stream (None until the request returns)
+        self._decided = False
+
+    def start(self, attempt):
+        with self._lock: self._running[attempt] = None
+
+    def streaming(self, attempt, stream):
+        """Records an attempt's stream; returns False (after closing it) if the call was already decided."""
+        with self._lock:
+            if not self._decided:
+                self._running[attempt] = stream
+                return True
+        if hasattr(stream, 'close'): stream.close()
+        return False
+
+    def finished(self, attempt):
+        with self._lock: self._running.pop(attempt, None)
+
+    def close_others(self, winner=None):
+        """
+        Decides the call: closes every still-running attempt but winner (a stream that has not started yet is
+        closed by streaming()). Returns the (closed, abandoned) counts.
+        """
+        with self._lock:
+            self._decided = True
+            losers = [stream for attempt, stream in self._running.items() if attempt != winner]
+            self._running.clear()
+        for stream in losers:
+            if hasattr(stream, 'close'): stream.close()
+        closed = len(losers) if self.streamed else 0
+        return closed, len(losers) - closed
+
+class HedgedChatClient:
+    """Drop-in wrapper exposing chat.completions.create(...); other attributes are delegated to the wrapped client."""
+
+    def __init__(self, inner_client, budget_fraction, default_delay_seconds=30.0):
+        self.inner_client = inner_client
+        self.budget_fraction = budget_fraction
+        self.default_delay_seconds = default_delay_seconds
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(_LatencyHistogram)
+        self.requests = self.hedged = self.hedge_wins = self.primary_wins_after_hedge = self.budget_denied = self.no_valid_response = 0
+        self.losers_closed = self.losers_abandoned = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create_chat_completion))
+
+    def __getattr__(self, name):
+        if name == 'inner_client': raise AttributeError(name)
+        return getattr(self.inner_client, name)
+
+    def hedge_delay(self, model, bucket):
+        with self._lock:
+            p90 = self._latencies[(model, bucket)].percentile(HEDGE_PERCENTILE)
+        return max(MIN_HEDGE_DELAY_SECONDS, p90 if p90 is not None else self.default_delay_seconds)
+
+    def _record_latency(self, model, bucket, seconds):
+        with self._lock:
+            self._latencies[(model, bucket)].samples.append(seconds)
+
+    def _take_hedge_budget(self):
+        with self._lock:
+            if self.hedged + 1 > self.budget_fraction * self.requests:
+                self.budget_denied += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def _start_attempt(self, attempt, outcomes, model, bucket, kwargs, call):
+        call.start(attempt)
+        def run():
+            started = time.perf_counter()
+            try:
+                response = self.inner_client.chat.completions.create(model=model, **kwargs)
+                if not call.streaming(attempt, response): raise RuntimeError("closed: the call was decided before its response started")
+                response = read_completion_stream(response)
+            except Exception as e:
+                outcomes.put((attempt, None, e))
+                return
+            finally:
+                call.finished(attempt)
+            self._record_latency(model, bucket, time.perf_counter() - started)
+            outcomes.put((attempt, response, None))
+        threading.Thread(target=run, daemon=True, name=f"grading-call-{attempt}").start()
+
+    def _decide(self, call, winner=None):
+        closed, abandoned = call.close_others(winner)
+        with self._lock:
+            self.losers_closed += closed
+            self.losers_abandoned += abandoned
+
+    def _create_chat_completion(self, model=None, messages=None, **kwargs):
+        kwargs['messages'] = messages
+        bucket = _prompt_size_bucket(messages or [])
+        expects_json = (kwargs.get('response_format') or {}).get('type') == 'json_object'
+        with self._lock:
+            self.requests += 1
+        outcomes = queue.Queue()
+        call = _HedgedCall(bool(kwargs.get('stream')))
+        token = current_token()
+        if token is not None: token.on_cancel(lambda: self._decide(call)) # A cancelled job closes every attempt
+        self._start_attempt('primary', outcomes, model, bucket, kwargs, call)
+        attempts_running, hedge_decided, hedge_sent = 1, False, False
+        fallback, first_error = None, None
+        delay = self.hedge_delay(model, bucket)
+        deadline = time.monotonic() + delay
+        while attempts_running:
+            timeout = None if hedge_decided else max(0.0, deadline - time.monotonic())
+            try:
+                attempt, response, error = outcomes.get(timeout=timeout)
+            except queue.Empty:
+                hedge_decided = True # Only one hedge per call, whether or not the budget allows it
+                if self._take_hedge_budget():
+                    print(f"Hedging slow grading call to '{model}' (prompt bucket {bucket}) after {delay:.1f}s.")
+                    self._start_attempt('hedge', outcomes, model, bucket, kwargs, call)
+                    attempts_running, hedge_sent = attempts_running + 1, True
+                continue
+            attempts_running -= 1
+            if error is None and _is_valid_response(response, expects_json):
+                self._decide(call, attempt)
+                if hedge_sent:
+                    with self._lock:
+                        if attempt == 'hedge': self.hedge_wins += 1
+                        else: self.primary_wins_after_hedge += 1
+                return response
+            # Invalid JSON or an error: keep waiting for the other attempt, if any
+            if error is None: fallback = fallback or response
+            else: first_error = first_error or error
+        with self._lock:
+            self.no_valid_response += 1
+        if fallback is not None: return fallback # Downstream salvage can still recover truncated JSON
+        raise first_error
+
+    def stats(self):
+        with self._lock:
+            hedging = {
+                "budget_percent": round(self.budget_fraction * 100, 1), "requests": self.requests, "hedged": self.hedged,
+                "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else 0.0,
+                "hedge_wins": self.hedge_wins, "primary_wins_after_hedge": self.primary_wins_after_hedge,
+                "hedge_win_rate": round(self.hedge_wins / self.hedged, 4) if self.hedged else None,
+                "budget_denied": self.budget_denied, "no_valid_response": self.no_valid_response,
+                "losers_closed": self.losers_closed, "losers_abandoned": self.losers_abandoned,
+                "p90_latency_seconds": {f"{model}|bucket{bucket}": round(p90, 3) for (model, bucket), histogram in self._latencies.items()
+                                        if (p90 := histogram.percentile(HEDGE_PERCENTILE)) is not None},
+            }
+        inner_stats = self.inner_client.stats() if hasattr(self.inner_client, 'stats') else {}
+        return dict(inner_stats, hedging=hedging)
+
+def wrap_with_hedging(chat_client):
+    """Wraps chat_client in a HedgedChatClient when GRADING_HEDGE_BUDGET_PERCENT is set to a positive number."""
+    if chat_client is None: return None
+    try:
+        budget_percent = float(os.getenv("GRADING_HEDGE_BUDGET_PERCENT", "0"))
+        default_delay_seconds = float(os.getenv("GRADING_HEDGE_DEFAULT_DELAY_SECONDS", "30"))
+    except ValueError:
+        print("Invalid GRADING_HEDGE_* setting; request hedging is disabled.")
+        return chat_client
+    if budget_percent <= 0: return chat_client
+    print(f"Request hedging enabled: at most {budget_percent:g}% extra grading calls, fired at the observed p90 latency.")
+    return HedgedChatClient(chat_client, budget_percent / 100.0, default_delay_seconds)
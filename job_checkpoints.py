@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import pickle
+
+# --- Stage-Level Job Checkpoints ---
+# Each /analyze job gets a directory (uploads/jobs/<job_id>) holding its uploads, the extracted project
+# and one checkpoint file per finished pipeline stage (extraction manifest, parsed rubric, collected
+# content, summaries of the code beyond the prompt budget, requirements text, assembled prompt, raw
+# grading response). A failed job is kept for JOB_RETENTION_SECONDS so a retry resumes from the first
+# stage without a checkpoint instead of re-uploading, re-extracting or paying for another LLM call.
+# A stage that is redone (its checkpoint was missing or unreadable) drops the checkpoints of every later
+# stage, which were built from its old output.
+
+JOB_FILENAME = "job.json"
+CHECKPOINT_DIRNAME = "checkpoints"
+PIPELINE_STAGES = ('extract', 'rubric', 'content', 'summaries', 'requirements', 'prompt', 'llm_response')
+
+class JobCheckpoints:
+    """Reads and writes the per-stage checkpoint files of one job directory."""
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.checkpoint_dir = os.path.join(job_dir, CHECKPOINT_DIRNAME)
+        self.resumed_stages = []
+
+    def _path(self, stage):
+        return os.path.join(self.checkpoint_dir, f"{stage}.pkl")
+
+    def completed_stages(self):
+        return [stage for stage in PIPELINE_STAGES if os.path.exists(self._path(stage))]
+
+    def load(self, stage):
+        """Returns the stored output of a stage, or None when the stage has not completed."""
+        try:
+            with open(self._path(stage), 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Discarding unreadable checkpoint {self._path(stage)}: {e}")
+            return None
+        self.resumed_stages.append(stage)
+        return value
+
+    def save(self, stage, value):
+        """
+        Writes a stage output atomically, so a crash mid-write never leaves a half checkpoint behind, after
+        discarding the later stages' checkpoints: they were computed from the output being replaced.
+        """
+        self.discard(stage)
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        temp_path = self._path(stage) + ".tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self._path(stage))
+
+    def discard(self, stage):
+        """Drops a stage checkpoint and every later one (their inputs are about to change)."""
+        for later_stage in PIPELINE_STAGES[PIPELINE_STAGES.index(stage):]:
+            try: os.remove(self._path(later_stage))
+            except FileNotFoundError: pass
+
+def save_job(job_dir, job):
+    temp_path = os.path.join(job_dir, JOB_FILENAME + ".tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, indent=2)
+    os.replace(temp_path, os.path.join(job_dir, JOB_FILENAME))
+
+def load_job(job_dir):
+    """Returns the job description written by save_job, or None if the job does not exist (or expired)."""
+    try:
+        with open(os.path.join(job_dir, JOB_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def update_job(job_dir, **changes):
+    job = load_job(job_dir)
+    if job is None: return None
+    job.update(changes, updated_at=time.time())
+    save_job(job_dir, job)
+    return job
@@ -0,0 +1,149 @@
+import os
+import re
+
+# --- Deterministic Local Checks ---
+# Rubric rows that only ask whether something EXISTS in the submission ("README present",
+# "unit tests exist", "no hard-coded credentials") are graded here from the collected file tree
+# instead of by the LLM. Each check is registered against regex patterns that are matched
+# against the criterion text from the rubric's detected criterion column. A check that cannot decide
+# from the file tree returns None and the criterion stays with the LLM.
+
+LOCAL_CHECK_RULES = []
+LOCAL_CHECK_MAX_CRITERION_WORDS = 15 # Longer criteria usually ask about quality, not presence
+LOCAL_CHECK_COMMENT_PREFIX = "[Local check] "
+CREDENTIAL_SCAN_MAX_FILE_BYTES = 512 * 1024
+CREDENTIAL_SCAN_EXTENSIONS = (
+    '.py', '.java', '.js', '.ts', '.jsx', '.tsx', '.json', '.yaml', '.yml', '.xml', '.ini', '.cfg', '.conf',
+    '.properties', '.env', '.sh', '.rb', '.php', '.go', '.cs', '.swift', '.c', '.cpp', '.h', '.hpp', '.html'
+)
+
+# A presence criterion must be nothing but "<subject> present" or "has <subject>", optionally about the
+# project as a whole. Anything more ("README with setup steps", "tests that pass", "has a test plan",
+# "uses test-driven development") asks about something else and stays with the AI.
+PRESENCE_PREFIX = r'^\s*(?:(?:the\s+)?(?:project|repo(?:sitory)?|submission|code(?:base)?|solution|app(?:lication)?)\s+)?'
+PRESENCE_END = r'\s*[.!]?\s*$'
+
+CREDENTIAL_PATTERNS = [
+    ('AWS access key', re.compile(r'AKIA[0-9A-Z]{16}')),
+    ('private key', re.compile(r'-----BEGIN (?:RSA |EC |OPENSSH |DSA )?PRIVATE KEY-----')),
+    ('hard-coded secret', re.compile(r'''(?i)\b(?:api[_-]?key|secret(?:[_-]?key)?|password|passwd|pwd|access[_-]?token|auth[_-]?token|client[_-]?secret)\b\s*[:=]\s*['"]([^'"\s]{8,})['"]''')),
+    ('connection string with password', re.compile(r'(?i)\b(?:mongodb(?:\+srv)?|postgres(?:ql)?|mysql|redis)://[^:\s/]+:[^@\s/]{4,}@')),
+]
+# Values that are clearly placeholders are not treated as leaked secrets.
+PLACEHOLDER_SECRET_PATTERN = re.compile(r'(?i)^(?:\$\{.*\}|<.*>|x+|\*+|your[_-].*|changeme|placeholder|example.*|dummy.*|test.*|os\.environ.*|process\.env.*)$')
+
+def _presence_patterns(subject):
+    """Patterns for whole criteria phrased "<subject> is present" or "has <subject>"."""
+    return (
+        PRESENCE_PREFIX + rf'(?:an?\s+|the\s+)?{subject}(?:\s+files?|\s+folders?|\s+director(?:y|ies))?\s+(?:is\s+|are\s+)?(?:present|exists?|included|provided|available|added|written)' + PRESENCE_END,
+        PRESENCE_PREFIX + rf'(?:has|have|uses?|includes?|contains?|provides?|with)\s+(?:an?\s+|the\s+)?{subject}' + PRESENCE_END,
+    )
+
+def local_check(*patterns):
+    """Registers a local check for criteria whose text matches any of the given regex patterns."""
+    def decorator(check_function):
+        LOCAL_CHECK_RULES.append(([re.compile(p, re.IGNORECASE) for p in patterns], check_function))
+        return check_function
+    return decorator
+
+def _basenames(file_paths):
+    return [os.path.basename(path).lower() for path in file_paths]
+
+@local_check(*_presence_patterns(r'readme(?:\.md)?'))
+def check_readme_present(match, file_paths, text_files_content, base_dir):
+    found = [path for path in file_paths if os.path.basename(path).lower().startswith('readme')]
+    if found: return True, f"README found: {found[0]}."
+    return False, "No README file found in the submission."
+
+@local_check(*_presence_patterns(r'(?:unit[ -]?)?tests?(?:\s+cases?)?'))
+def check_unit_tests_exist(match, file_paths, text_files_content, base_dir):
+    test_file_pattern = re.compile(r'(^test_.*\.py$|_test\.(py|go)$|\.(test|spec)\.(js|jsx|ts|tsx)$|tests?\.(java|cs)$|^test.*\.(java|cs)$)', re.IGNORECASE)
+    found = [path for path in file_paths if test_file_pattern.search(os.path.basename(path))]
+    found += [path for path in file_paths if re.search(r'(^|[\\/])(tests?|__tests__|spec)[\\/]', path, re.IGNORECASE) and path not in found]
+    if found: return True, f"{len(found)} test file(s) found, e.g. {found[0]}."
+    return False, "No unit test files or test directories found."
+
+@local_check(*_presence_patterns(r'(?P<name>requirements\.txt|package\.json|pom\.xml|build\.gradle|pyproject\.toml|dockerfile|docker-compose\.ya?ml|\.gitignore|\.env\.example)'))
+def check_named_file_present(match, file_paths, text_files_content, base_dir):
+    expected_name = match.group('name').lower()
+    names = _basenames(file_paths)
+    if expected_name == 'docker-compose.yml' or expected_name == 'docker-compose.yaml':
+        present = any(name in ('docker-compose.yml', 'docker-compose.yaml') for name in names)
+    else:
+        present = expected_name in names
+    if present: return True, f"{expected_name} is present in the submission."
+    return False, f"{expected_name} was not found in the submission."
+
+@local_check(*_presence_patterns(r'screen ?shots?(?P<folder>\s+(?:folder|directory))?'))
+def check_screenshots_present(match, file_paths, text_files_content, base_dir):
+    folders = sorted({os.path.dirname(path) for path in file_paths if re.search(r'screen ?shots?', os.path.dirname(path), re.IGNORECASE)})
+    if folders: return True, f"Screenshots folder found: {folders[0]}."
+    if match.group('folder'): return False, "No screenshots folder found."
+    images = [path for path in file_paths if path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'))]
+    if images: return None # Logos and icons are images too; whether these are screenshots is for the AI to judge
+    return False, "No screenshots folder or image files found."
+
+@local_check(r'\bno\b.*\b(hard[ -]?coded|embedded|exposed)\b.*\b(credentials?|secrets?|passwords?|api[ _-]?keys?|keys|tokens?)\b',
+             r'\b(credentials?|secrets?|passwords?|api[ _-]?keys?)\b.*\bnot\b.*\b(hard[ -]?coded|committed|exposed|embedded)\b')
+def check_no_hardcoded_credentials(match, file_paths, text_files_content, base_dir):
+    findings = []
+    for path in file_paths:
+        if not path.lower().endswith(CREDENTIAL_SCAN_EXTENSIONS): continue
+        full_path = os.path.join(base_dir, path) if base_dir else None
+        content = None
+        if full_path and os.path.isfile(full_path) and os.path.getsize(full_path) <= CREDENTIAL_SCAN_MAX_FILE_BYTES:
+            try:
+                with open(full_path, 'r', encoding='utf-8', errors='ignore') as f: content = f.read()
+            except OSError as e:
+                print(f"Error reading {path} for credential scan: {e}")
+        if content is None: content = text_files_content.get(path)
+        if not content: continue
+        for label, pattern in CREDENTIAL_PATTERNS:
+            for found in pattern.finditer(content):
+                secret_value = found.group(1) if pattern.groups else found.group(0)
+                if PLACEHOLDER_SECRET_PATTERN.match(secret_value): continue
+                findings.append(f"{label} in {path}")
+                break
+    if findings:
+        shown = "; ".join(findings[:5]) + (f"; and {len(findings) - 5} more" if len(findings) > 5 else "")
+        return False, f"Possible hard-coded credentials: {shown}."
+    return True, "No hard-coded credentials detected in the submitted source and config files."
+
+def match_local_check(criterion_text):
+    """Returns (check_function, match) for the first rule matching the criterion text, or (None, None)."""
+    if not criterion_text or len(criterion_text.split()) > LOCAL_CHECK_MAX_CRITERION_WORDS:
+        return None, None
+    for patterns, check_function in LOCAL_CHECK_RULES:
+        for pattern in patterns:
+            match = pattern.search(criterion_text)
+            if match: return check_function, match
+    return None, None
+
+def run_local_checks(criteria_for_ai_list, file_paths, text_files_content, base_dir=None):
+    """
+    Grades the criteria that a registered local check can decide. Returns {criterion_id: grade} with the
+    same shape the AI returns (criterion_id, criterion_name, score_achieved, comments); criteria with
+    no matching rule, or whose check is undecided, are left for the LLM. A pass earns max_score (1.0 if the rubric has no score column).
+    """
+    local_grades = {}
+    for criterion in criteria_for_ai_list:
+        check_function, match = match_local_check(criterion.get('criterion_name', ''))
+        if check_function is None: continue
+        try:
+            outcome = check_function(match, file_paths, text_files_content, base_dir)
+        except Exception as e:
+            print(f"Local check {check_function.__name__} failed for criterion {criterion['criterion_id']}, leaving it to the AI: {e}")
+            continue
+        if outcome is None: continue # Undecided locally
+        passed, comment = outcome
+        max_score = criterion.get('max_score', 1.0)
+        local_grades[criterion['criterion_id']] = {
+            "criterion_id": criterion['criterion_id'],
+            "criterion_name": criterion.get('criterion_name', ''),
+            "score_achieved": max_score if passed else 0.0,
+            "comments": LOCAL_CHECK_COMMENT_PREFIX + comment,
+            "graded_by": "local_check",
+        }
+    if local_grades:
+        print(f"Local checks graded {len(local_grades)} of {len(criteria_for_ai_list)} criteria without the AI.")
+    return local_grades
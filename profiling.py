@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import collections
+
+# --- On-Demand Request Profiling ---
+# An admin can ask for one /analyze request to be profiled (see app.py). The request then runs under
+# cProfile (on the request thread and on the scheduler worker that does the grading), tracemalloc records
+# the peak memory and top allocation sites of every pipeline stage, and a background sampler collects
+# flamegraph-ready collapsed stacks. Artifacts are written to one directory per profile:
+#   profile.pstats    - load with pstats / snakeviz
+#   stacks.collapsed  - feed to flamegraph.pl or speedscope
+#   summary.json      - per-stage wall time, peak memory and top allocation sites
+# Unprofiled requests get NULL_PROFILER, whose hooks are no-ops, so there is no overhead when disabled.
+
+PROFILE_ARTIFACTS = {'pstats': 'profile.pstats', 'stacks': 'stacks.collapsed', 'summary': 'summary.json'}
+STACK_SAMPLE_INTERVAL_SECONDS = 0.005
+TOP_ALLOCATION_SITES = 10
+TRACEMALLOC_FRAMES = 5
+
+# From Python 3.12 cProfile is built on sys.monitoring and already sees every thread (and only one profiler
+# may be active), so worker threads only need their own Profile on older interpreters.
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+# tracemalloc is process-wide, so only one request is profiled at a time; others queue behind it.
+_profiling_lock = threading.Lock()
+# The profiler's own bookkeeping (stack sampling, snapshots) is kept out of the allocation report.
+_SELF_ALLOCATION_FILTERS = (tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__))
+
+class _NullProfiler:
+    enabled = False
+    profile_id = None
+    _null_context = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._null_context
+
+    def wrap(self, func):
+        return func
+
+    def finish(self):
+        return None
+
+NULL_PROFILER = _NullProfiler()
+
+def _format_frame_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class RequestProfiler:
+    """Profiles one request; use stage() around pipeline steps and wrap() for work handed to other threads."""
+    enabled = True
+
+    def __init__(self, profile_id, output_dir):
+        self.profile_id = profile_id
+        self.output_dir = output_dir
+        self.stages = []
+        self._profiles = []
+        self._stack_counts = collections.Counter()
+        self._sampled_threads = set()
+        self._sampling = threading.Event()
+        self._sampler = None
+        self._started_at = None
+        self._summary = None
+
+    def start(self):
+        _profiling_lock.acquire()
+        self._started_at = time.perf_counter()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._begin_thread_profile()
+        self._sampling.set()
+        self._sampler = threading.Thread(target=self._sample_stacks, daemon=True, name=f"profiler-{self.profile_id[:8]}")
+        self._sampler.start()
+        return self
+
+    def _begin_thread_profile(self):
+        self._sampled_threads.add(threading.get_ident())
+        if self._profiles and not PER_THREAD_CPROFILE: return None
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def _sample_stacks(self):
+        while self._sampling.is_set():
+            frames = sys._current_frames()
+            for thread_id in list(self._sampled_threads):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self._stack_counts[_format_frame_stack(frame)] += 1
+            time.sleep(STACK_SAMPLE_INTERVAL_SECONDS)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Records wall time, peak traced memory and the top allocation sites of one pipeline stage."""
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot().filter_traces(_SELF_ALLOCATION_FILTERS)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot().filter_traces(_SELF_ALLOCATION_FILTERS)
+            top_sites = after.compare_to(before, 'lineno')[:TOP_ALLOCATION_SITES]
+            self.stages.append({
+                "stage": name,
+                "seconds": round(seconds, 3),
+                "peak_traced_bytes": peak_bytes,
+                "traced_bytes_at_end": current_bytes,
+                "top_allocation_sites": [{"site": str(stat.traceback[0]), "size_diff_bytes": stat.size_diff, "count_diff": stat.count_diff}
+                                         for stat in top_sites if stat.size_diff > 0],
+            })
+
+    def wrap(self, func):
+        """Returns func instrumented with its own cProfile and stack sampling, for running on another thread."""
+        def profiled(*args, **kwargs):
+            profile = self._begin_thread_profile()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None: profile.disable()
+                self._sampled_threads.discard(threading.get_ident())
+        return profiled
+
+    def finish(self):
+        """Stops profiling and writes the artifacts. Returns the summary dict; later calls return the same summary."""
+        if self._summary is not None or self._started_at is None: return self._summary
+        try:
+            for profile in self._profiles: profile.disable()
+            self._sampling.clear()
+            if self._sampler: self._sampler.join()
+            tracemalloc.stop()
+            os.makedirs(self.output_dir, exist_ok=True)
+            stats = None
+            for profile in self._profiles:
+                if stats is None: stats = pstats.Stats(profile)
+                else: stats.add(profile)
+            if stats is not None:
+                stats.dump_stats(os.path.join(self.output_dir, PROFILE_ARTIFACTS['pstats']))
+            with open(os.path.join(self.output_dir, PROFILE_ARTIFACTS['stacks']), 'w', encoding='utf-8') as f:
+                for stack, count in self._stack_counts.most_common():
+                    f.write(f"{stack} {count}\n")
+            summary = {
+                "profile_id": self.profile_id,
+                "total_seconds": round(time.perf_counter() - self._started_at, 3),
+                "stack_samples": sum(self._stack_counts.values()),
+                "stages": self.stages,
+            }
+            with open(os.path.join(self.output_dir, PROFILE_ARTIFACTS['summary']), 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+            self._summary = summary
+            return summary
+        finally:
+            self._started_at = None
+            _profiling_lock.release()
+
+def start_request_profiler(requested, profile_id, output_dir):
+    """Returns a started RequestProfiler when profiling was requested, NULL_PROFILER otherwise."""
+    if not requested: return NULL_PROFILER
+    print(f"Profiling request {profile_id}; artifacts will be written to {output_dir}.")
+    return RequestProfiler(profile_id, output_dir).start()
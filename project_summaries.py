@@ -0,0 +1,397 @@
+import os
+import re
+import json
+import math
+import time
+import queue
+import hashlib
+import threading
+import collections
+from cancellation import CancelToken, JobCancelled, cancellation_scope, current_token
+from utils import _call_openai_with_retries, _cascade_settings, _admission_limits, read_project_text, file_manifest, CHARS_PER_TOKEN_ESTIMATE
+
+# --- Map-Reduce Project Summaries ---
+# collect_project_content sends at most MAX_TOTAL_AI_TEXT_CHARS of raw code, so most of a large project
+# never reaches the grader. The hand-written files left out or truncated (collection_report's
+# overflow_files) are summarized instead:
+#   map:    files are grouped by directory into units of up to SUMMARY_UNIT_CHARS (large files are split
+#           into parts) and each unit is summarized in parallel by a cheap deployment into a structured
+#           module summary (purpose, components, features, quality notes, key symbols)
+#   reduce: while the summaries exceed SUMMARY_BUDGET_CHARS, neighbouring summaries (in path order, so
+#           mostly one directory) are merged by the same deployment, up to SUMMARY_MAX_REDUCE_LEVELS times
+# The grading prompt then carries the summaries plus short raw excerpts around each unit's key symbols.
+# Summaries are cached by a hash of their input, so starter code shared by a cohort and re-graded
+# submissions are summarized once. The calls go through the grading scheduler when one is given (its
+# class caps and per-user fair share apply), at most SUMMARY_CONCURRENCY per job at a time. Before any
+# call, estimate_summaries() projects the tokens and ADMISSION_MAX_SUMMARY_TOKENS is enforced like the
+# other admission limits: 'downgrade' summarizes less source, 'reject' skips the summaries.
+# SUMMARY_TIME_BUDGET_SECONDS bounds the added latency: when it expires, queued calls are withdrawn,
+# running ones are closed and their units are listed as not summarized. Set PROJECT_SUMMARIES=0 to drop
+# overflow instead.
+
+SUMMARY_PROMPT_VERSION = 1 # Bump when the prompts change so cached summaries are rebuilt
+PROJECT_SUMMARIES_ENABLED = os.getenv("PROJECT_SUMMARIES", "1").lower() not in ('0', 'false', 'no')
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4")) # Calls in flight per job
+SUMMARY_TIME_BUDGET_SECONDS = float(os.getenv("SUMMARY_TIME_BUDGET_SECONDS", "180"))
+SUMMARY_BUDGET_CHARS = int(os.getenv("SUMMARY_BUDGET_CHARS", "60000")) # Rendered summaries in the grading prompt
+SUMMARY_UNIT_CHARS = 24000 # Source per map call (~6k tokens)
+SUMMARY_MAX_SOURCE_CHARS = int(os.getenv("SUMMARY_MAX_SOURCE_CHARS", "800000")) # Overflow beyond this is listed as not summarized
+SUMMARY_MAX_TOKENS = 700
+SUMMARY_MAX_REDUCE_LEVELS = 3
+SUMMARY_PROMPT_OVERHEAD_CHARS = 900 # Instructions and JSON shape sent with every map/reduce call
+EXCERPT_BUDGET_CHARS = 20000
+EXCERPT_MAX_CHARS = 2500
+EXCERPT_LINES = 40
+UNSUMMARIZED_MANIFEST_CHARS = 4000
+MEMORY_CACHE_ENTRIES = 2048
+
+SUMMARY_SHAPE = ('{"module":"<directory or files covered>","purpose":"<1-2 sentences>","components":[{"name":"<file/class/function>",'
+                 '"role":"<what it does>"}],"features":["<functionality actually implemented>"],"quality":["<tests, error handling, '
+                 'structure, security: strengths and problems>"],"key_symbols":["<up to 3 function/class names most relevant to grading>"]}')
+MAP_PROMPT = """Summarize this part of a student software project for a grader who will not see the code.
+Output STRICTLY one JSON object: {shape}
+Be factual and brief; say when code is incomplete, stubbed or commented out.
+{sources}"""
+REDUCE_PROMPT = """Merge these summaries of neighbouring parts of a student software project into one summary for a grader.
+Output STRICTLY one JSON object: {shape}
+Keep every implemented feature and every quality problem; drop repetition.
+{summaries}"""
+DEFINITION_PATTERN = r'^[ \t]*(?:(?:export|public|private|protected|static|async|abstract|final|default)\s+)*(?:def|class|function|func|fn|interface|struct|enum)\b[^\n]*\b{symbol}\b'
+
+def summary_deployment():
+    """AZURE_OPENAI_SUMMARY_DEPLOYMENT_NAME, else the cascade's fast deployment, else the grading deployment."""
+    strong_deployment, fast_deployment, _ = _cascade_settings()
+    return os.getenv("AZURE_OPENAI_SUMMARY_DEPLOYMENT_NAME") or fast_deployment or strong_deployment
+
+class SummaryCache:
+    """
+    Summaries keyed by input hash: an in-memory LRU, backed by JSON files when cache_dir is set. A disk hit
+    refreshes the file's mtime, so an age-based sweep of cache_dir removes the entries that stopped being used.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=MEMORY_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        if not self.cache_dir: return None
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        try: os.utime(self._disk_path(key))
+        except OSError: pass # Swept meanwhile; the value read is still good
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if not self.cache_dir: return
+        temp_path = self._disk_path(key) + f".{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(temp_path, self._disk_path(key))
+        except OSError as e:
+            print(f"Could not cache project summary {key[:12]}: {e}")
+
+def _cache_key(kind, deployment, parts):
+    digest = hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}|{kind}|{deployment}".encode('utf-8'))
+    for label, text in parts:
+        digest.update(f"\0{label}\0".encode('utf-8'))
+        digest.update(text.encode('utf-8', errors='ignore'))
+    return digest.hexdigest()
+
+def build_summary_units(project_dir, overflow_files, max_source_chars=SUMMARY_MAX_SOURCE_CHARS):
+    """
+    Reads the overflow files and packs them, directory by directory, into units of at most SUMMARY_UNIT_CHARS
+    ([(label, text)] lists; files larger than a unit become numbered parts). Returns (units, skipped_paths).
+    """
+    units, skipped, total_chars = [], [], 0
+    paths_by_dir = collections.defaultdict(list)
+    for file_info in overflow_files:
+        paths_by_dir[os.path.dirname(file_info['path'])].append(file_info['path'])
+    for directory in sorted(paths_by_dir):
+        unit, unit_chars = [], 0
+        for path in sorted(paths_by_dir[directory]):
+            if total_chars >= max_source_chars:
+                skipped.append(path)
+                continue
+            try:
+                text = read_project_text(os.path.join(project_dir, path)) or ""
+            except Exception as e:
+                print(f"Could not read {path} for summarization: {e}")
+                continue
+            total_chars += len(text)
+            part_count = -(-len(text) // SUMMARY_UNIT_CHARS)
+            for part in range(part_count):
+                label = path if part_count == 1 else f"{path} (part {part + 1}/{part_count})"
+                segment = text[part * SUMMARY_UNIT_CHARS:(part + 1) * SUMMARY_UNIT_CHARS]
+                if unit and unit_chars + len(segment) > SUMMARY_UNIT_CHARS:
+                    units.append(unit)
+                    unit, unit_chars = [], 0
+                unit.append((label, segment))
+                unit_chars += len(segment)
+        if unit: units.append(unit)
+    return units, skipped
+
+def _interleave_by_top_directory(units):
+    """Orders units round-robin across top-level directories, so a time budget that cuts the map short still covers every part of the project."""
+    by_top = collections.OrderedDict()
+    for unit in units:
+        by_top.setdefault(unit[0][0].replace('\\', '/').split('/')[0], collections.deque()).append(unit)
+    ordered = []
+    while by_top:
+        for top in list(by_top):
+            ordered.append(by_top[top].popleft())
+            if not by_top[top]: del by_top[top]
+    return ordered
+
+def _parse_summary(raw_text, fallback_module):
+    try:
+        summary = json.loads(raw_text)
+        if isinstance(summary, dict): return summary
+    except (TypeError, json.JSONDecodeError):
+        pass
+    return {"module": fallback_module, "purpose": (raw_text or "").strip()[:500]}
+
+def _excerpts_for(unit, key_symbols):
+    """Short raw excerpts starting at the definitions of a unit's key symbols: [{"path", "line", "text"}]."""
+    excerpts = []
+    for symbol in [symbol for symbol in key_symbols if isinstance(symbol, str) and re.fullmatch(r'[\w.$]{2,80}', symbol)][:3]:
+        pattern = re.compile(DEFINITION_PATTERN.format(symbol=re.escape(symbol.split('.')[-1])), re.MULTILINE)
+        for label, text in unit:
+            match = pattern.search(text)
+            if not match: continue
+            start = text.rfind('\n', 0, match.start()) + 1
+            excerpt = '\n'.join(text[start:].split('\n')[:EXCERPT_LINES])[:EXCERPT_MAX_CHARS]
+            excerpts.append({"path": label, "line": text.count('\n', 0, start) + 1, "text": excerpt})
+            break
+    return excerpts
+
+def _start_thread(func, *args, cancel_token=None):
+    """Runs func(*args) on its own thread inside cancel_token's scope; used when no scheduler is given."""
+    def run():
+        with cancellation_scope(cancel_token): func(*args)
+    threading.Thread(target=run, daemon=True, name="project-summary").start()
+
+class _SummaryRun:
+    """One project's map-reduce: the calls, their cache and the shared deadline."""
+
+    def __init__(self, chat_client, deployment, cache, deadline, submit=None):
+        self.chat_client, self.deployment, self.cache, self.deadline = chat_client, deployment, cache, deadline
+        self.submit = submit or _start_thread
+        self.calls = self.cache_hits = self.prompt_tokens = self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def _summarize(self, kind, parts, prompt_text, fallback_module):
+        key = _cache_key(kind, self.deployment, parts)
+        cached = self.cache.get(key)
+        if cached is not None:
+            with self._lock: self.cache_hits += 1
+            return cached
+        messages = [{"role": "system", "content": "You summarize source code for a grader and output JSON only."},
+                    {"role": "user", "content": prompt_text}]
+        response = _call_openai_with_retries(self.chat_client, messages, self.deployment, 0.2, SUMMARY_MAX_TOKENS, {"type": "json_object"})
+        usage = getattr(response, 'usage', None)
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += getattr(usage, 'prompt_tokens', None) or 0
+            self.completion_tokens += getattr(usage, 'completion_tokens', None) or 0
+        summary = _parse_summary(response.choices[0].message.content, fallback_module)
+        self.cache.put(key, summary)
+        return summary
+
+    def map_unit(self, unit):
+        sources = ''.join(f"--- {label} ---\n{text}\n" for label, text in unit)
+        summary = self._summarize('map', unit, MAP_PROMPT.format(shape=SUMMARY_SHAPE, sources=sources), ', '.join(label for label, _ in unit))
+        summary = dict(summary, files=[label for label, _ in unit])
+        return summary, _excerpts_for(unit, summary.get('key_symbols') or [])
+
+    def reduce_group(self, group):
+        parts = [(','.join(summary.get('files', [])), json.dumps(summary, sort_keys=True, separators=(',', ':'))) for summary in group]
+        summaries_json = '\n'.join(text for _, text in parts)
+        merged = self._summarize('reduce', parts, REDUCE_PROMPT.format(shape=SUMMARY_SHAPE, summaries=summaries_json), group[0].get('module', ''))
+        return dict(merged, files=[path for summary in group for path in summary.get('files', [])])
+
+    def run_parallel(self, func, items):
+        """
+        func over items, at most SUMMARY_CONCURRENCY submitted at a time, until the deadline. Returns {index: result}
+        for those that finished; the rest are withdrawn from the queue or closed mid-call.
+        """
+        job_token = current_token()
+        run_token = CancelToken() # Cancelled at the deadline, or with the job
+        if job_token is not None: job_token.on_cancel(lambda: run_token.cancel(job_token.reason))
+        outcomes = queue.Queue()
+        def call(index):
+            try:
+                outcomes.put((index, func(items[index]), None))
+            except BaseException as e:
+                outcomes.put((index, None, e))
+        pending, in_flight, results = collections.deque(range(len(items))), 0, {}
+        try:
+            while (pending or in_flight) and not run_token.cancelled:
+                while pending and in_flight < max(1, SUMMARY_CONCURRENCY):
+                    self.submit(call, pending.popleft(), cancel_token=run_token)
+                    in_flight += 1
+                try:
+                    index, result, error = outcomes.get(timeout=max(0.0, self.deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                in_flight -= 1
+                if error is None: results[index] = result
+                elif not isinstance(error, JobCancelled): print(f"Project summary call failed: {error}")
+        finally:
+            run_token.cancel("Project summary time budget spent")
+        if job_token is not None: job_token.raise_if_cancelled()
+        return results
+
+def _compact(summary):
+    return json.dumps({key: value for key, value in summary.items() if key not in ('key_symbols', 'files')}, separators=(',', ':'), ensure_ascii=False)
+
+def _reduce_groups(summaries):
+    """Neighbouring summaries packed into groups of about one map unit of JSON."""
+    groups, group, group_chars = [], [], 0
+    for summary in summaries:
+        summary_chars = len(_compact(summary))
+        if group and group_chars + summary_chars > SUMMARY_UNIT_CHARS:
+            groups.append(group)
+            group, group_chars = [], 0
+        group.append(summary)
+        group_chars += summary_chars
+    if group: groups.append(group)
+    return groups
+
+def render_project_summaries(summaries, excerpts, unsummarized_paths):
+    """The prompt section appended to the project content: one compact JSON summary per line, excerpts, and what was left out."""
+    lines = [f"Module summaries (files beyond the raw content budget, summarized; {sum(len(s.get('files', [])) for s in summaries)} files):"]
+    lines += [_compact(summary) for summary in summaries]
+    if excerpts:
+        lines.append("Excerpts from summarized files:")
+        lines += [f"--- {excerpt['path']} (from line {excerpt['line']}) ---\n{excerpt['text']}" for excerpt in excerpts]
+    if unsummarized_paths:
+        manifest = file_manifest(sorted(unsummarized_paths))
+        if len(manifest) > UNSUMMARIZED_MANIFEST_CHARS: manifest = manifest[:UNSUMMARIZED_MANIFEST_CHARS].rsplit(' ', 1)[0] + " ..."
+        lines.append(f"Not shown or summarized ({len(unsummarized_paths)} files): {manifest}")
+    return '\n'.join(lines) + '\n'
+
+def estimate_summaries(collection_report, max_source_chars=SUMMARY_MAX_SOURCE_CHARS):
+    """
+    Preflight cost of summarize_overflow() without reading a file or calling the AI: map and reduce calls and
+    their prompt/completion tokens. Cache hits cannot be known in advance, so this is an upper bound.
+    """
+    overflow_files = (collection_report.get('overflow_files') or []) if PROJECT_SUMMARIES_ENABLED else []
+    source_chars, chars_by_dir = 0, collections.Counter()
+    for file_info in overflow_files:
+        if source_chars >= max_source_chars: break
+        source_chars += file_info['chars']
+        chars_by_dir[os.path.dirname(file_info['path'])] += file_info['chars']
+    map_calls = sum(math.ceil(chars / SUMMARY_UNIT_CHARS) for chars in chars_by_dir.values()) # Units never span directories
+    summary_chars = SUMMARY_MAX_TOKENS * CHARS_PER_TOKEN_ESTIMATE # Every summary at its max_tokens limit
+    prompt_chars = source_chars + map_calls * SUMMARY_PROMPT_OVERHEAD_CHARS
+    calls, summaries, levels = map_calls, map_calls, 0
+    while summaries * summary_chars > SUMMARY_BUDGET_CHARS and levels < SUMMARY_MAX_REDUCE_LEVELS:
+        groups = math.ceil(summaries * summary_chars / SUMMARY_UNIT_CHARS)
+        if groups >= summaries: break
+        prompt_chars += summaries * summary_chars + groups * SUMMARY_PROMPT_OVERHEAD_CHARS
+        calls, summaries, levels = calls + groups, groups, levels + 1
+    return {"source_chars": source_chars, "calls": calls, "prompt_tokens": math.ceil(prompt_chars / CHARS_PER_TOKEN_ESTIMATE),
+            "completion_tokens": calls * SUMMARY_MAX_TOKENS}
+
+def _estimated_tokens(estimate):
+    return estimate["prompt_tokens"] + estimate["completion_tokens"]
+
+def admit_summaries(collection_report):
+    """
+    Checks the summary estimate against ADMISSION_MAX_SUMMARY_TOKENS. With ADMISSION_POLICY=downgrade less source
+    is summarized until the estimate fits; with 'reject' the summaries are skipped. Returns (max_source_chars,
+    decision), max_source_chars being 0 when nothing may be summarized.
+    """
+    limits = _admission_limits()
+    max_source_chars = SUMMARY_MAX_SOURCE_CHARS
+    estimate = estimate_summaries(collection_report, max_source_chars)
+    decision = {"policy": limits["policy"], "max_summary_tokens": limits["max_summary_tokens"], "actions": [],
+                "estimate_before": estimate, "estimate": estimate}
+    if _estimated_tokens(estimate) <= limits["max_summary_tokens"]: return max_source_chars, decision
+    if limits["policy"] == "reject":
+        max_source_chars = 0
+    while max_source_chars > 0 and _estimated_tokens(estimate) > limits["max_summary_tokens"]:
+        max_source_chars = int(max_source_chars * 0.95 * limits["max_summary_tokens"] / _estimated_tokens(estimate))
+        if max_source_chars < SUMMARY_UNIT_CHARS: max_source_chars = 0
+        estimate = estimate_summaries(collection_report, max_source_chars)
+    estimate = estimate_summaries(collection_report, max_source_chars)
+    decision["actions"].append(f"summarizing at most {max_source_chars} source chars (~{_estimated_tokens(estimate)} tokens)" if max_source_chars
+                               else f"skipped summaries of ~{_estimated_tokens(decision['estimate_before'])} tokens")
+    decision["estimate"] = estimate
+    print(f"Admission control: project summaries {decision['actions'][0]}.")
+    return max_source_chars, decision
+
+def preview_summaries(collection_report):
+    """What summarize_overflow() would spend, for dry runs: its result shape with the admitted estimate and no text."""
+    _, admission = admit_summaries(collection_report)
+    estimate = admission["estimate"]
+    return {"text": "", "estimated": True, "overflow_files": len(collection_report.get('overflow_files') or []), "calls": estimate["calls"],
+            "prompt_tokens": estimate["prompt_tokens"], "completion_tokens": estimate["completion_tokens"], "admission": admission}
+
+def summarize_overflow(chat_client, project_dir, collection_report, cache, submit=None):
+    """
+    Map-reduce summaries of the files in collection_report['overflow_files']. Returns a dict with the prompt
+    'text' ("" when there is nothing to summarize, summaries are disabled or there is no chat client), coverage
+    and cost stats (files summarized, units, calls, tokens, cache hits, reduce levels, seconds) and the admission
+    decision. submit(func, *args, cancel_token=...) runs each call, e.g. GradingScheduler.submit bound to the
+    job's user and priority class; by default every call gets its own thread.
+    """
+    overflow_files = collection_report.get('overflow_files') or []
+    result = {"text": "", "overflow_files": len(overflow_files), "files_summarized": 0, "units": 0, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+              "cache_hits": 0, "reduce_levels": 0, "seconds": 0.0}
+    if not overflow_files or not PROJECT_SUMMARIES_ENABLED or not chat_client: return result
+    started = time.monotonic()
+    deployment = summary_deployment()
+    max_source_chars, result["admission"] = admit_summaries(collection_report)
+    run = _SummaryRun(chat_client, deployment, cache, started + SUMMARY_TIME_BUDGET_SECONDS, submit)
+    units, skipped = build_summary_units(project_dir, overflow_files, max_source_chars)
+    units = _interleave_by_top_directory(units)
+    mapped = run.run_parallel(run.map_unit, units)
+    summaries = sorted((mapped[index][0] for index in mapped), key=lambda summary: summary['files'][0])
+    excerpts, excerpt_chars = [], 0
+    for index in sorted(mapped):
+        for excerpt in mapped[index][1]:
+            if excerpt_chars + len(excerpt['text']) > EXCERPT_BUDGET_CHARS: break
+            excerpts.append(excerpt)
+            excerpt_chars += len(excerpt['text'])
+    while summaries and sum(len(_compact(summary)) for summary in summaries) > SUMMARY_BUDGET_CHARS and result["reduce_levels"] < SUMMARY_MAX_REDUCE_LEVELS:
+        groups = _reduce_groups(summaries)
+        if len(groups) == len(summaries): break # Every summary is already a unit on its own; merging cannot shrink them
+        reduced = run.run_parallel(run.reduce_group, groups)
+        # A group whose merge did not finish in time keeps its separate summaries
+        summaries = [summary for index, group in enumerate(groups) for summary in ([reduced[index]] if index in reduced else group)]
+        result["reduce_levels"] += 1
+    while summaries and sum(len(_compact(summary)) for summary in summaries) > SUMMARY_BUDGET_CHARS:
+        summaries.pop() # Still over budget after the last level: the files of the dropped summaries are listed as not summarized
+    summarized_files = {label.split(' (part ')[0] for summary in summaries for label in summary.get('files', [])}
+    unsummarized = [file_info['path'] for file_info in overflow_files if file_info['path'] not in summarized_files and not file_info['sent_chars']]
+    result.update(text=render_project_summaries(summaries, excerpts, unsummarized) if summaries else "", deployment=deployment,
+                  files_summarized=len(summarized_files), not_summarized=len(unsummarized), units=len(units), calls=run.calls,
+                  prompt_tokens=run.prompt_tokens, completion_tokens=run.completion_tokens,
+                  cache_hits=run.cache_hits, skipped_for_size=len(skipped), seconds=round(time.monotonic() - started, 2))
+    print(f"Project summaries: {result['files_summarized']}/{len(overflow_files)} overflow files in {len(summaries)} summaries "
+          f"({run.calls} calls, {run.cache_hits} cache hits, {result['reduce_levels']} reduce levels, {result['seconds']}s).")
+    return result
@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import threading
+import unicodedata
+import collections
+from utils import read_requirements_file, read_requirements_pages, file_sha256
+
+# --- Requirements Digest ---
+# The requirements document is part of every grading prompt, and PDF/PPTX decks extract with page
+# headers and footers, page numbers, repeated slide titles and ragged whitespace. The digest normalizes
+# the extracted text once per document: repeated headers/footers and page numbers at the top and bottom
+# of each page are dropped (numbers elsewhere, e.g. marks in a table, are kept), whitespace is
+# collapsed, long lines repeated verbatim are kept once, and numbered requirements ("3.", "2.1", "FR-4")
+# are joined with their wrapped and bulleted continuation lines into one "[id] text" line each,
+# in document order. The structured list is kept alongside the compact text. Digests are cached by the
+# document's SHA-256 in memory and, when a cache directory is given, on disk, so a cohort graded against
+# one requirements document builds it once. Set REQUIREMENTS_DIGEST=0 to send the verbatim text instead.
+
+DIGEST_VERSION = 2 # Bump when the digest rules change so cached digests are rebuilt
+REQUIREMENTS_DIGEST_ENABLED = os.getenv("REQUIREMENTS_DIGEST", "1").lower() not in ('0', 'false', 'no')
+HEADER_FOOTER_ZONE_LINES = 3 # Lines at the top and bottom of each page checked for repeated headers/footers
+HEADER_FOOTER_MIN_PAGES = 3
+HEADER_FOOTER_PAGE_FRACTION = 0.5
+MIN_DEDUPED_LINE_CHARS = 30 # Shorter lines (table cells, "Yes", slide titles) may legitimately repeat
+MEMORY_CACHE_ENTRIES = 32
+
+PAGE_NUMBER_PATTERN = re.compile(r'^(?:page|slide|p\.)?\s*\d{1,4}(?:\s*(?:/|of)\s*\d{1,4})?$', re.IGNORECASE)
+# A page number inside a longer header/footer line ("Acme Ltd - Page 3 of 12"); only such lines compare with digits ignored
+FOOTER_NUMBER_PATTERN = re.compile(r'\b(?:page|slide|p\.)\s*\d{1,4}\b|\b\d{1,4}\s*(?:/|of)\s*\d{1,4}\s*$', re.IGNORECASE)
+REQUIREMENT_ITEM_PATTERN = re.compile(
+    r'^(?P<id>\d{1,3}(?:\.\d{1,3})+\.?|\d{1,3}[.)]|(?:REQ|FR|NFR|UR|SR|TR|US|R)[-_ ]?\d{1,4}(?:\.\d{1,3})*[.):]?)\s+(?P<text>\S.*)$', re.IGNORECASE)
+CONTINUATION_MARKER_PATTERN = re.compile(r'^(?:[-*•▪●–‣o]\s+|\(?[a-z]\)\s+|\(?[ivx]{1,4}\)\s+)')
+
+def _normalize_line(line):
+    line = unicodedata.normalize('NFKC', line)
+    line = ''.join(ch for ch in line if ch in '\t' or unicodedata.category(ch)[0] != 'C')
+    return ' '.join(line.split())
+
+def _header_footer_key(line):
+    """Lines carrying a page number match across pages with the number ignored; other lines ("Exercise 3") only verbatim."""
+    if PAGE_NUMBER_PATTERN.match(line) or FOOTER_NUMBER_PATTERN.search(line):
+        return re.sub(r'\d+', '#', line.lower())
+    return line.lower()
+
+def _repeated_edge_lines(pages):
+    """Keys of lines found in the top or bottom zone of at least HEADER_FOOTER_PAGE_FRACTION of the pages."""
+    if len(pages) < HEADER_FOOTER_MIN_PAGES: return set()
+    counts = collections.Counter()
+    for lines in pages:
+        counts.update({_header_footer_key(line) for line in lines[:HEADER_FOOTER_ZONE_LINES] + lines[-HEADER_FOOTER_ZONE_LINES:]})
+    min_pages = max(2, HEADER_FOOTER_PAGE_FRACTION * len(pages))
+    return {key for key, count in counts.items() if count >= min_pages}
+
+def build_requirements_digest(pages):
+    """
+    Digests the extracted text of a requirements document (one string per page or slide). Returns a dict with
+    the compact 'text', the structured 'requirements' list ([{"id", "text"}]) and what was removed.
+    """
+    page_lines = [[line for line in map(_normalize_line, page.splitlines()) if line] for page in pages]
+    repeated_keys = _repeated_edge_lines(page_lines)
+    stats = {"headers_footers_removed": 0, "page_numbers_removed": 0, "duplicate_lines_removed": 0}
+    lines, seen_long_lines = [], set()
+    for page in page_lines:
+        for index, line in enumerate(page):
+            at_edge = index < HEADER_FOOTER_ZONE_LINES or index >= len(page) - HEADER_FOOTER_ZONE_LINES
+            if at_edge and _header_footer_key(line) in repeated_keys:
+                stats["headers_footers_removed"] += 1
+            elif at_edge and PAGE_NUMBER_PATTERN.match(line):
+                stats["page_numbers_removed"] += 1
+            elif len(line) >= MIN_DEDUPED_LINE_CHARS and line.lower() in seen_long_lines:
+                stats["duplicate_lines_removed"] += 1
+            else:
+                if len(line) >= MIN_DEDUPED_LINE_CHARS: seen_long_lines.add(line.lower())
+                lines.append(line)
+
+    # One "[id] text" line per numbered requirement, absorbing wrapped and bulleted continuation lines
+    requirements, output_lines, current = [], [], None
+    for line in lines:
+        item = REQUIREMENT_ITEM_PATTERN.match(line)
+        if item:
+            current = {"id": item.group('id').rstrip('.):'), "text": item.group('text')}
+            requirements.append(current)
+            output_lines.append(current)
+        elif current is not None and CONTINUATION_MARKER_PATTERN.match(line):
+            current["text"] += (" " if current["text"].endswith(':') else "; ") + CONTINUATION_MARKER_PATTERN.sub('', line)
+        elif current is not None and line[0].islower():
+            current["text"] += " " + line
+        else:
+            current = None
+            output_lines.append(line)
+    text = "\n".join(f"[{line['id']}] {line['text']}" if isinstance(line, dict) else line for line in output_lines)
+    return dict(stats, version=DIGEST_VERSION, pages=len(pages), source_chars=sum(len(page) for page in pages),
+                digest_chars=len(text), text=text, requirements=requirements)
+
+class RequirementsDigestCache:
+    """
+    Requirements digests keyed by document SHA-256: an in-memory LRU, backed by JSON files when cache_dir is set.
+    A disk hit refreshes the file's mtime, so an age-based sweep of cache_dir removes the digests no longer used.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=MEMORY_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._digests = collections.OrderedDict()
+        self.hits = self.disk_hits = self.builds = 0
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, sha256):
+        return os.path.join(self.cache_dir, f"{sha256}.json")
+
+    def _remember(self, sha256, digest):
+        with self._lock:
+            self._digests[sha256] = digest
+            self._digests.move_to_end(sha256)
+            while len(self._digests) > self.max_entries: self._digests.popitem(last=False)
+
+    def _load_from_disk(self, sha256):
+        if not self.cache_dir: return None
+        try:
+            with open(self._disk_path(sha256), 'r', encoding='utf-8') as f:
+                digest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        try: os.utime(self._disk_path(sha256))
+        except OSError: pass # Swept meanwhile; the digest read is still good
+        return digest if digest.get("version") == DIGEST_VERSION else None
+
+    def _save_to_disk(self, sha256, digest):
+        if not self.cache_dir: return
+        temp_path = self._disk_path(sha256) + f".{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(digest, f)
+            os.replace(temp_path, self._disk_path(sha256))
+        except OSError as e:
+            print(f"Could not cache requirements digest {sha256[:12]}: {e}")
+
+    def get(self, file_path, sha256=None):
+        """The digest of a requirements document, built on first use. Returns None when the file cannot be read."""
+        sha256 = sha256 or file_sha256(file_path)
+        with self._lock:
+            digest = self._digests.get(sha256)
+            if digest is not None:
+                self._digests.move_to_end(sha256)
+                self.hits += 1
+                return digest
+        digest = self._load_from_disk(sha256)
+        if digest is not None:
+            self.disk_hits += 1
+        else:
+            pages = read_requirements_pages(file_path)
+            if pages is None: return None
+            digest = dict(build_requirements_digest(pages), sha256=sha256)
+            self.builds += 1
+            print(f"Requirements digest built for {os.path.basename(file_path)}: {digest['source_chars']} -> {digest['digest_chars']} chars, "
+                  f"{len(digest['requirements'])} numbered requirements.")
+            self._save_to_disk(sha256, digest)
+        self._remember(sha256, digest)
+        return digest
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._digests), "hits": self.hits, "disk_hits": self.disk_hits, "builds": self.builds}
+
+def load_requirements_text(file_path, digest_cache, sha256=None):
+    """
+    The requirements text to put in grading prompts: the cached digest, or the verbatim extracted text when
+    REQUIREMENTS_DIGEST=0 or the digest came out empty. Returns None when the document cannot be read.
+    """
+    if not REQUIREMENTS_DIGEST_ENABLED:
+        return read_requirements_file(file_path)
+    digest = digest_cache.get(file_path, sha256)
+    if digest is None: return None
+    if not digest['text'] and digest['source_chars']: # Nothing survived the rules; never send less than the original
+        return read_requirements_file(file_path)
+    return digest['text']
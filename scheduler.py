@@ -0,0 +1,137 @@
+import time
+import threading
+import collections
+from cancellation import JobCancelled, cancellation_scope
+
+# --- Grading Scheduler ---
+# Sits in front of the (slow, quota-bound) grading stage. Jobs belong to a priority class
+# ('interactive' or 'bulk'), each class has its own concurrency cap so a cohort upload can never
+# occupy the slots reserved for single interactive submissions, and within a class users are
+# served round-robin so one user's fifty queued jobs do not delay everyone else's first job.
+# A job submitted with a CancelToken leaves the queue as soon as the token is cancelled, and a running
+# one executes inside the token's cancellation scope so its OpenAI call is abandoned (cancellation.py).
+
+PRIORITY_CLASSES = ('interactive', 'bulk') # Dispatch order: interactive is always considered first
+DEFAULT_CLASS_LIMITS = {'interactive': 4, 'bulk': 2}
+WAIT_SAMPLES_PER_CLASS = 500 # Recent queue waits kept per class for the p95 figure
+
+class GradingJob:
+    """A unit of work queued in the scheduler; wait() blocks until it has run and returns its result."""
+
+    def __init__(self, user_id, priority_class, func, args, kwargs, cancel_token=None):
+        self.user_id = user_id
+        self.priority_class = priority_class
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.cancel_token = cancel_token
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    @property
+    def queue_wait_seconds(self):
+        """Time spent queued before a worker picked the job up (so far, if it is still waiting)."""
+        return round((self.started_at or time.monotonic()) - self.enqueued_at, 3)
+
+    @property
+    def run_seconds(self):
+        if self.started_at is None: return None
+        return round((self.finished_at or time.monotonic()) - self.started_at, 3)
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Grading job for {self.user_id} did not finish within {timeout} seconds.")
+        if self.exception is not None: raise self.exception
+        return self.result
+
+class GradingScheduler:
+    """Priority classes with per-class concurrency caps and per-user fair-share (round-robin) queues."""
+
+    def __init__(self, class_limits=None):
+        self.class_limits = dict(DEFAULT_CLASS_LIMITS, **(class_limits or {}))
+        self._lock = threading.Lock()
+        # priority class -> OrderedDict(user_id -> deque of jobs); the dict order is the round-robin order
+        self._queues = {priority_class: collections.OrderedDict() for priority_class in PRIORITY_CLASSES}
+        self._running = {priority_class: 0 for priority_class in PRIORITY_CLASSES}
+        self._recent_waits = {priority_class: collections.deque(maxlen=WAIT_SAMPLES_PER_CLASS) for priority_class in PRIORITY_CLASSES}
+
+    def submit(self, user_id, priority_class, func, *args, cancel_token=None, **kwargs):
+        if priority_class not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority_class}'. Allowed: {', '.join(PRIORITY_CLASSES)}.")
+        job = GradingJob(user_id or 'anonymous', priority_class, func, args, kwargs, cancel_token)
+        with self._lock:
+            self._queues[priority_class].setdefault(job.user_id, collections.deque()).append(job)
+        if cancel_token is not None: cancel_token.on_cancel(lambda: self.cancel(job))
+        self._dispatch()
+        return job
+
+    def run(self, user_id, priority_class, func, *args, cancel_token=None, **kwargs):
+        """Submits a job and blocks until it has run. Returns (result, job)."""
+        job = self.submit(user_id, priority_class, func, *args, cancel_token=cancel_token, **kwargs)
+        return job.wait(), job
+
+    def cancel(self, job):
+        """Removes a job that is still queued and fails it with JobCancelled; returns False if it already started."""
+        with self._lock:
+            jobs = self._queues[job.priority_class].get(job.user_id)
+            if job.started_at is not None or jobs is None or job not in jobs: return False
+            jobs.remove(job)
+            if not jobs: self._queues[job.priority_class].pop(job.user_id)
+        job.exception = JobCancelled(job.cancel_token.reason if job.cancel_token else "Cancelled")
+        job.finished_at = time.monotonic()
+        job._done.set()
+        return True
+
+    def _next_job(self, priority_class):
+        user_queues = self._queues[priority_class]
+        if not user_queues: return None
+        user_id, jobs = next(iter(user_queues.items()))
+        job = jobs.popleft()
+        user_queues.pop(user_id)
+        if jobs: user_queues[user_id] = jobs # Back of the line behind the other users
+        return job
+
+    def _dispatch(self):
+        to_start = []
+        with self._lock:
+            for priority_class in PRIORITY_CLASSES:
+                while self._running[priority_class] < self.class_limits[priority_class]:
+                    job = self._next_job(priority_class)
+                    if job is None: break
+                    self._running[priority_class] += 1
+                    job.started_at = time.monotonic()
+                    self._recent_waits[priority_class].append(job.queue_wait_seconds)
+                    to_start.append(job)
+        for job in to_start:
+            threading.Thread(target=self._run_job, args=(job,), daemon=True, name=f"grading-{job.priority_class}").start()
+
+    def _run_job(self, job):
+        try:
+            with cancellation_scope(job.cancel_token):
+                job.result = job.func(*job.args, **job.kwargs)
+        except BaseException as e:
+            job.exception = e
+        finally:
+            job.finished_at = time.monotonic()
+            with self._lock:
+                self._running[job.priority_class] -= 1
+            job._done.set()
+            self._dispatch()
+
+    def stats(self):
+        """Queue depth, running jobs and recent queue-wait percentiles per priority class."""
+        with self._lock:
+            stats = {}
+            for priority_class in PRIORITY_CLASSES:
+                waits = sorted(self._recent_waits[priority_class])
+                stats[priority_class] = {
+                    "limit": self.class_limits[priority_class],
+                    "running": self._running[priority_class],
+                    "queued": sum(len(jobs) for jobs in self._queues[priority_class].values()),
+                    "queued_users": len(self._queues[priority_class]),
+                    "wait_p50_seconds": waits[len(waits) // 2] if waits else 0.0,
+                    "wait_p95_seconds": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                }
+            return stats
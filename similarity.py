@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import zlib
+import random
+import collections
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# --- Cohort Code Similarity (MinHash + LSH) ---
+# Flags submissions that share copied code without comparing every pair. Each file is tokenized with
+# identifiers, string and numeric literals abstracted (so renaming variables does not hide a copy),
+# split into overlapping token shingles and reduced to a MinHash signature. A submission's signature is
+# the element-wise minimum of its file signatures (the MinHash of all its shingles). Locality-sensitive
+# hashing over signature bands, for whole submissions and for single files (one copied file in an
+# otherwise original project), yields candidate pairs in near-linear time; only candidates are scored.
+# SimilarityIndex is incremental: submissions can be added (or replaced) one at a time as they arrive,
+# and the index is saved as JSON so later runs only process new submissions.
+
+SHINGLE_TOKENS = 8 # Abstracted tokens are low-entropy, so windows must be long to stay distinctive
+MIN_FILE_TOKENS = 30 # Shorter files (configs, stubs) match everything and are ignored
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 32 # 4 rows per band: pairs above ~0.4 Jaccard almost always become candidates
+FILE_MATCH_THRESHOLD = 0.5
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+_UINT64_MASK = (1 << 64) - 1
+
+_random = random.Random(0x5EED) # Fixed seed: signatures must stay comparable across runs and processes
+_PERMUTATIONS = [(_random.randint(1, MERSENNE_PRIME - 1), _random.randint(0, MERSENNE_PRIME - 1)) for _ in range(NUM_PERMUTATIONS)]
+if np is not None:
+    _PERMUTATION_A = np.array([a for a, _ in _PERMUTATIONS], dtype=np.uint64)
+    _PERMUTATION_B = np.array([b for _, b in _PERMUTATIONS], dtype=np.uint64)
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/|<!--.*?-->)
+  | (?P<string>\"\"\".*?\"\"\"|'''.*?'''|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)
+  | (?P<number>\b0[xX][0-9a-fA-F]+\b|\b\d[\d_]*(?:\.\d+)?(?:[eE][+-]?\d+)?\b)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<symbol>[^\s\w])
+""", re.DOTALL | re.VERBOSE)
+
+# Kept verbatim so structure survives identifier abstraction (Python, JS/TS, Java/C#, C/C++, Go, PHP)
+KEYWORDS = frozenset("""
+and as assert async await break case catch class const continue def default del delete do elif else enum except export
+extends false final finally for foreach from func function go if implements import in instanceof interface is lambda let
+match new nil none not null or package pass private protected public raise return self static struct super switch this
+throw throws true try type typeof using var void while with yield
+""".split())
+
+def normalized_tokens(text):
+    """Code tokens with comments dropped and identifiers/literals replaced by placeholders (keywords and symbols kept)."""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'comment': continue
+        if kind == 'word':
+            word = match.group()
+            tokens.append(word.lower() if word.lower() in KEYWORDS else 'ID')
+        elif kind == 'string': tokens.append('STR')
+        elif kind == 'number': tokens.append('NUM')
+        else: tokens.append(match.group())
+    return tokens
+
+def shingle_hashes(text):
+    """32-bit hashes of every SHINGLE_TOKENS-long window of normalized tokens; empty for very short files."""
+    tokens = normalized_tokens(text)
+    if len(tokens) < MIN_FILE_TOKENS: return set()
+    return {zlib.crc32(' '.join(tokens[index:index + SHINGLE_TOKENS]).encode('utf-8')) for index in range(len(tokens) - SHINGLE_TOKENS + 1)}
+
+def minhash_signature(shingles):
+    """MinHash signature of a shingle set (NUM_PERMUTATIONS values); numpy is used when installed, with identical results."""
+    if np is not None:
+        hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        permuted = (np.outer(hashes, _PERMUTATION_A) + _PERMUTATION_B) % np.uint64(MERSENNE_PRIME) & np.uint64(MAX_HASH)
+        return tuple(int(value) for value in permuted.min(axis=0))
+    return tuple(min(((a * shingle + b) & _UINT64_MASK) % MERSENNE_PRIME & MAX_HASH for shingle in shingles) for a, b in _PERMUTATIONS)
+
+def file_signatures(project_text_files_content, baseline_shingles=frozenset()):
+    """{path: signature} for the files of one submission; shingles of the starter code (baseline) are ignored."""
+    signatures = {}
+    for path, content in project_text_files_content.items():
+        shingles = shingle_hashes(content) - baseline_shingles
+        if shingles: signatures[path] = minhash_signature(shingles)
+    return signatures
+
+def baseline_shingles_for(project_text_files_content):
+    """Shingles of starter/template code handed out to everyone, so they never count as copying."""
+    return frozenset().union(*(shingle_hashes(content) for content in project_text_files_content.values()))
+
+def estimated_similarity(signature_a, signature_b):
+    """Estimated Jaccard similarity: the fraction of MinHash positions that agree."""
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / NUM_PERMUTATIONS
+
+def _band_keys(signature):
+    rows = NUM_PERMUTATIONS // LSH_BANDS
+    return [(band, hash(signature[band * rows:(band + 1) * rows])) for band in range(LSH_BANDS)]
+
+def _flagged(comparisons, threshold):
+    flagged = [comparison for comparison in comparisons if comparison["similarity"] >= threshold or comparison["matched_files"]]
+    return sorted(flagged, key=lambda comparison: (-comparison["similarity"], -len(comparison["matched_files"])))
+
+class SimilarityIndex:
+    """Incremental LSH index of submission and file signatures."""
+
+    def __init__(self):
+        self.submissions = {} # submission_id -> {"signature": tuple, "files": {path: tuple}}
+        self._submission_buckets = collections.defaultdict(set)
+        self._file_buckets = collections.defaultdict(set)
+
+    def remove(self, submission_id):
+        entry = self.submissions.pop(submission_id, None)
+        if entry is None: return
+        for key in _band_keys(entry["signature"]): self._submission_buckets[key].discard(submission_id)
+        for path, signature in entry["files"].items():
+            for key in _band_keys(signature): self._file_buckets[key].discard((submission_id, path))
+
+    def add_signatures(self, submission_id, signatures_by_file, threshold=FILE_MATCH_THRESHOLD):
+        """
+        Indexes one submission (replacing a previous version) and returns the indexed submissions it resembles:
+        overall similarity at or above threshold, or at least one file pair above FILE_MATCH_THRESHOLD.
+        """
+        self.remove(submission_id)
+        if not signatures_by_file: return []
+        candidates = self._insert(submission_id, signatures_by_file) - {submission_id}
+        return _flagged([self.compare(submission_id, other_id) for other_id in candidates], threshold)
+
+    def _insert(self, submission_id, signatures_by_file):
+        """Adds the signatures to the LSH buckets; returns the submissions sharing at least one band."""
+        signatures_by_file = {path: tuple(signature) for path, signature in signatures_by_file.items()}
+        signature = tuple(map(min, zip(*signatures_by_file.values())))
+        self.submissions[submission_id] = {"signature": signature, "files": signatures_by_file}
+        candidates = set()
+        for key in _band_keys(signature):
+            candidates.update(self._submission_buckets[key])
+            self._submission_buckets[key].add(submission_id)
+        for path, file_signature in signatures_by_file.items():
+            for key in _band_keys(file_signature):
+                candidates.update(other_id for other_id, _ in self._file_buckets[key])
+                self._file_buckets[key].add((submission_id, path))
+        return candidates
+
+    def add_submission(self, submission_id, project_text_files_content, baseline_shingles=frozenset(), threshold=FILE_MATCH_THRESHOLD):
+        return self.add_signatures(submission_id, file_signatures(project_text_files_content, baseline_shingles), threshold)
+
+    def compare(self, submission_a, submission_b):
+        """Similarity of two indexed submissions plus the file pairs that look copied."""
+        entry_a, entry_b = self.submissions[submission_a], self.submissions[submission_b]
+        matched_files = []
+        for path, file_signature in entry_a["files"].items():
+            candidates = set()
+            for key in _band_keys(file_signature):
+                candidates.update(other_path for other_id, other_path in self._file_buckets[key] if other_id == submission_b)
+            for other_path in candidates:
+                file_similarity = estimated_similarity(file_signature, entry_b["files"][other_path])
+                if file_similarity >= FILE_MATCH_THRESHOLD:
+                    matched_files.append({"file_a": path, "file_b": other_path, "similarity": round(file_similarity, 3)})
+        return {
+            "submission_a": submission_a, "submission_b": submission_b,
+            "similarity": round(estimated_similarity(entry_a["signature"], entry_b["signature"]), 3),
+            "matched_files": sorted(matched_files, key=lambda match: -match["similarity"]),
+        }
+
+    def report(self, threshold=FILE_MATCH_THRESHOLD):
+        """Every flagged pair in the index (see add_signatures), most similar first."""
+        candidate_pairs = set()
+        for bucket in list(self._submission_buckets.values()) + [{submission_id for submission_id, _ in files} for files in self._file_buckets.values()]:
+            ordered = sorted(bucket)
+            candidate_pairs.update((a, b) for index, a in enumerate(ordered) for b in ordered[index + 1:])
+        return _flagged([self.compare(a, b) for a, b in candidate_pairs], threshold)
+
+    def save(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"num_permutations": NUM_PERMUTATIONS, "shingle_tokens": SHINGLE_TOKENS,
+                       "submissions": {submission_id: {path: list(signature) for path, signature in entry["files"].items()}
+                                       for submission_id, entry in self.submissions.items()}}, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a saved index; a missing file, or one built with different parameters, gives an empty index."""
+        index = cls()
+        try:
+            with open(path, 'r', encoding='utf-8') as f: saved = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return index
+        if saved.get("num_permutations") != NUM_PERMUTATIONS or saved.get("shingle_tokens") != SHINGLE_TOKENS:
+            print(f"Similarity index {path} was built with different parameters; starting a new one.")
+            return index
+        for submission_id, signatures_by_file in saved.get("submissions", {}).items():
+            if signatures_by_file: index._insert(submission_id, signatures_by_file)
+        return index
@@ -0,0 +1,103 @@
+import time
+import threading
+from cancellation import CancelToken, JobCancelled, cancellation_scope
+
+# --- Single-Flight Request Coalescing ---
+# Identical submissions that arrive while one is already being graded (double-clicks, proxy-timeout
+# retries) attach to the running execution and receive its result instead of starting another pipeline
+# and LLM call. Successful results stay replayable for a short window so a retry that arrives just
+# after the original finished is answered from memory too. Callers may pass their own CancelToken: a
+# caller that cancels stops waiting at once, and the shared execution (which runs in the flight's own
+# cancellation scope) is cancelled only when every caller waiting on it has cancelled.
+
+class IdempotencyKeyMismatchError(Exception):
+    """Raised when a client reuses an idempotency key for a submission with different content."""
+
+class _Flight:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.result = None
+        self.exception = None
+        self.completed_at = None
+        self.followers = 0
+        self.waiting = 0 # Callers still interested in the outcome
+        self.cancel_token = CancelToken()
+
+class SingleFlight:
+    """Runs at most one execution per key at a time; concurrent callers with the same key share its outcome."""
+
+    def __init__(self, replay_seconds=300):
+        self.replay_seconds = replay_seconds
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock) # Notified when a flight completes or a caller cancels
+        self._flights = {}
+        self.executions = self.coalesced = self.replayed = self.abandoned = 0
+
+    def _evict_expired(self, now):
+        for key in [key for key, flight in self._flights.items() if flight.completed_at is not None and now - flight.completed_at > self.replay_seconds]:
+            del self._flights[key]
+
+    def _withdraw(self, key, flight, reason):
+        """A caller cancelled: once nobody waits on an unfinished flight, its execution is cancelled too (with the last reason)."""
+        with self._lock:
+            flight.waiting -= 1
+            self._changed.notify_all()
+            abandon = flight.waiting == 0 and flight.completed_at is None
+            if abandon:
+                self.abandoned += 1
+                if self._flights.get(key) is flight: del self._flights[key] # Later callers start afresh
+        if abandon: flight.cancel_token.cancel(reason)
+
+    def run(self, key, func, fingerprint=None, replayable=lambda result: True, cancel_token=None):
+        """
+        Returns (result, shared): shared is False for the caller that actually ran func. fingerprint
+        identifies the work behind the key (e.g. content hashes behind an idempotency key); reusing a key
+        with a different fingerprint raises IdempotencyKeyMismatchError. Results for which replayable()
+        is False (e.g. errors) are handed to concurrent waiters but never replayed to later callers.
+        A caller whose cancel_token is cancelled gets JobCancelled; func is cancelled with the last caller.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+            flight = self._flights.get(key)
+            if flight is not None and fingerprint is not None and flight.fingerprint not in (None, fingerprint):
+                raise IdempotencyKeyMismatchError(f"Key '{key}' was already used for a different submission.")
+            if flight is None:
+                flight = self._flights[key] = _Flight(fingerprint)
+                self.executions += 1
+                is_leader = True
+            else:
+                flight.followers += 1
+                if flight.completed_at is not None: self.replayed += 1
+                else: self.coalesced += 1
+                is_leader = False
+            interested = flight.completed_at is None
+            if interested: flight.waiting += 1
+        if interested and cancel_token is not None: cancel_token.on_cancel(lambda: self._withdraw(key, flight, cancel_token.reason))
+        if not is_leader:
+            with self._lock:
+                self._changed.wait_for(lambda: flight.completed_at is not None or (cancel_token is not None and cancel_token.cancelled))
+            if flight.completed_at is None: raise JobCancelled(cancel_token.reason)
+            if flight.exception is not None: raise flight.exception
+            return flight.result, True
+        try:
+            with cancellation_scope(flight.cancel_token):
+                flight.result = func()
+        except BaseException as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                flight.completed_at = time.monotonic()
+                if (flight.exception is not None or not replayable(flight.result)) and self._flights.get(key) is flight:
+                    del self._flights[key]
+                self._changed.notify_all()
+        return flight.result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": sum(1 for flight in self._flights.values() if flight.completed_at is None),
+                "replayable": sum(1 for flight in self._flights.values() if flight.completed_at is not None),
+                "executions": self.executions, "coalesced": self.coalesced, "replayed": self.replayed, "abandoned": self.abandoned,
+            }
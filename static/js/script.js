@@ -6,6 +6,8 @@ document.addEventListener('DOMContentLoaded', function() {
     const resultsContainer = document.getElementById('resultsContainer');
     const dataframeOutput = document.getElementById('dataframeOutput');
     const downloadReportBtn = document.getElementById('downloadReportBtn');
+    const cancelAnalysisBtn = document.getElementById('cancelAnalysisBtn');
+    const uploadProgress = document.getElementById('uploadProgress');
  
     // Function to update custom file input labels
     function updateFileNameLabel(inputElement, labelElement) {
@@ -22,15 +24,135 @@ document.addEventListener('DOMContentLoaded', function() {
         label.setAttribute('data-default-text', label.textContent);
     });
  
+    // Idempotency key for the current file selection: retries of the same submission reuse it so the
+    // server answers them from the running (or just finished) grading instead of starting another one.
+    let idempotencyKey = null;
+    function newClientKey() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
+    // The running analysis picks its own job id (X-Job-Id) so it can be cancelled before the response
+    // arrives: from the overlay's Cancel button, or when the page is closed (the server also notices a
+    // dropped connection, but a beacon is immediate and works through proxies that keep theirs open).
+    let runningJobId = null;
+    let analysisAbort = null;
+    function cancelRunningJob() {
+        if (runningJobId) navigator.sendBeacon(`/jobs/${encodeURIComponent(runningJobId)}/cancel`);
+        runningJobId = null;
+        if (analysisAbort) analysisAbort.abort();
+    }
+    window.addEventListener('pagehide', cancelRunningJob);
+    cancelAnalysisBtn.addEventListener('click', function() {
+        // Cancelling also discards a partial chunked upload; closing the page keeps it so it can be resumed
+        if (runningUpload) {
+            fetch(`/uploads/${runningUpload.id}`, { method: 'DELETE', keepalive: true });
+            localStorage.removeItem(runningUpload.resumeKey);
+        }
+        cancelRunningJob();
+    });
+
+    // Project archives of CHUNKED_UPLOAD_MIN_BYTES or more go up as a resumable chunked upload before
+    // /analyze (POST /uploads, PUT /uploads/<id>/chunks/<n> with each chunk's offset and SHA-256, then
+    // POST /uploads/<id>/complete). UPLOAD_PARALLELISM chunks are in flight at once, a failed chunk is
+    // retried with back-off, and submitting the same file again after a failure sends only the chunks
+    // the server does not have yet (the upload id is remembered in localStorage).
+    const CHUNKED_UPLOAD_MIN_BYTES = 16 * 1024 * 1024;
+    const UPLOAD_PARALLELISM = 4;
+    const CHUNK_ATTEMPTS = 5;
+    let runningUpload = null;
+
+    function uploadResumeKey(file) {
+        return `chunked-upload:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function sha256Hex(buffer) {
+        const digest = await crypto.subtle.digest('SHA-256', buffer);
+        return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function putChunk(upload, file, index, signal) {
+        const offset = index * upload.chunk_bytes;
+        const data = await file.slice(offset, Math.min(file.size, offset + upload.chunk_bytes)).arrayBuffer();
+        const checksum = await sha256Hex(data);
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(`/uploads/${upload.upload_id}/chunks/${index}`, {
+                    method: 'PUT',
+                    headers: { 'Content-Type': 'application/octet-stream', 'X-Chunk-Offset': String(offset), 'X-Chunk-SHA256': checksum },
+                    body: data,
+                    signal: signal
+                });
+                if (response.ok) return;
+                // Only a chunk corrupted in transit (422) or a server-side failure is worth sending again
+                if (response.status !== 422 && response.status < 500) throw new Error((await response.json()).error);
+                if (attempt >= CHUNK_ATTEMPTS) throw new Error(`Chunk ${index} failed after ${attempt} attempts.`);
+            } catch (error) {
+                // fetch rejects with a TypeError when the network fails
+                if (!(error instanceof TypeError) || attempt >= CHUNK_ATTEMPTS) throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+        }
+    }
+
+    async function uploadProjectInChunks(file, signal) {
+        const resumeKey = uploadResumeKey(file);
+        let upload = null;
+        const savedUploadId = localStorage.getItem(resumeKey);
+        if (savedUploadId) {
+            const response = await fetch(`/uploads/${savedUploadId}`, { signal: signal });
+            if (response.ok) upload = await response.json(); // Otherwise it expired: start over
+        }
+        if (!upload) {
+            const response = await fetch('/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size }),
+                signal: signal
+            });
+            upload = await response.json();
+            if (!response.ok) throw new Error(upload.error);
+            localStorage.setItem(resumeKey, upload.upload_id);
+        }
+        runningUpload = { id: upload.upload_id, resumeKey: resumeKey };
+        const received = new Set(upload.received_chunks);
+        const pending = [...Array(upload.chunk_count).keys()].filter(index => !received.has(index));
+        let chunksDone = received.size;
+        let failed = false;
+        const showProgress = () => { uploadProgress.textContent = `Uploading project: ${Math.round(100 * chunksDone / upload.chunk_count)}%`; };
+        showProgress();
+        const uploadWorker = async () => {
+            while (pending.length && !failed) {
+                try {
+                    await putChunk(upload, file, pending.shift(), signal);
+                } catch (error) {
+                    failed = true; // Stop the other workers; the chunks already sent are kept for the next attempt
+                    throw error;
+                }
+                chunksDone++;
+                showProgress();
+            }
+        };
+        await Promise.all(Array.from({ length: UPLOAD_PARALLELISM }, uploadWorker));
+        const response = await fetch(`/uploads/${upload.upload_id}/complete`, { method: 'POST', signal: signal });
+        const completed = await response.json();
+        if (!response.ok) throw new Error(completed.error);
+        uploadProgress.textContent = '';
+        return upload.upload_id;
+    }
+
     // Attach event listeners for file input changes
     document.getElementById('rubricFile').addEventListener('change', function() {
         updateFileNameLabel(this, document.getElementById('rubricFile_label'));
+        idempotencyKey = null;
     });
     document.getElementById('projectZip').addEventListener('change', function() {
         updateFileNameLabel(this, document.getElementById('projectZip_label'));
+        idempotencyKey = null;
     });
     document.getElementById('requirementsFile').addEventListener('change', function() {
         updateFileNameLabel(this, document.getElementById('requirementsFile_label'));
+        idempotencyKey = null;
     });
  
     uploadForm.addEventListener('submit', async function(event) {
@@ -52,18 +174,35 @@ document.addEventListener('DOMContentLoaded', function() {
         document.body.classList.add('loading-active'); // Add class to body to prevent scrolling and indicate busy state
  
         const formData = new FormData(uploadForm);
+        idempotencyKey = idempotencyKey || newClientKey();
+        analysisAbort = new AbortController();
+        const projectFile = document.getElementById('projectZip').files[0];
+        let uploadFailed = true;
  
         try {
+            if (projectFile && projectFile.size >= CHUNKED_UPLOAD_MIN_BYTES && window.crypto && crypto.subtle) {
+                const uploadId = await uploadProjectInChunks(projectFile, analysisAbort.signal);
+                formData.delete('projectZip');
+                formData.append('projectUploadId', uploadId);
+                runningJobId = uploadId; // The upload becomes the job
+            } else {
+                runningJobId = newClientKey();
+            }
+            uploadFailed = false;
             const response = await fetch('/analyze', {
                 method: 'POST',
-                body: formData
+                headers: { 'Idempotency-Key': idempotencyKey, 'X-Job-Id': runningJobId },
+                body: formData,
+                signal: analysisAbort.signal
             });
+            if (runningUpload) localStorage.removeItem(runningUpload.resumeKey); // Claimed by the job; nothing left to resume
  
             const data = await response.json();
  
             if (data.success) {
-                // Display HTML table
-                dataframeOutput.innerHTML = data.table_html;
+                idempotencyKey = null; // The next click is a new submission (identical files are still replayed for a few minutes)
+                // Render the compact JSON result (columns + row arrays) as a table
+                renderResultsTable(data.result.report);
                 resultsContainer.classList.remove('d-none'); // Show results container
                
                 // Set download link for the Excel file
@@ -77,9 +216,20 @@ document.addEventListener('DOMContentLoaded', function() {
             }
  
         } catch (error) {
-            console.error('Error during analysis:', error);
-            showFlashMessage('An unexpected error occurred during analysis. Check console for details.', 'error');
+            if (error.name === 'AbortError') {
+                showFlashMessage('Analysis cancelled.', 'info');
+            } else if (uploadFailed) {
+                console.error('Error during upload:', error);
+                showFlashMessage(`Project upload failed: ${error.message}` + (runningUpload ? ' Submit again to resume the upload.' : ''), 'error');
+            } else {
+                console.error('Error during analysis:', error);
+                showFlashMessage('An unexpected error occurred during analysis. Check console for details.', 'error');
+            }
         } finally {
+            runningJobId = null;
+            runningUpload = null;
+            analysisAbort = null;
+            uploadProgress.textContent = '';
             // Hide loading overlay and enable button
             loadingOverlay.classList.add('d-none'); // Hide the full-screen overlay
             document.body.classList.remove('loading-active'); // Remove class from body to allow scrolling again
@@ -88,6 +238,35 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
  
+    // Builds the results table from {columns, rows, row_kinds}; cells are set via textContent so
+    // comments from the AI are never interpreted as HTML.
+    function renderResultsTable(report) {
+        const table = document.createElement('table');
+        table.className = 'table table-striped table-bordered table-hover responsive-table';
+
+        const headerRow = table.createTHead().insertRow();
+        report.columns.forEach(column => {
+            const th = document.createElement('th');
+            th.textContent = column;
+            headerRow.appendChild(th);
+        });
+
+        const tbody = table.createTBody();
+        report.rows.forEach((row, rowIndex) => {
+            const tr = tbody.insertRow();
+            const rowKind = report.row_kinds ? report.row_kinds[rowIndex] : 'criterion';
+            if (rowKind !== 'criterion') {
+                tr.classList.add(`row-${rowKind}`);
+            }
+            row.forEach(value => {
+                tr.insertCell().textContent = value === null || value === undefined ? '' : value;
+            });
+        });
+
+        dataframeOutput.innerHTML = '';
+        dataframeOutput.appendChild(table);
+    }
+ 
     function showFlashMessage(message, type) {
         const alertDiv = document.createElement('div');
         // Use Bootstrap alert classes for styling
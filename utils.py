@@ -7,6 +7,12 @@ import json
 import base64
 import mimetypes
 import collections
+import math
+import fnmatch
+import hashlib
+import time
+import re
+import mmap
 from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
  
 # Document parsing imports
@@ -15,6 +21,11 @@ from pypdf import PdfReader
 from pptx import Presentation
 # Excel styling imports
 import xlsxwriter # Ensure this is installed: pip install XlsxWriter
+# Deterministic checks that grade presence-style criteria without the AI
+from local_checks import run_local_checks
+from deployment_pool import load_deployment_pool
+from hedging import wrap_with_hedging
+from cancellation import call_cancellable, cancellable_sleep, check_cancelled, streamed_completion
  
 # --- Constants for File Types and AI ---
 ALLOWED_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
@@ -34,7 +45,85 @@ DOCUMENT_PROJECT_EXTENSIONS = ('.docx', '.pdf', '.pptx')
 MAX_FILE_SIZE_FOR_AI_PROCESSING = 1000 * 1024 * 1024 # 1 MB
 MAX_INDIVIDUAL_FILE_TRUNCATION_CHARS = 4000
 MAX_TOTAL_AI_TEXT_CHARS = 200000
- 
+SKIPPED_DIR_NAMES = ['__pycache__', '.idea', '.venv', 'node_modules', '.git', 'dist', 'build']
+
+# --- Generated / Vendored File Detection ---
+# Files matched here are dropped (or demoted behind hand-written code) BEFORE their
+# full content is read, so lockfiles and bundles no longer eat the prompt budget.
+GENERATED_FILE_NAMES = {
+    'package-lock.json', 'npm-shrinkwrap.json', 'yarn.lock', 'pnpm-lock.yaml',
+    'poetry.lock', 'pipfile.lock', 'composer.lock', 'gemfile.lock', 'cargo.lock', 'go.sum'
+}
+GENERATED_FILE_SUFFIXES = ('.min.js', '.min.css', '.bundle.js', '.chunk.js', '_pb2.py', '.pb.go', '.designer.cs', '.g.dart')
+VENDORED_DIR_NAMES = {'vendor', 'vendors', 'third_party', 'thirdparty', 'bower_components', 'jspm_packages', 'site-packages'}
+# Whole library file names only ("jquery-3.7.1.min.js", "bootstrap.bundle.js", "chart.umd.js"), so student files
+# such as chartController.js or angularApp.js are not mistaken for them
+VENDORED_LIBRARY_PATTERN = re.compile(
+    r'^(?:jquery|jquery-ui|bootstrap|bootstrap-(?:theme|grid|reboot|utilities|icons)|angular|react|react-dom|vue|lodash|underscore|moment|chart|d3|three|popper|axios)'
+    r'(?:[.-]v?\d+(?:\.\d+)*)?(?:\.(?:bundle|slim|umd|esm|cjs|module|production|development|global|prod))*(?:\.min)?\.(?:js|css)$')
+GENERATED_CODE_MARKERS = ('@generated', 'do not edit', 'auto-generated', 'autogenerated', 'this file was generated', 'generated by')
+CLASSIFIER_SAMPLE_BYTES = 8192
+MINIFIED_AVG_LINE_LENGTH = 300 # Hand-written code rarely averages more than ~80 chars per line
+MINIFIED_MAX_LINE_LENGTH = 2000
+HIGH_ENTROPY_BITS_PER_CHAR = 5.6 # Source code sits around 4.5-5.2; base64/packed blobs approach 6
+
+# --- Sampled Reading of Logs and Data Files ---
+# Large logs and data dumps are not read whole: head, tail and evenly spaced windows are taken through
+# mmap and combined with cheap stats (size, line count, log levels, JSON/XML shape) into one excerpt
+# that fits the per-file budget, so the AI sees a representative slice instead of only the first lines.
+SAMPLED_FILE_EXTENSIONS = ('.log', '.json', '.xml', '.csv', '.tsv', '.jsonl', '.ndjson')
+# Build manifests and config files share those extensions but are read whole, up to MANIFEST_MAX_CHARS,
+# so the grader sees the complete dependency list instead of a head/tail sample.
+MANIFEST_FILENAMES = {
+    'package.json', 'composer.json', 'tsconfig.json', 'jsconfig.json', 'angular.json', 'app.json', 'appsettings.json',
+    'manifest.json', 'pom.xml', 'androidmanifest.xml', 'web.xml', 'build.xml', 'ivy.xml',
+}
+MANIFEST_MAX_CHARS = 16000
+SAMPLE_HEAD_FRACTION = 0.3
+SAMPLE_TAIL_FRACTION = 0.25
+SAMPLE_MIDDLE_WINDOWS = 3
+STATS_PROBE_COUNT = 32 # Evenly spaced probes used for log levels and average line length
+STATS_PROBE_BYTES = 4096
+EXACT_LINE_COUNT_MAX_BYTES = 64 * 1024 * 1024 # Above this the line count is estimated from the probes
+LOG_LEVEL_PATTERN = re.compile(rb'\b(TRACE|DEBUG|INFO|NOTICE|WARN(?:ING)?|ERROR|SEVERE|CRITICAL|FATAL|ALERT|EMERG)\b', re.IGNORECASE)
+
+# --- Jupyter Notebooks ---
+# Notebooks are parsed cell by cell (streamed, never json.load-ed whole) into code and markdown text;
+# outputs are reduced to short text summaries and a few embedded plot images go through the image path.
+NOTEBOOK_EXTENSION = '.ipynb'
+NOTEBOOK_READ_CHUNK_CHARS = 1024 * 1024
+NOTEBOOK_OUTPUT_TEXT_CHARS = 300
+NOTEBOOK_MAX_PLOT_IMAGES = 2
+NOTEBOOK_MAX_IMAGE_BASE64_CHARS = 2 * 1024 * 1024
+NOTEBOOK_IMAGE_MIME_TYPES = ('image/png', 'image/jpeg')
+
+# Grading prompt layout. 'compact' lists each criterion once as minified JSON (grouped by category/parameter,
+# only grading-relevant columns) and prefixes the project files with a manifest; 'legacy' sends the rubric
+# markdown table plus the full pretty-printed criteria list. See bench_prompt.py for the token difference.
+GRADING_PROMPT_STYLE = os.getenv("GRADING_PROMPT_STYLE", "compact").lower()
+# Rubric columns that carry no grading guidance: serial numbers and the blanks a human grader fills in
+NON_GRADING_RUBRIC_KEY_PATTERN = re.compile(r'^(?:s[._]?no\.?|sr[._]?no\.?|sl[._]?no\.?|serial(?:_no)?|no\.?|#|id|index|unnamed.*|.*(?:obtained|achieved|awarded|given).*|comments?|remarks?|feedback|reviewer.*|grader.*)$')
+
+# Output budget for the follow-up call that re-asks only for criteria the main response missed
+FOLLOW_UP_BASE_TOKENS = 400
+FOLLOW_UP_TOKENS_PER_CRITERION = 250
+# The follow-up prompt has no screenshots and only the project files that mention the missing criteria
+FOLLOW_UP_CONTENT_CHARS = 40000
+FOLLOW_UP_KEYWORD_STOPWORDS = frozenset({
+    'with', 'that', 'this', 'have', 'from', 'each', 'should', 'must', 'will', 'been', 'into', 'used', 'uses', 'using', 'when',
+    'where', 'which', 'their', 'there', 'other', 'than', 'then', 'them', 'they', 'what', 'code', 'project', 'proper', 'properly',
+    'clear', 'clearly', 'good', 'well', 'implemented', 'implementation', 'criteria', 'criterion', 'marks', 'score', 'points',
+})
+
+# Preflight cost model (rough figures for GPT-4o-class deployments; only used for estimates and admission control)
+CHARS_PER_TOKEN_ESTIMATE = 4 # Fallback when tiktoken is not installed
+TOKENS_PER_IMAGE_ESTIMATE = 1000 # A detail:auto screenshot costs 85 + 170 per 512px tile, ~765-1105 tokens
+COMPLETION_TOKENS_BASE_ESTIMATE = 200
+COMPLETION_TOKENS_PER_CRITERION_ESTIMATE = 120
+LATENCY_BASE_SECONDS = 3.0
+PROMPT_TOKENS_PER_SECOND = 4000.0
+COMPLETION_TOKENS_PER_SECOND = 40.0
+
 # --- DYNAMIC RUBRIC KEYWORDS (FINAL & COMPLETE) ---
 # These lists are the core of the dynamic handling.
  
@@ -77,31 +166,263 @@ def read_docx(file_path):
         print(f"Error reading DOCX {file_path}: {e}")
         return None
  
-def read_pdf(file_path):
-    """Extracts text from a PDF file, returns None on error."""
+def read_pdf_pages(file_path):
+    """Extracts the text of each PDF page, returns None on error."""
     try:
         reader = PdfReader(file_path)
-        text = ""
-        for page in reader.pages:
-            text += (page.extract_text() or "") + "\n"
-        return text
+        return [page.extract_text() or "" for page in reader.pages]
     except Exception as e:
         print(f"Error reading PDF {file_path}: {e}")
         return None
  
-def read_pptx(file_path):
-    """Extracts text from a PPTX file, returns None on error."""
-    text = ""
+def read_pdf(file_path):
+    """Extracts text from a PDF file, returns None on error."""
+    pages = read_pdf_pages(file_path)
+    return None if pages is None else "".join(page + "\n" for page in pages)
+ 
+def read_pptx_slides(file_path):
+    """Extracts the text of each PPTX slide, returns None on error."""
     try:
         prs = Presentation(file_path)
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    text += shape.text + "\n"
+        return ["".join(shape.text + "\n" for shape in slide.shapes if hasattr(shape, "text")) for slide in prs.slides]
     except Exception as e:
         print(f"Error extracting text from PPTX {file_path}: {e}")
         return None
-    return text
+ 
+def read_pptx(file_path):
+    """Extracts text from a PPTX file, returns None on error."""
+    slides = read_pptx_slides(file_path)
+    return None if slides is None else "".join(slides)
+ 
+def _window_at(mapped, start, length):
+    """Bytes of a window widened to whole lines: starts after the newline preceding start, ends at a newline."""
+    if start > 0:
+        line_start = mapped.find(b'\n', start - 1, start + length)
+        start = line_start + 1 if line_start != -1 else start
+    end = min(len(mapped), start + length)
+    if end < len(mapped):
+        line_end = mapped.rfind(b'\n', start, end)
+        if line_end > start: end = line_end + 1
+    return mapped[start:end]
+ 
+def _json_top_level_shape(head_text):
+    """Describes a (possibly truncated) JSON document from its head: top-level type and first-level keys."""
+    keys, depth, in_string, escaped, string_start, last_string = [], 0, False, False, 0, None
+    top_level = None
+    for index, char in enumerate(head_text):
+        if in_string:
+            if escaped: escaped = False
+            elif char == '\\': escaped = True
+            elif char == '"':
+                in_string, last_string = False, head_text[string_start:index]
+            continue
+        if char == '"':
+            in_string, string_start = True, index + 1
+        elif char in '{[':
+            if top_level is None: top_level = 'object' if char == '{' else 'array'
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+        elif char == ':' and last_string is not None:
+            # Keys of the top-level object, or of the objects inside a top-level array
+            if (top_level == 'object' and depth == 1) or (top_level == 'array' and depth == 2):
+                if last_string not in keys: keys.append(last_string)
+            last_string = None
+        elif not char.isspace():
+            last_string = None
+        if len(keys) >= 30: break
+    if top_level is None: return None
+    if top_level == 'array': return f"array of objects with keys: {', '.join(keys)}" if keys else "array"
+    return f"object with keys: {', '.join(keys)}" if keys else "object"
+ 
+def read_sampled_data_file(file_path, budget_chars=None):
+    """
+    Reads a log/data file through mmap without loading it whole: returns (excerpt_text, stats) where the
+    excerpt holds the head, evenly spaced middle windows and the tail, prefixed by a one-line summary of
+    the stats (bytes, lines, distinct log levels, JSON/XML shape). Returns (None, None) on error.
+    """
+    budget_chars = budget_chars or MAX_INDIVIDUAL_FILE_TRUNCATION_CHARS
+    lower_name = file_path.lower()
+    try:
+        with open(file_path, 'rb') as f:
+            size_bytes = os.fstat(f.fileno()).st_size
+            if size_bytes == 0: return "", {"bytes": 0, "lines": 0}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                probe_stride = max(size_bytes // STATS_PROBE_COUNT, 1)
+                probes = [mapped[offset:offset + STATS_PROBE_BYTES] for offset in range(0, size_bytes, probe_stride)][:STATS_PROBE_COUNT]
+                stats = {"bytes": size_bytes}
+                if size_bytes <= EXACT_LINE_COUNT_MAX_BYTES:
+                    stats["lines"] = sum(mapped[offset:offset + 1024 * 1024].count(b'\n') for offset in range(0, size_bytes, 1024 * 1024))
+                else:
+                    probe_newlines = sum(probe.count(b'\n') for probe in probes)
+                    stats["lines_estimated"] = int(size_bytes * probe_newlines / max(sum(len(probe) for probe in probes), 1))
+                if lower_name.endswith('.log'):
+                    levels = {match.upper() for probe in probes for match in LOG_LEVEL_PATTERN.findall(probe)}
+                    stats["log_levels"] = sorted(level.decode('ascii') for level in levels)
+                head_text = mapped[:STATS_PROBE_BYTES * 16].decode('utf-8', errors='ignore')
+                if lower_name.endswith('.json'):
+                    stats["json_shape"] = _json_top_level_shape(head_text)
+                elif lower_name.endswith(('.jsonl', '.ndjson')):
+                    try: stats["json_shape"] = f"one JSON object per line with keys: {', '.join(json.loads(head_text.split(chr(10), 1)[0]))}"
+                    except (ValueError, TypeError): pass
+                elif lower_name.endswith('.xml'):
+                    root_match = re.search(r'<([A-Za-z_][\w:.-]*)', re.sub(r'<[?!][^>]*>', '', head_text))
+                    if root_match: stats["xml_root"] = root_match.group(1)
+                elif lower_name.endswith(('.csv', '.tsv')):
+                    stats["header"] = head_text.split('\n', 1)[0].strip()[:300]
+
+                summary = ", ".join(f"{key.replace('_', ' ')}: {', '.join(value) if isinstance(value, list) else value}" for key, value in stats.items() if value not in (None, []))
+                header = f"[Sampled excerpt; {summary}]\n"
+                body_budget = max(budget_chars - len(header), 0)
+                if size_bytes <= body_budget:
+                    return header + mapped[:].decode('utf-8', errors='ignore'), stats
+                head_bytes = int(body_budget * SAMPLE_HEAD_FRACTION)
+                tail_bytes = int(body_budget * SAMPLE_TAIL_FRACTION)
+                window_bytes = (body_budget - head_bytes - tail_bytes) // (SAMPLE_MIDDLE_WINDOWS + 1) # Leaves room for the window markers
+                sections = [("head", _window_at(mapped, 0, head_bytes))]
+                for window_index in range(1, SAMPLE_MIDDLE_WINDOWS + 1):
+                    offset = size_bytes * window_index // (SAMPLE_MIDDLE_WINDOWS + 1)
+                    sections.append((f"sample at ~{offset * 100 // size_bytes}%", _window_at(mapped, offset, window_bytes)))
+                sections.append(("tail", _window_at(mapped, max(size_bytes - tail_bytes, 0), tail_bytes)))
+                excerpt = header + "".join(f"--- {label} ---\n{data.decode('utf-8', errors='ignore').strip(chr(10))}\n" for label, data in sections)
+                return excerpt[:budget_chars], stats
+    except (OSError, ValueError) as e:
+        print(f"Error sampling data file {file_path}: {e}")
+        return None, None
+ 
+def iter_notebook_cells(file_path):
+    """
+    Yields the cells of a .ipynb file one at a time, decoding each cell object as soon as it is complete
+    in the read buffer, so memory is bounded by the largest cell rather than the whole notebook.
+    Handles both nbformat 4 ("cells") and nbformat 3 ("worksheets" -> "cells") layouts.
+    """
+    decoder = json.JSONDecoder()
+    cells_start_pattern = re.compile(r'"cells"\s*:\s*\[')
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        buffer, position, at_eof = '', None, False
+        while True:
+            if position is None:
+                match = cells_start_pattern.search(buffer)
+                if match: buffer, position = buffer[match.end():], 0
+            else:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,': position += 1
+                if position < len(buffer) and buffer[position] == ']': return
+                if position < len(buffer):
+                    try:
+                        cell, position = decoder.raw_decode(buffer, position)
+                        yield cell
+                        continue
+                    except json.JSONDecodeError:
+                        if at_eof: raise
+                buffer, position = buffer[position:], 0 # Drop what has been decoded before reading more
+            if at_eof: return
+            chunk = f.read(NOTEBOOK_READ_CHUNK_CHARS)
+            if not chunk: at_eof = True
+            buffer += chunk
+ 
+def _notebook_text(value):
+    return ''.join(value) if isinstance(value, list) else (value or '')
+ 
+def read_notebook(file_path, max_images=NOTEBOOK_MAX_PLOT_IMAGES):
+    """
+    Converts a notebook into grading text: markdown and code cells are kept, outputs are reduced to short
+    text summaries (base64 payloads never reach the text). Returns (text, plot_images, stats) where
+    plot_images holds up to max_images (mime_type, base64_data) tuples for the image path; returns
+    (None, [], None) on error.
+    """
+    parts, plot_images = [], []
+    stats = {"code_cells": 0, "markdown_cells": 0, "outputs_stripped": 0, "images_found": 0}
+    try:
+        for cell in iter_notebook_cells(file_path):
+            cell_type = cell.get('cell_type')
+            source = _notebook_text(cell.get('source', cell.get('input'))).strip()
+            if cell_type == 'markdown':
+                stats["markdown_cells"] += 1
+                if source: parts.append(f"# [markdown]\n{source}")
+                continue
+            if cell_type != 'code':
+                continue
+            stats["code_cells"] += 1
+            execution_count = cell.get('execution_count', cell.get('prompt_number'))
+            cell_lines = [f"# In[{execution_count if execution_count is not None else ' '}]:\n{source}"]
+            for output in cell.get('outputs', []):
+                stats["outputs_stripped"] += 1
+                output_type, data = output.get('output_type'), output.get('data', {})
+                if output_type == 'error' or output_type == 'pyerr':
+                    cell_lines.append(f"# Error: {output.get('ename')}: {output.get('evalue')}")
+                    continue
+                image_mime = next((mime for mime in NOTEBOOK_IMAGE_MIME_TYPES if mime in data), None)
+                if image_mime or 'png' in output:
+                    stats["images_found"] += 1
+                    image_data = _notebook_text(data.get(image_mime) if image_mime else output.get('png')).replace('\n', '')
+                    if len(plot_images) < max_images and len(image_data) <= NOTEBOOK_MAX_IMAGE_BASE64_CHARS:
+                        plot_images.append((image_mime or 'image/png', image_data))
+                        cell_lines.append(f"# Out: [plot image {len(plot_images)}, sent with the screenshots]")
+                    else:
+                        cell_lines.append("# Out: [image output omitted]")
+                    continue
+                output_text = _notebook_text(output.get('text') or data.get('text/plain')).strip()
+                if output_text:
+                    shortened = output_text[:NOTEBOOK_OUTPUT_TEXT_CHARS] + (" ..." if len(output_text) > NOTEBOOK_OUTPUT_TEXT_CHARS else "")
+                    cell_lines.append("# Out: " + shortened.replace('\n', '\n# '))
+                elif data:
+                    cell_lines.append(f"# Out: [{', '.join(sorted(data))} output omitted]")
+            parts.append('\n'.join(cell_lines))
+    except (OSError, ValueError) as e:
+        print(f"Error reading notebook {file_path}: {e}")
+        return None, [], None
+    return '\n\n'.join(parts), plot_images, stats
+ 
+def read_project_text(file_path):
+    """The full text of a collected project file, read the way collect_project_content reads it (notebooks as cells, documents as extracted text)."""
+    lower_name = file_path.lower()
+    if lower_name.endswith(NOTEBOOK_EXTENSION): return read_notebook(file_path, max_images=0)[0]
+    if lower_name.endswith('.pdf'): return read_pdf(file_path)
+    if lower_name.endswith('.docx'): return read_docx(file_path)
+    if lower_name.endswith('.pptx'): return read_pptx(file_path)
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f: return f.read()
+
+def read_requirements_file(file_path):
+    """Reads a requirements document (.docx, .pdf or .pptx), returns None on error or unsupported type."""
+    file_path_lower = file_path.lower()
+    if file_path_lower.endswith('.docx'): return read_docx(file_path)
+    if file_path_lower.endswith('.pdf'): return read_pdf(file_path)
+    if file_path_lower.endswith('.pptx'): return read_pptx(file_path)
+    print(f"Unsupported requirements file type: {file_path}")
+    return None
+ 
+def read_requirements_pages(file_path):
+    """Like read_requirements_file, but one string per PDF page or PPTX slide (a DOCX is a single page)."""
+    file_path_lower = file_path.lower()
+    if file_path_lower.endswith('.pdf'): return read_pdf_pages(file_path)
+    if file_path_lower.endswith('.pptx'): return read_pptx_slides(file_path)
+    text = read_requirements_file(file_path)
+    return None if text is None else [text]
+ 
+def create_azure_chat_client():
+    """
+    Builds the Azure OpenAI chat client from the AZURE_OPENAI_* environment variables, or returns None.
+    When AZURE_OPENAI_DEPLOYMENT_POOL is set, a load-balanced DeploymentPool is returned instead.
+    Either is wrapped in a HedgedChatClient when GRADING_HEDGE_BUDGET_PERCENT is set (see hedging.py).
+    """
+    pool_config = os.getenv("AZURE_OPENAI_DEPLOYMENT_POOL")
+    if pool_config:
+        pool = load_deployment_pool(pool_config)
+        if pool: return wrap_with_hedging(pool)
+        print("Deployment pool could not be loaded; falling back to the single configured deployment.")
+    endpoint, api_key = os.getenv("AZURE_OPENAI_ENDPOINT"), os.getenv("AZURE_OPENAI_API_KEY")
+    deployment_name, api_version = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"), os.getenv("AZURE_OPENAI_API_VERSION")
+    if not all([endpoint, api_key, deployment_name, api_version]):
+        print("Azure OpenAI chat credentials are not fully set in .env file. AI chat features will be disabled.")
+        return None
+    try:
+        from openai import AzureOpenAI
+        chat_client = AzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version=api_version)
+        print("Azure OpenAI chat client initialized successfully.")
+        return wrap_with_hedging(chat_client)
+    except Exception as e:
+        print(f"Error initializing Azure OpenAI chat client: {e}")
+        return None
  
 def _identify_rubric_columns(df_rubric):
     """
@@ -222,59 +543,285 @@ def encode_image_to_base64(image_path):
         print(f"Error encoding image {image_path}: {e}")
         return None
  
+def _shannon_entropy(text):
+    """Returns the Shannon entropy of a string in bits per character."""
+    if not text: return 0.0
+    counts = collections.Counter(text)
+    total = len(text)
+    return -sum((n / total) * math.log2(n / total) for n in counts.values())
+ 
+def _load_gitignore_rules(dir_path):
+    """Parses a .gitignore in dir_path into (base_dir, pattern, negated, dir_only) rules."""
+    rules = []
+    gitignore_path = os.path.join(dir_path, '.gitignore')
+    if not os.path.isfile(gitignore_path): return rules
+    try:
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                pattern = line.strip()
+                if not pattern or pattern.startswith('#'): continue
+                negated = pattern.startswith('!')
+                if negated: pattern = pattern[1:]
+                dir_only = pattern.endswith('/')
+                pattern = pattern.rstrip('/')
+                if pattern: rules.append((dir_path, pattern, negated, dir_only))
+    except Exception as e:
+        print(f"Error reading .gitignore in {dir_path}: {e}")
+    return rules
+ 
+def _is_gitignored(item_path, is_dir, gitignore_rules):
+    """Applies the submission's own .gitignore rules (last matching rule wins, like git)."""
+    ignored = False
+    for base_dir, pattern, negated, dir_only in gitignore_rules:
+        if dir_only and not is_dir: continue
+        relative_path = os.path.relpath(item_path, base_dir).replace(os.sep, '/')
+        if relative_path.startswith('..'): continue
+        if '/' in pattern: # Anchored to the directory holding the .gitignore
+            matched = fnmatch.fnmatch(relative_path, pattern.lstrip('/')) or fnmatch.fnmatch(relative_path, pattern.lstrip('/') + '/*')
+        else:
+            matched = any(fnmatch.fnmatch(part, pattern) for part in relative_path.split('/'))
+        if matched: ignored = not negated
+    return ignored
+ 
+def _directory_size(dir_path):
+    total = 0
+    for root, _, files in os.walk(dir_path):
+        for name in files:
+            try: total += os.path.getsize(os.path.join(root, name))
+            except OSError: pass
+    return total
+ 
+def classify_project_file(item_path, item_name):
+    """
+    Decides whether a text-like project file is worth sending to the AI, reading at most
+    CLASSIFIER_SAMPLE_BYTES of it. Returns ('keep' | 'demote' | 'drop', reason or None).
+    """
+    name_lower = item_name.lower()
+    if name_lower in GENERATED_FILE_NAMES: return 'drop', 'lockfile'
+    if name_lower.endswith(GENERATED_FILE_SUFFIXES): return 'drop', 'minified or generated bundle'
+    if not name_lower.endswith(TEXT_FILE_EXTENSIONS): return 'keep', None # Documents are judged by their extracted text
+    try:
+        with open(item_path, 'r', encoding='utf-8', errors='ignore') as f: sample = f.read(CLASSIFIER_SAMPLE_BYTES)
+    except Exception as e:
+        print(f"Error sampling file {item_path}: {e}")
+        return 'keep', None
+    lines = sample.splitlines() or ['']
+    # Too little text to judge line shape reliably; data files (one-line JSON, JSON-lines logs) are sampled instead
+    if len(sample) >= 1000 and not name_lower.endswith(SAMPLED_FILE_EXTENSIONS):
+        avg_line_length = len(sample) / len(lines)
+        if avg_line_length > MINIFIED_AVG_LINE_LENGTH or max(len(line) for line in lines) > MINIFIED_MAX_LINE_LENGTH:
+            return 'drop', 'minified (very long lines)'
+        if _shannon_entropy(sample) > HIGH_ENTROPY_BITS_PER_CHAR:
+            return 'drop', 'high-entropy data blob'
+    header = '\n'.join(lines[:10]).lower()
+    if any(marker in header for marker in GENERATED_CODE_MARKERS): return 'demote', 'generated-code marker'
+    if VENDORED_LIBRARY_PATTERN.match(name_lower): return 'demote', 'vendored library'
+    return 'keep', None
+ 
+def file_sha256(file_path):
+    """Streams a file through SHA-256 so large bodies are never held in memory."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+ 
+def _find_duplicate_file(item_path, relative_file_path, size_bytes, files_by_size):
+    """
+    Returns the relative path of an identical file collected earlier, or None.
+    Files are only hashed when another file of the same size has been seen, so unique files cost nothing extra.
+    """
+    peers = files_by_size.setdefault(size_bytes, [])
+    if not peers:
+        peers.append({"path": item_path, "relative_path": relative_file_path, "hash": None})
+        return None
+    try:
+        digest = file_sha256(item_path)
+        for peer in peers:
+            if peer['hash'] is None: peer['hash'] = file_sha256(peer['path'])
+            if peer['hash'] == digest: return peer['relative_path']
+    except OSError as e:
+        print(f"Error hashing file {relative_file_path}: {e}")
+        return None
+    peers.append({"path": item_path, "relative_path": relative_file_path, "hash": digest})
+    return None
+ 
+def _zip_mirrors_existing_tree(zip_path):
+    """
+    True when every member of a nested ZIP already exists, with the same size, next to the archive
+    (either beside it or in the folder named after it) - i.e. the archive was shipped alongside its own extraction.
+    """
+    parent_dir = os.path.dirname(zip_path)
+    candidate_roots = [parent_dir, os.path.splitext(zip_path)[0]]
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = [info for info in zip_ref.infolist() if not info.is_dir()]
+    except Exception as e:
+        print(f"Error inspecting nested archive {zip_path}: {e}")
+        return False
+    if not members: return False
+    for root in candidate_roots:
+        if all(os.path.isfile(os.path.join(root, info.filename)) and os.path.getsize(os.path.join(root, info.filename)) == info.file_size for info in members):
+            return True
+    return False
+ 
+def _record_duplicate(collection_report, canonical_path, relative_file_path, size_bytes):
+    collection_report['duplicate_aliases'].setdefault(canonical_path, []).append(relative_file_path)
+    collection_report['duplicate_bytes_skipped'] += size_bytes
+ 
+def summarize_duplicate_aliases(duplicate_aliases, sent_files=None, min_mirrored_files=3):
+    """
+    Compacts {canonical_path: [alias_paths]} into short lines for the prompt. Whole mirrored trees
+    (e.g. the same project under two extracted_project_* folders) collapse into one 'A/ == B/' line.
+    With sent_files (the {path: content} the prompt carries), copies of a file that is not in it are left out.
+    """
+    mirror_pairs = collections.defaultdict(list)
+    for canonical_path, aliases in duplicate_aliases.items():
+        if sent_files is not None and not sent_files.get(canonical_path): continue # Cut by the budget, or empty
+        canonical_parts = canonical_path.replace(os.sep, '/').split('/')
+        for alias in aliases:
+            alias_parts = alias.replace(os.sep, '/').split('/')
+            common = 0
+            while common < min(len(canonical_parts), len(alias_parts)) - 1 and canonical_parts[-1 - common] == alias_parts[-1 - common]:
+                common += 1
+            key = ('/'.join(alias_parts[:len(alias_parts) - common]), '/'.join(canonical_parts[:len(canonical_parts) - common]))
+            mirror_pairs[key].append((alias, canonical_path))
+    lines = []
+    for (alias_prefix, canonical_prefix), pairs in mirror_pairs.items():
+        if len(pairs) >= min_mirrored_files:
+            lines.append(f"{alias_prefix}/ == {canonical_prefix}/ ({len(pairs)} identical files)")
+        else:
+            lines.extend(f"{alias} == {canonical_path}" for alias, canonical_path in pairs)
+    return lines
+ 
+def _record_dropped(collection_report, relative_path, reason, size_bytes):
+    collection_report['dropped_files'].append({"path": relative_path, "reason": reason, "bytes": size_bytes})
+    collection_report['bytes_saved'] += size_bytes
+ 
 def collect_project_content(top_level_extracted_base_dir):
+    """
+    Walks the extracted submission and gathers text content, screenshots and video names for the AI.
+    Returns (text_files_content, image_messages, video_files, collection_report) where
+    collection_report lists generated/vendored files that were dropped or demoted and the bytes saved,
+    plus byte-identical copies (read and sent only once) keyed by the path that was kept, and
+    file_paths, every file seen in the submission (used by the local checks engine). Large logs and data
+    files are read as sampled excerpts (see read_sampled_data_file) and listed in sampled_files; notebooks
+    are reduced to their cells (see read_notebook) and listed in notebooks. Hand-written files that did not
+    fit MAX_TOTAL_AI_TEXT_CHARS, or were truncated to fit, are listed in overflow_files for summarization.
+    """
     all_text_file_candidates, image_messages_for_ai, video_files_detected = [], [], []
+    collection_report = {"dropped_files": [], "demoted_files": [], "bytes_saved": 0, "duplicate_aliases": {}, "duplicate_bytes_skipped": 0, "sampled_files": [], "notebooks": [], "file_paths": [], "overflow_files": []}
     image_count = 0
     scan_queue = collections.deque([top_level_extracted_base_dir])
     processed_zip_archives = set()
+    gitignore_rules = []
+    files_by_size = {}
     while scan_queue:
+        check_cancelled() # Large submissions take a while to walk; stop once per directory if the job was cancelled
         current_dir_to_scan = scan_queue.popleft()
+        gitignore_rules.extend(_load_gitignore_rules(current_dir_to_scan))
         for entry in os.scandir(current_dir_to_scan):
             item_path, item_name = entry.path, entry.name
             relative_file_path = os.path.relpath(item_path, top_level_extracted_base_dir)
             if entry.is_dir():
-                if item_name not in ['__pycache__', '.idea', '.venv', 'node_modules', '.git', 'dist', 'build']:
+                if item_name in SKIPPED_DIR_NAMES: continue
+                if item_name.lower() in VENDORED_DIR_NAMES:
+                    _record_dropped(collection_report, relative_file_path + '/', 'vendored directory', _directory_size(item_path))
+                elif _is_gitignored(item_path, True, gitignore_rules):
+                    _record_dropped(collection_report, relative_file_path + '/', 'ignored by submission .gitignore', _directory_size(item_path))
+                else:
                     scan_queue.append(item_path)
-            elif "__MACOSX" in item_path or item_name.startswith("._") or item_name == ".DS_Store":
                 continue
-            elif item_name.lower().endswith('.zip'):
+            if "__MACOSX" in item_path or item_name.startswith("._") or item_name == ".DS_Store":
+                continue
+            if entry.is_file(): collection_report['file_paths'].append(relative_file_path)
+            if item_name.lower().endswith('.zip'):
                 if os.path.abspath(item_path) not in processed_zip_archives:
+                    processed_zip_archives.add(os.path.abspath(item_path))
+                    canonical_path = _find_duplicate_file(item_path, relative_file_path, entry.stat().st_size, files_by_size)
+                    if canonical_path:
+                        _record_duplicate(collection_report, canonical_path, relative_file_path, entry.stat().st_size)
+                        continue
+                    if _zip_mirrors_existing_tree(item_path):
+                        print(f"Skipping nested archive (already extracted alongside): {relative_file_path}")
+                        continue
                     nested_extract_dir = os.path.join(os.path.dirname(item_path), os.path.splitext(item_name)[0] + "_extracted_nested")
                     os.makedirs(nested_extract_dir, exist_ok=True)
                     if unzip_file(item_path, nested_extract_dir):
                         scan_queue.append(nested_extract_dir)
-                    processed_zip_archives.add(os.path.abspath(item_path))
             elif entry.is_file() and entry.stat().st_size > MAX_FILE_SIZE_FOR_AI_PROCESSING:
                 print(f"Skipping file (too large): {relative_file_path}")
             elif item_name.lower().endswith(ALLOWED_IMAGE_EXTENSIONS) and image_count < 5:
+                canonical_path = _find_duplicate_file(item_path, relative_file_path, entry.stat().st_size, files_by_size)
+                if canonical_path:
+                    _record_duplicate(collection_report, canonical_path, relative_file_path, entry.stat().st_size)
+                    continue
                 encoded_image = encode_image_to_base64(item_path)
                 if encoded_image:
                     mime_type = mimetypes.guess_type(item_name)[0] or 'image/jpeg'
                     image_messages_for_ai.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}", "detail": "auto"}})
                     image_count += 1
-            elif item_name.lower().endswith(TEXT_FILE_EXTENSIONS + DOCUMENT_PROJECT_EXTENSIONS):
-                content = None
+            elif item_name.lower().endswith(TEXT_FILE_EXTENSIONS + SAMPLED_FILE_EXTENSIONS + DOCUMENT_PROJECT_EXTENSIONS + (NOTEBOOK_EXTENSION,)):
+                gitignored = item_name != '.gitignore' and _is_gitignored(item_path, False, gitignore_rules)
+                if gitignored and not item_name.lower().endswith(SAMPLED_FILE_EXTENSIONS):
+                    _record_dropped(collection_report, relative_file_path, 'ignored by submission .gitignore', entry.stat().st_size)
+                    continue
+                verdict, reason = classify_project_file(item_path, item_name)
+                if gitignored and verdict != 'drop': # Ignored logs and datasets are often what the project analyzes
+                    verdict, reason = 'demote', 'data file ignored by submission .gitignore'
+                if verdict == 'drop':
+                    _record_dropped(collection_report, relative_file_path, reason, entry.stat().st_size)
+                    continue
+                canonical_path = _find_duplicate_file(item_path, relative_file_path, entry.stat().st_size, files_by_size)
+                if canonical_path:
+                    _record_duplicate(collection_report, canonical_path, relative_file_path, entry.stat().st_size)
+                    continue
+                content, sampled, is_manifest = None, False, item_name.lower() in MANIFEST_FILENAMES
                 try:
-                    if item_name.lower().endswith(TEXT_FILE_EXTENSIONS):
+                    if item_name.lower().endswith(SAMPLED_FILE_EXTENSIONS) and not is_manifest and entry.stat().st_size > MAX_INDIVIDUAL_FILE_TRUNCATION_CHARS:
+                        content, sample_stats = read_sampled_data_file(item_path)
+                        sampled = True
+                        if content: collection_report['sampled_files'].append(dict(sample_stats, path=relative_file_path))
+                    elif item_name.lower().endswith(TEXT_FILE_EXTENSIONS + SAMPLED_FILE_EXTENSIONS):
                         with open(item_path, 'r', encoding='utf-8', errors='ignore') as f: content = f.read()
+                    elif item_name.lower().endswith(NOTEBOOK_EXTENSION):
+                        content, plot_images, notebook_stats = read_notebook(item_path, max_images=max(0, min(NOTEBOOK_MAX_PLOT_IMAGES, 5 - image_count)))
+                        for mime_type, image_data in plot_images:
+                            image_messages_for_ai.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_data}", "detail": "auto"}})
+                            image_count += 1
+                        if notebook_stats: collection_report['notebooks'].append(dict(notebook_stats, path=relative_file_path, images_sent=len(plot_images)))
                     elif item_name.lower().endswith('.pdf'): content = read_pdf(item_path)
                     elif item_name.lower().endswith('.docx'): content = read_docx(item_path)
                     elif item_name.lower().endswith('.pptx'): content = read_pptx(item_path)
-                    if content: all_text_file_candidates.append({"path": relative_file_path, "content": content})
+                    if content:
+                        all_text_file_candidates.append({"path": relative_file_path, "content": content, "demoted": verdict == 'demote', "sampled": sampled,
+                                                         "max_chars": MANIFEST_MAX_CHARS if is_manifest else MAX_INDIVIDUAL_FILE_TRUNCATION_CHARS})
+                        if verdict == 'demote':
+                            collection_report['demoted_files'].append({"path": relative_file_path, "reason": reason, "bytes": entry.stat().st_size})
                 except Exception as e:
                     print(f"Error processing file {relative_file_path}: {e}")
             elif item_name.lower().endswith(ALLOWED_VIDEO_EXTENSIONS):
                 video_files_detected.append(relative_file_path)
     collected_text_for_ai = {}
     current_total_text_chars = 0
-    all_text_file_candidates.sort(key=lambda x: len(x['content']))
+    budget_exhausted = False
+    # Hand-written files first (smallest first), demoted generated/vendored files only if budget remains
+    all_text_file_candidates.sort(key=lambda x: (x['demoted'], len(x['content'])))
     for file_info in all_text_file_candidates:
-        truncated_content = file_info['content'][:MAX_INDIVIDUAL_FILE_TRUNCATION_CHARS]
-        if current_total_text_chars + len(truncated_content) <= MAX_TOTAL_AI_TEXT_CHARS:
+        truncated_content = file_info['content'][:file_info['max_chars']]
+        budget_exhausted = budget_exhausted or current_total_text_chars + len(truncated_content) > MAX_TOTAL_AI_TEXT_CHARS
+        if not budget_exhausted:
             collected_text_for_ai[file_info['path']] = truncated_content
             current_total_text_chars += len(truncated_content)
-        else: break
-    return collected_text_for_ai, image_messages_for_ai, video_files_detected
+        # Hand-written code the grader sees only partly or not at all can still be covered by a summary
+        if not file_info['demoted'] and not file_info['sampled'] and (budget_exhausted or len(truncated_content) < len(file_info['content'])):
+            collection_report['overflow_files'].append({"path": file_info['path'], "chars": len(file_info['content']),
+                                                        "sent_chars": 0 if budget_exhausted else len(truncated_content)})
+    print(f"Content classifier: dropped {len(collection_report['dropped_files'])} items "
+          f"({collection_report['bytes_saved']} bytes saved), demoted {len(collection_report['demoted_files'])} files, "
+          f"skipped {sum(len(a) for a in collection_report['duplicate_aliases'].values())} duplicate copies "
+          f"({collection_report['duplicate_bytes_skipped']} bytes).")
+    return collected_text_for_ai, image_messages_for_ai, video_files_detected, collection_report
  
 def safe_numeric_score(score_input):
     if score_input is None or pd.isna(score_input): return 0.0
@@ -285,21 +832,19 @@ def safe_numeric_score(score_input):
         return float(score_input)
     except (ValueError, TypeError): return 0.0
  
-@retry(wait=wait_random_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(5))
+# The call is streamed so a cancelled job (see cancellation.py) closes it mid-response; it never sleeps into another attempt
+@retry(wait=wait_random_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(5), sleep=cancellable_sleep)
 def _call_openai_with_retries(chat_client, messages, model_name, temperature, max_tokens, response_format):
     import openai
     try:
-        response = chat_client.chat.completions.create(model=model_name, messages=messages, temperature=temperature, max_tokens=max_tokens, response_format=response_format)
+        response = call_cancellable(streamed_completion, chat_client.chat.completions.create, model=model_name, messages=messages, temperature=temperature, max_tokens=max_tokens, response_format=response_format)
         return response
     except (openai.APIConnectionError, openai.RateLimitError, openai.APITimeoutError) as e:
         print(f"OpenAI API error (retriable): {e}"); raise
     except Exception as e:
         print(f"Unexpected error during OpenAI call: {e}"); raise
  
-def generate_grading_with_openai(chat_client, original_rubric_dataframe, rubric_data_markdown_for_ai, requirements_text, project_text_files_content, image_messages_for_ai, has_video):
-    if not chat_client: return "Azure OpenAI chat client not initialized.", [], {"total_score": "N/A", "overall_feedback": "AI grading skipped."}
-    col_map = getattr(original_rubric_dataframe, '_identified_columns', {}); actual_criteria_col_name = col_map.get('criterion_col'); actual_max_score_col_name = col_map.get('max_score_col')
-    if not actual_criteria_col_name: return "Failed to identify grading criteria.", [], {"total_score": "N/A", "overall_feedback": "Could not identify grading criteria."}
+def _build_criteria_for_ai(original_rubric_dataframe, actual_criteria_col_name, actual_max_score_col_name):
     criteria_for_ai_list = []
     gradeable_rubric = original_rubric_dataframe[~original_rubric_dataframe['is_summary_row']].copy()
     gradeable_rubric.dropna(subset=[actual_criteria_col_name], inplace=True)
@@ -312,90 +857,540 @@ def generate_grading_with_openai(chat_client, original_rubric_dataframe, rubric_
             if col not in [actual_criteria_col_name, actual_max_score_col_name, 'is_summary_row', 'index'] and pd.notna(val):
                 criterion_info[str(col).replace(" ", "_").lower()] = str(val).strip()
         criteria_for_ai_list.append(criterion_info)
+    return criteria_for_ai_list
+ 
+def _rubric_key(column_name):
+    """The key a rubric column gets in the criteria dicts built by _build_criteria_for_ai."""
+    return str(column_name).replace(" ", "_").lower() if column_name else None
+
+def compact_criteria_json(criteria_for_ai_list, rubric_columns=None):
+    """
+    Minified JSON of the criteria: rows of [criterion_id, criterion_name, max_score, <guidance columns>] grouped by
+    the rubric's category/parameters columns, with values shared by every criterion stated once under "common".
+    Serial numbers and grader-filled columns (marks obtained, remarks) are left out.
+    """
+    rubric_columns = rubric_columns or {}
+    group_keys = [key for key in (_rubric_key(rubric_columns.get('category_col')), _rubric_key(rubric_columns.get('parameters_col'))) if key]
+    detail_keys = []
+    for criterion in criteria_for_ai_list:
+        for key in criterion:
+            if key not in ('criterion_id', 'criterion_name', 'max_score') and key not in group_keys and key not in detail_keys \
+                    and not NON_GRADING_RUBRIC_KEY_PATTERN.match(key):
+                detail_keys.append(key)
+    common = {}
+    if len(criteria_for_ai_list) > 1:
+        for key in group_keys + detail_keys:
+            values = {criterion.get(key) for criterion in criteria_for_ai_list}
+            if len(values) == 1 and None not in values: common[key] = values.pop()
+    group_keys = [key for key in group_keys if key not in common]
+    detail_keys = [key for key in detail_keys if key not in common]
+    groups = {}
+    for criterion in criteria_for_ai_list:
+        group_id = tuple(criterion.get(key) for key in group_keys)
+        group = groups.setdefault(group_id, dict({key: value for key, value in zip(group_keys, group_id) if value is not None}, criteria=[]))
+        details = ["" if criterion.get(key) in (None, criterion['criterion_name']) else criterion[key] for key in detail_keys]
+        group['criteria'].append([criterion['criterion_id'], criterion['criterion_name'], criterion.get('max_score')] + details)
+    document = {"columns": ['criterion_id', 'criterion_name', 'max_score'] + detail_keys, "groups": list(groups.values())}
+    if common: document["common"] = common
+    return json.dumps(document, separators=(',', ':'), ensure_ascii=False)
+
+def _build_grading_prompt(rubric_data_markdown_for_ai, criteria_for_ai_list, requirements_text, project_content_text, image_count, video_guidance_text, request_confidence=False, rubric_columns=None):
+    if GRADING_PROMPT_STYLE == 'legacy':
+        return _build_legacy_grading_prompt(rubric_data_markdown_for_ai, criteria_for_ai_list, requirements_text, project_content_text, image_count, video_guidance_text, request_confidence)
+    confidence_field = ',"confidence":<0.0-1.0, how certain you are of the score given the evidence>' if request_confidence else ''
+    return f"""You are an expert software project grader. Grade the project against EVERY criterion below, using the requirements and project files.
+**Criteria to Grade:** (rows in each group follow "columns"; "common" applies to every criterion)
+```json
+{compact_criteria_json(criteria_for_ai_list, rubric_columns)}
+```
+**Project Requirements:**\n{requirements_text}
+**Project Content:**\n{project_content_text}End of Project Content.
+**Visual Analysis:** {image_count} UI screenshots are provided. {video_guidance_text}
+---
+Output STRICTLY one JSON object and nothing else:
+{{"overall_total_score":<number>,"overall_feedback":"<summary of the project's performance>","grades":[{{"criterion_id":<id>,"criterion_name":"<name>","score_achieved":<number>,"comments":"<specific justification>"{confidence_field}}}]}}
+Return one grade per criterion; `criterion_id` and `criterion_name` MUST exactly match the list.
+"""
+
+def _build_legacy_grading_prompt(rubric_data_markdown_for_ai, criteria_for_ai_list, requirements_text, project_content_text, image_count, video_guidance_text, request_confidence=False):
     criteria_list_str = json.dumps(criteria_for_ai_list, indent=2)
-    video_guidance_text = "Video file detected. Assume video-related criteria are met." if has_video else ""
-    main_prompt_text = f"""You are an expert software project grader. Evaluate a project based on the rubric, requirements, and project files.
+    confidence_field = ', "confidence": 0.9' if request_confidence else ''
+    confidence_instruction = ("\nFor each grade also report `confidence` (0.0-1.0): how certain you are that the score is correct given the evidence you can see."
+                              if request_confidence else "")
+    return f"""You are an expert software project grader. Evaluate a project based on the rubric, requirements, and project files.
 **Evaluation Rubric (for context):**\n{rubric_data_markdown_for_ai}
 **List of Specific Criteria to Grade:**\nThis is the definitive list. You MUST provide a grade for EACH object in this JSON array.\n```json\n{criteria_list_str}\n```
 **Project Requirements:**\n{requirements_text}
-**Project Content:**\n(Code, configs, etc. from the project submission follow)\n{''.join(f"File: {filename}\\n```\\n{content}\\n```\\n" for filename, content in project_text_files_content.items())}End of Project Content.
-**Visual Analysis:**\n{len(image_messages_for_ai)} UI screenshots are provided. {video_guidance_text}
+**Project Content:**\n(Code, configs, etc. from the project submission follow)\n{project_content_text}End of Project Content.
+**Visual Analysis:**\n{image_count} UI screenshots are provided. {video_guidance_text}
 ---
-**Grading Task:**\nProvide a grade for EACH criterion from the "List of Specific Criteria to Grade".
+**Grading Task:**\nProvide a grade for EACH criterion from the "List of Specific Criteria to Grade".{confidence_instruction}
 **Output your response STRICTLY as a single JSON object. Do not include any other text.**
 The JSON object must have this structure:
 ```json
 {{
     "overall_total_score": "Total calculated score (numeric if possible)",
     "overall_feedback": "A comprehensive summary of the project's performance.",
-    "grades": [ {{ "criterion_id": 0, "criterion_name": "The EXACT name of the criterion from the list", "score_achieved": 4.0, "comments": "Specific justification for this score." }} ]
+    "grades": [ {{ "criterion_id": 0, "criterion_name": "The EXACT name of the criterion from the list", "score_achieved": 4.0, "comments": "Specific justification for this score."{confidence_field} }} ]
 }}
 ```
 **CRITICAL:** The `criterion_id` in your output MUST EXACTLY MATCH the `criterion_id` from the list I provided. This is essential for matching results. The `criterion_name` should also be returned exactly as provided.
 """
-    messages_for_ai = [{"role": "system", "content": "You are a precise grader outputting structured JSON."}, {"role": "user", "content": [{"type": "text", "text": main_prompt_text}] + image_messages_for_ai}]
+ 
+def _salvage_grading_json(raw_text):
+    """
+    Parses a grading response. If the JSON is truncated (e.g. cut off at max_tokens), every complete
+    object in the "grades" array is still recovered, along with the overall fields if they were emitted.
+    Returns (parsed_result, was_salvaged).
+    """
     try:
-        response = _call_openai_with_retries(chat_client, messages_for_ai, os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"), 0.4, 4000, {"type": "json_object"})
-        parsed_result = json.loads(response.choices[0].message.content)
-        overall_result = {"total_score": parsed_result.get("overall_total_score", "N/A"), "overall_feedback": parsed_result.get("overall_feedback", "N/A")}
-        grading_breakdown = parsed_result.get("grades", [])
-        return None, grading_breakdown, overall_result
+        return json.loads(raw_text), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+    raw_text = raw_text or ""
+    decoder = json.JSONDecoder()
+    parsed_result = {"grades": []}
+    for key in ('overall_total_score', 'overall_feedback'):
+        key_match = re.search(rf'"{key}"\s*:\s*', raw_text)
+        if key_match:
+            try: parsed_result[key], _ = decoder.raw_decode(raw_text, key_match.end())
+            except json.JSONDecodeError: pass
+    grades_match = re.search(r'"grades"\s*:\s*\[', raw_text)
+    position = grades_match.end() if grades_match else len(raw_text)
+    while position < len(raw_text):
+        while position < len(raw_text) and raw_text[position] in ' \t\r\n,': position += 1
+        if position >= len(raw_text) or raw_text[position] != '{': break
+        try:
+            grade, position = decoder.raw_decode(raw_text, position)
+        except json.JSONDecodeError:
+            break # The truncated tail
+        parsed_result["grades"].append(grade)
+    print(f"Salvaged {len(parsed_result['grades'])} complete grade objects from a malformed/truncated AI response.")
+    return parsed_result, True
+ 
+def build_grading_messages(prompt_text, image_messages_for_ai):
+    return [{"role": "system", "content": "You are a precise grader outputting structured JSON."}, {"role": "user", "content": [{"type": "text", "text": prompt_text}] + image_messages_for_ai}]
+
+def grading_prompt_for(grading_request, criteria_to_grade, request_confidence=False):
+    """The grading prompt of a prepared request, restricted to criteria_to_grade."""
+    return _build_grading_prompt(grading_request["rubric_markdown"], criteria_to_grade, grading_request["requirements_text"], grading_request["project_content_text"],
+                                 len(grading_request["image_messages"]), grading_request["video_guidance_text"], request_confidence=request_confidence,
+                                 rubric_columns=grading_request.get("rubric_columns"))
+
+def _grade_with_deployment(chat_client, deployment_name, prompt_text, image_messages_for_ai, max_tokens=4000):
+    """Runs one grading call and returns (parsed_result, tier_stats)."""
+    messages_for_ai = build_grading_messages(prompt_text, image_messages_for_ai)
+    started = time.perf_counter()
+    response = _call_openai_with_retries(chat_client, messages_for_ai, deployment_name, 0.4, max_tokens, {"type": "json_object"})
+    usage = getattr(response, 'usage', None)
+    parsed_result, was_salvaged = _salvage_grading_json(response.choices[0].message.content)
+    tier_stats = {
+        "deployment": deployment_name,
+        "latency_seconds": round(time.perf_counter() - started, 3),
+        "prompt_tokens": getattr(usage, 'prompt_tokens', None),
+        "completion_tokens": getattr(usage, 'completion_tokens', None),
+        "truncated": getattr(response.choices[0], 'finish_reason', None) == 'length',
+        "salvaged": was_salvaged,
+    }
+    return parsed_result, tier_stats
+ 
+def _merge_grades(parsed_result, criteria_by_id, grades_by_id, require_valid=True):
+    """Copies grades for known criteria into grades_by_id, normalizing ids the model returned as strings."""
+    for grade in parsed_result.get("grades", []):
+        if not isinstance(grade, dict): continue
+        criterion_id = grade.get('criterion_id')
+        if isinstance(criterion_id, str) and criterion_id.strip().lstrip('-').isdigit():
+            grade['criterion_id'] = int(criterion_id.strip())
+        if require_valid and _grade_schema_error(grade, criteria_by_id) is not None: continue
+        if grade.get('criterion_id') in criteria_by_id:
+            grades_by_id[grade['criterion_id']] = grade
+ 
+def merge_grading_response(raw_text, grading_request, grades_by_id, require_valid=True):
+    """Parses (or salvages) one raw grading response and merges its grades into grades_by_id. Returns the parsed result."""
+    parsed_result, _ = _salvage_grading_json(raw_text)
+    _merge_grades(parsed_result, {criterion['criterion_id']: criterion for criterion in grading_request["criteria_for_ai"]}, grades_by_id, require_valid)
+    return parsed_result
+
+def follow_up_grading_request(grading_request, missing_criteria):
+    """
+    A reduced copy of grading_request for re-asking only missing_criteria: no screenshots, and only the project files
+    whose path or content mention the criteria's keywords (best matches first, up to FOLLOW_UP_CONTENT_CHARS); the
+    rest are listed by name. The requirements and rubric guidance for those criteria are kept.
+    """
+    keywords = set()
+    for criterion in missing_criteria:
+        for key, value in criterion.items():
+            if key != 'criterion_id' and isinstance(value, str):
+                keywords.update(word for word in re.findall(r'[a-z][a-z0-9_]{3,}', value.lower()) if word not in FOLLOW_UP_KEYWORD_STOPWORDS)
+    files = grading_request["project_text_files_content"]
+    def relevance(filename):
+        filename_lower, content_lower = filename.lower(), files[filename].lower()
+        return sum(3 * (keyword in filename_lower) + min(content_lower.count(keyword), 5) for keyword in keywords)
+    scores = {filename: relevance(filename) for filename in files}
+    selected, selected_chars = {}, 0
+    matched = any(scores.values()) # Without a single match, fall back to the files in their usual order
+    for filename in sorted(files, key=scores.get, reverse=True):
+        if (scores[filename] or not matched) and selected_chars + len(files[filename]) <= FOLLOW_UP_CONTENT_CHARS:
+            selected[filename] = files[filename]
+            selected_chars += len(files[filename])
+    project_content_text = _render_project_content(selected, {})
+    if len(selected) < len(files):
+        project_content_text += f"Other project files (not shown): {file_manifest([filename for filename in files if filename not in selected])}\n"
+    return dict(grading_request, project_content_text=project_content_text, image_messages=[])
+
+def missing_ai_criteria(grading_request, grades_by_id):
+    return [criterion for criterion in grading_request["criteria_for_ai"] if criterion['criterion_id'] not in grades_by_id]
+
+def finalize_grading(grading_request, grades_by_id, overall_feedback, grading_stats):
+    """Adds the local-check grades and orders everything by rubric row. Returns (None, grading_breakdown, overall_result)."""
+    grades_by_id = dict(grades_by_id)
+    grades_by_id.update(grading_request["local_grades"])
+    grading_breakdown = [grades_by_id[criterion['criterion_id']] for criterion in grading_request["all_criteria"] if criterion['criterion_id'] in grades_by_id]
+    total_score = sum(safe_numeric_score(grade.get('score_achieved')) for grade in grading_breakdown)
+    return None, grading_breakdown, {"total_score": total_score, "overall_feedback": overall_feedback or "N/A", "grading_stats": grading_stats}
+
+def _grade_schema_error(grade, criteria_by_id):
+    """Returns why a returned grade object is unusable, or None if it is valid."""
+    if not isinstance(grade, dict): return "not an object"
+    criterion = criteria_by_id.get(grade.get('criterion_id'))
+    if criterion is None: return "unknown criterion_id"
+    score = grade.get('score_achieved')
+    if isinstance(score, bool) or not isinstance(score, (int, float, str)): return "missing score"
+    try: score = float(score)
+    except ValueError: return "non-numeric score"
+    if score < 0 or ('max_score' in criterion and score > criterion['max_score']): return "score out of range"
+    return None
+ 
+def _cascade_settings():
+    """Read at call time because app.py loads .env after importing this module."""
+    strong_deployment = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")
+    fast_deployment = os.getenv("AZURE_OPENAI_FAST_DEPLOYMENT_NAME")
+    try: threshold = float(os.getenv("GRADING_CASCADE_CONFIDENCE_THRESHOLD", "0.7"))
+    except ValueError: threshold = 0.7
+    if fast_deployment == strong_deployment: fast_deployment = None
+    return strong_deployment, fast_deployment, threshold
+ 
+def file_manifest(filenames):
+    """One-line listing of the files grouped by directory, e.g. 'README.md src/{app.py,utils.py} tests/test_app.py'."""
+    names_by_dir = {}
+    for filename in filenames:
+        directory, name = os.path.split(filename.replace('\\', '/'))
+        names_by_dir.setdefault(directory, []).append(name)
+    return ' '.join(' '.join(names) if not directory else f"{directory}/{names[0]}" if len(names) == 1 else f"{directory}/{{{','.join(names)}}}"
+                    for directory, names in names_by_dir.items())
+
+def _render_project_content(project_text_files_content, duplicate_aliases, project_summaries_text=""):
+    if GRADING_PROMPT_STYLE == 'legacy':
+        project_content_text = ''.join(f"File: {filename}\n```\n{content}\n```\n" for filename, content in project_text_files_content.items())
+    else:
+        project_content_text = f"Manifest ({len(project_text_files_content)} files): {file_manifest(project_text_files_content)}\n" + \
+            ''.join(f"--- {filename} ---\n{content}\n" for filename, content in project_text_files_content.items())
+    duplicate_lines = summarize_duplicate_aliases(duplicate_aliases, project_text_files_content)
+    if duplicate_lines:
+        project_content_text += "Identical copies (shown once above):\n" + "\n".join(f"- {line}" for line in duplicate_lines) + "\n"
+    return project_content_text + (project_summaries_text or "")
+ 
+def prepare_grading_request(original_rubric_dataframe, rubric_data_markdown_for_ai, requirements_text, project_text_files_content, image_messages_for_ai, has_video, duplicate_aliases=None, project_file_paths=None, project_base_dir=None, project_summaries_text="", summary_usage=None):
+    """
+    Runs every local grading step (criteria extraction, local checks, project content rendering) without
+    calling the AI. Returns (error_message, grading_request); the request can be inspected, estimated and
+    downgraded (see apply_admission_control) before grade_prepared_request spends any tokens on it.
+    project_summaries_text (see project_summaries.py) is appended to the project content; summary_usage holds the
+    calls and tokens those summaries cost (or would cost, in a dry run) for the preflight estimate.
+    """
+    col_map = getattr(original_rubric_dataframe, '_identified_columns', {}); actual_criteria_col_name = col_map.get('criterion_col'); actual_max_score_col_name = col_map.get('max_score_col')
+    if not actual_criteria_col_name: return "Failed to identify grading criteria.", None
+    all_criteria_list = _build_criteria_for_ai(original_rubric_dataframe, actual_criteria_col_name, actual_max_score_col_name)
+    local_grades = run_local_checks(all_criteria_list, project_file_paths, project_text_files_content, project_base_dir) if project_file_paths is not None else {}
+    return None, {
+        "rubric_columns": col_map,
+        "all_criteria": all_criteria_list,
+        "criteria_for_ai": [criterion for criterion in all_criteria_list if criterion['criterion_id'] not in local_grades],
+        "local_grades": local_grades,
+        "rubric_markdown": rubric_data_markdown_for_ai,
+        "requirements_text": requirements_text,
+        "project_text_files_content": dict(project_text_files_content),
+        "duplicate_aliases": duplicate_aliases or {},
+        "project_summaries_text": project_summaries_text,
+        "summary_usage": summary_usage or {},
+        "project_content_text": _render_project_content(project_text_files_content, duplicate_aliases or {}, project_summaries_text),
+        "image_messages": list(image_messages_for_ai),
+        "video_guidance_text": "Video file detected. Assume video-related criteria are met." if has_video else "",
+    }
+ 
+_TOKEN_ENCODER = None
+ 
+def estimate_tokens(text):
+    """Counts tokens with tiktoken when it is installed, otherwise approximates ~4 characters per token."""
+    global _TOKEN_ENCODER
+    if not text: return 0
+    if _TOKEN_ENCODER is None:
+        try:
+            import tiktoken
+            _TOKEN_ENCODER = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _TOKEN_ENCODER = False
+    if _TOKEN_ENCODER: return len(_TOKEN_ENCODER.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN_ESTIMATE)
+ 
+def _image_payload_bytes(image_message):
+    return len(image_message.get("image_url", {}).get("url", ""))
+ 
+def estimate_grading_request(grading_request):
+    """
+    Preflight estimate for the main grading call: prompt/completion tokens, image count and payload bytes,
+    and a projected latency from the rough throughput figures above. Nothing is sent to the AI. The tokens
+    of the project summaries made before this call are reported alongside, in the summary_* fields.
+    """
+    criteria_for_ai_list = grading_request["criteria_for_ai"]
+    image_messages_for_ai = grading_request["image_messages"]
+    if not criteria_for_ai_list:
+        prompt_text_tokens = completion_tokens = 0
+    else:
+        prompt_text = grading_prompt_for(grading_request, criteria_for_ai_list)
+        prompt_text_tokens = estimate_tokens(prompt_text)
+        completion_tokens = COMPLETION_TOKENS_BASE_ESTIMATE + COMPLETION_TOKENS_PER_CRITERION_ESTIMATE * len(criteria_for_ai_list)
+    image_tokens = TOKENS_PER_IMAGE_ESTIMATE * len(image_messages_for_ai) if criteria_for_ai_list else 0
+    prompt_tokens = prompt_text_tokens + image_tokens
+    strong_deployment, fast_deployment, _ = _cascade_settings()
+    summary_usage = grading_request.get("summary_usage") or {}
+    return {
+        "criteria_for_ai": len(criteria_for_ai_list),
+        "prompt_tokens": prompt_tokens,
+        "prompt_text_tokens": prompt_text_tokens,
+        "image_tokens": image_tokens,
+        "completion_tokens": completion_tokens,
+        "image_count": len(image_messages_for_ai),
+        "image_payload_bytes": sum(_image_payload_bytes(image) for image in image_messages_for_ai),
+        "projected_latency_seconds": round(LATENCY_BASE_SECONDS + prompt_tokens / PROMPT_TOKENS_PER_SECOND + completion_tokens / COMPLETION_TOKENS_PER_SECOND, 1) if criteria_for_ai_list else 0.0,
+        # With a cascade the fast tier runs first and escalated criteria are re-sent to the strong tier,
+        # so the real cost lies between one fast call and one fast plus one strong call of this size.
+        "deployments": [d for d in (fast_deployment, strong_deployment) if d],
+        "summary_calls": summary_usage.get("calls", 0),
+        "summary_prompt_tokens": summary_usage.get("prompt_tokens", 0),
+        "summary_completion_tokens": summary_usage.get("completion_tokens", 0),
+        "summary_tokens_estimated": bool(summary_usage.get("estimated")),
+    }
+ 
+def _admission_limits():
+    def env_number(name, default):
+        try: return float(os.getenv(name, default))
+        except ValueError: return float(default)
+    policy = os.getenv("ADMISSION_POLICY", "downgrade").lower()
+    return {
+        "max_prompt_tokens": int(env_number("ADMISSION_MAX_PROMPT_TOKENS", 100000)),
+        "max_image_payload_bytes": int(env_number("ADMISSION_MAX_IMAGE_PAYLOAD_BYTES", 20 * 1024 * 1024)),
+        "max_projected_seconds": env_number("ADMISSION_MAX_PROJECTED_SECONDS", 300),
+        "max_summary_tokens": int(env_number("ADMISSION_MAX_SUMMARY_TOKENS", 300000)), # Enforced by project_summaries.admit_summaries
+        "policy": policy if policy in ("downgrade", "reject") else "downgrade",
+    }
+ 
+def _admission_violations(estimate, limits):
+    violations = []
+    if estimate["prompt_tokens"] > limits["max_prompt_tokens"]:
+        violations.append(f"prompt of ~{estimate['prompt_tokens']} tokens exceeds the {limits['max_prompt_tokens']} token limit")
+    if estimate["image_payload_bytes"] > limits["max_image_payload_bytes"]:
+        violations.append(f"{estimate['image_payload_bytes']} bytes of images exceed the {limits['max_image_payload_bytes']} byte limit")
+    if estimate["projected_latency_seconds"] > limits["max_projected_seconds"]:
+        violations.append(f"projected latency of {estimate['projected_latency_seconds']}s exceeds the {limits['max_projected_seconds']:g}s limit")
+    return violations
+ 
+def apply_admission_control(grading_request):
+    """
+    Checks the preflight estimate against the ADMISSION_* limits before any tokens are spent. With
+    ADMISSION_POLICY=downgrade (default) an oversized job is shrunk in place: the largest screenshots are
+    dropped until the image payload fits, then the largest project files until the prompt and projected
+    latency fit. With ADMISSION_POLICY=reject, or when even the downgraded job does not fit, the job is refused.
+    Returns a decision dict: admitted, policy, violations, actions, estimate (after any downgrade).
+    """
+    limits = _admission_limits()
+    estimate = estimate_grading_request(grading_request)
+    decision = {"admitted": True, "policy": limits["policy"], "limits": limits, "violations": _admission_violations(estimate, limits),
+                "actions": [], "estimate_before": estimate, "estimate": estimate}
+    if not decision["violations"]: return decision
+    if limits["policy"] == "reject":
+        decision["admitted"] = False
+        return decision
+    images = sorted(grading_request["image_messages"], key=_image_payload_bytes, reverse=True)
+    image_bytes = estimate["image_payload_bytes"]
+    while images and image_bytes > limits["max_image_payload_bytes"]:
+        dropped = images.pop(0)
+        image_bytes -= _image_payload_bytes(dropped)
+        decision["actions"].append(f"dropped a {_image_payload_bytes(dropped)} byte screenshot")
+    # Prompt budget that also respects the latency limit (completion time is fixed by the criteria count)
+    latency_token_budget = (limits["max_projected_seconds"] - LATENCY_BASE_SECONDS - estimate["completion_tokens"] / COMPLETION_TOKENS_PER_SECOND) * PROMPT_TOKENS_PER_SECOND
+    token_budget = min(limits["max_prompt_tokens"], latency_token_budget) - TOKENS_PER_IMAGE_ESTIMATE * len(images)
+    files = grading_request["project_text_files_content"]
+    file_tokens = {filename: estimate_tokens(content) for filename, content in files.items()}
+    prompt_text_tokens = estimate["prompt_text_tokens"]
+    for filename in sorted(file_tokens, key=file_tokens.get, reverse=True):
+        if prompt_text_tokens <= token_budget: break
+        prompt_text_tokens -= file_tokens[filename]
+        files.pop(filename)
+        decision["actions"].append(f"dropped {filename} (~{file_tokens[filename]} tokens)")
+    if len(images) != len(grading_request["image_messages"]):
+        kept_image_ids = {id(image) for image in images}
+        grading_request["image_messages"] = [image for image in grading_request["image_messages"] if id(image) in kept_image_ids]
+    grading_request["project_content_text"] = _render_project_content(files, grading_request.get("duplicate_aliases", {}), grading_request.get("project_summaries_text"))
+    decision["estimate"] = estimate_grading_request(grading_request)
+    remaining_violations = _admission_violations(decision["estimate"], limits)
+    if remaining_violations:
+        decision["admitted"] = False
+        decision["violations"] = remaining_violations
+    print(f"Admission control: {'downgraded' if decision['admitted'] else 'rejected'} job "
+          f"({len(decision['actions'])} actions, ~{decision['estimate']['prompt_tokens']} prompt tokens).")
+    return decision
+ 
+def generate_grading_with_openai(chat_client, original_rubric_dataframe, rubric_data_markdown_for_ai, requirements_text, project_text_files_content, image_messages_for_ai, has_video, duplicate_aliases=None, project_file_paths=None, project_base_dir=None):
+    """Prepares the grading request and grades it in one step (see prepare_grading_request / grade_prepared_request)."""
+    if not chat_client: return "Azure OpenAI chat client not initialized.", [], {"total_score": "N/A", "overall_feedback": "AI grading skipped."}
+    error_message, grading_request = prepare_grading_request(
+        original_rubric_dataframe, rubric_data_markdown_for_ai, requirements_text, project_text_files_content,
+        image_messages_for_ai, has_video, duplicate_aliases, project_file_paths, project_base_dir)
+    if error_message: return error_message, [], {"total_score": "N/A", "overall_feedback": "Could not identify grading criteria."}
+    return grade_prepared_request(chat_client, grading_request)
+ 
+def grade_prepared_request(chat_client, grading_request):
+    """
+    Grades every rubric criterion. When AZURE_OPENAI_FAST_DEPLOYMENT_NAME is set, a cascade runs: the fast
+    deployment grades everything with a self-reported confidence, and only criteria that are missing,
+    schema-invalid or below GRADING_CASCADE_CONFIDENCE_THRESHOLD are re-graded by the strong deployment.
+    Per-tier latency/token stats are returned in overall_result['grading_stats'].
+    Criteria a local check could decide (see local_checks.py) never reach the AI.
+    """
+    if not chat_client: return "Azure OpenAI chat client not initialized.", [], {"total_score": "N/A", "overall_feedback": "AI grading skipped."}
+    all_criteria_list, criteria_for_ai_list, local_grades = grading_request["all_criteria"], grading_request["criteria_for_ai"], grading_request["local_grades"]
+    image_messages_for_ai = grading_request["image_messages"]
+    criteria_by_id = {criterion['criterion_id']: criterion for criterion in criteria_for_ai_list}
+    strong_deployment, fast_deployment, confidence_threshold = _cascade_settings()
+    grading_stats = {"tiers": {}, "escalated_criteria": [], "local_check_criteria": list(local_grades)}
+    if not criteria_for_ai_list:
+        grading_breakdown = [local_grades[criterion['criterion_id']] for criterion in all_criteria_list]
+        total_score = sum(safe_numeric_score(grade.get('score_achieved')) for grade in grading_breakdown)
+        return None, grading_breakdown, {"total_score": total_score, "overall_feedback": "All criteria were verified by local checks; no AI grading was needed.", "grading_stats": grading_stats}
+    try:
+        grades_by_id, overall_feedback = {}, None
+        criteria_to_escalate = criteria_for_ai_list
+        if fast_deployment:
+            try:
+                prompt_text = grading_prompt_for(grading_request, criteria_for_ai_list, request_confidence=True)
+                parsed_result, grading_stats["tiers"]["fast"] = _grade_with_deployment(chat_client, fast_deployment, prompt_text, image_messages_for_ai)
+                overall_feedback = parsed_result.get("overall_feedback")
+                _merge_grades(parsed_result, criteria_by_id, grades_by_id)
+                criteria_to_escalate = [
+                    criterion for criterion in criteria_for_ai_list
+                    if criterion['criterion_id'] not in grades_by_id
+                    or safe_numeric_score(grades_by_id[criterion['criterion_id']].get('confidence')) < confidence_threshold
+                ]
+            except Exception as e:
+                print(f"Fast-tier grading failed, escalating all criteria: {e}")
+        if criteria_to_escalate:
+            grading_stats["escalated_criteria"] = [criterion['criterion_id'] for criterion in criteria_to_escalate] if fast_deployment else []
+            prompt_text = grading_prompt_for(grading_request, criteria_to_escalate)
+            parsed_result, grading_stats["tiers"]["strong"] = _grade_with_deployment(chat_client, strong_deployment, prompt_text, image_messages_for_ai)
+            _merge_grades(parsed_result, criteria_by_id, grades_by_id)
+            if overall_feedback is None or len(criteria_to_escalate) == len(criteria_for_ai_list):
+                overall_feedback = parsed_result.get("overall_feedback")
+            # Targeted follow-up: re-ask only for criteria still missing or invalid instead of re-running everything
+            missing_criteria = [criterion for criterion in criteria_for_ai_list if criterion['criterion_id'] not in grades_by_id]
+            if missing_criteria:
+                print(f"AI response lacked valid grades for criteria {[c['criterion_id'] for c in missing_criteria]}; issuing a follow-up call for them only.")
+                grading_stats["follow_up_criteria"] = [criterion['criterion_id'] for criterion in missing_criteria]
+                prompt_text = grading_prompt_for(follow_up_grading_request(grading_request, missing_criteria), missing_criteria)
+                follow_up_max_tokens = min(4000, FOLLOW_UP_BASE_TOKENS + FOLLOW_UP_TOKENS_PER_CRITERION * len(missing_criteria))
+                parsed_result, grading_stats["tiers"]["follow_up"] = _grade_with_deployment(chat_client, strong_deployment, prompt_text, [], max_tokens=follow_up_max_tokens)
+                _merge_grades(parsed_result, criteria_by_id, grades_by_id, require_valid=False)
+                if overall_feedback is None: overall_feedback = parsed_result.get("overall_feedback")
+        if fast_deployment:
+            print(f"Grading cascade: {len(criteria_for_ai_list) - len(grading_stats['escalated_criteria'])}/{len(criteria_for_ai_list)} criteria settled by {fast_deployment}, "
+                  f"{len(grading_stats['escalated_criteria'])} escalated to {strong_deployment}.")
+        return finalize_grading(grading_request, grades_by_id, overall_feedback, grading_stats)
     except Exception as e:
         print(f"An error occurred during AI grading: {e}"); import traceback; traceback.print_exc()
         return f"AI grading error: {e}", [], {"total_score": "N/A", "overall_feedback": f"AI grading failed: {e}"}
  
-def generate_styled_excel_report(original_rubric_dataframe, grading_breakdown, overall_result):
+def build_report_dataframe(original_rubric_dataframe, grading_breakdown, overall_result):
     """
-    Generates a styled Excel report with correct coloring, now fully dynamic.
+    Merges the AI grades into the rubric rows, adding category subtotals, the overall feedback row and
+    the total row. Shared by the Excel report and the JSON results returned to the browser.
     """
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        workbook, worksheet = writer.book, writer.book.add_worksheet('Analysis Results')
- 
-        col_map = getattr(original_rubric_dataframe, '_identified_columns', {})
-        actual_criteria_col_name = col_map.get('criterion_col', 'Criterion')
-        actual_category_col_name = col_map.get('category_col') # Might be None
-        actual_max_score_col_name = col_map.get('max_score_col', 'Score')
+    col_map = getattr(original_rubric_dataframe, '_identified_columns', {})
+    actual_criteria_col_name = col_map.get('criterion_col', 'Criterion')
+    actual_category_col_name = col_map.get('category_col') # Might be None
+    actual_max_score_col_name = col_map.get('max_score_col', 'Score')
  
-        df_rubric_body = original_rubric_dataframe[~original_rubric_dataframe['is_summary_row']].copy()
-        df_rubric_body.dropna(subset=[actual_criteria_col_name], inplace=True)
-        report_columns = [col for col in original_rubric_dataframe.columns if col not in ['is_summary_row', 'index']]
-        if 'AI Score' not in report_columns: report_columns.append('AI Score')
-        if 'AI Comments' not in report_columns: report_columns.append('AI Comments')
+    df_rubric_body = original_rubric_dataframe[~original_rubric_dataframe['is_summary_row']].copy()
+    df_rubric_body.dropna(subset=[actual_criteria_col_name], inplace=True)
+    report_columns = [col for col in original_rubric_dataframe.columns if col not in ['is_summary_row', 'index']]
+    if 'AI Score' not in report_columns: report_columns.append('AI Score')
+    if 'AI Comments' not in report_columns: report_columns.append('AI Comments')
  
-        ai_grades_map = {grade.get('criterion_id'): grade for grade in grading_breakdown}
-        df_rubric_body['AI Score'] = df_rubric_body['index'].map(lambda idx: ai_grades_map.get(idx, {}).get('score_achieved', 'N/A'))
-        df_rubric_body['AI Comments'] = df_rubric_body['index'].map(lambda idx: ai_grades_map.get(idx, {}).get('comments', 'No AI feedback.'))
+    ai_grades_map = {grade.get('criterion_id'): grade for grade in grading_breakdown}
+    df_rubric_body['AI Score'] = df_rubric_body['index'].map(lambda idx: ai_grades_map.get(idx, {}).get('score_achieved', 'N/A'))
+    df_rubric_body['AI Comments'] = df_rubric_body['index'].map(lambda idx: ai_grades_map.get(idx, {}).get('comments', 'No AI feedback.'))
  
-        final_report_rows_list = []
-       
-        # Only group and create subtotals if a category column was identified
-        if actual_category_col_name and actual_category_col_name in df_rubric_body.columns:
-            grouped = df_rubric_body.groupby(actual_category_col_name, sort=False)
-            for category_name, group_df in grouped:
-                for _, row in group_df.iterrows():
-                    final_report_rows_list.append(row.to_dict())
-               
-                category_achieved = safe_numeric_score(pd.to_numeric(group_df['AI Score'], errors='coerce').sum())
-                category_max = safe_numeric_score(pd.to_numeric(group_df[actual_max_score_col_name], errors='coerce').sum())
-                subtotal_row = {col: "" for col in report_columns}
-                subtotal_row[actual_category_col_name] = f"{category_name} Total"
-                if actual_max_score_col_name: subtotal_row[actual_max_score_col_name] = category_max
-                subtotal_row['AI Score'] = category_achieved
-                final_report_rows_list.append(subtotal_row)
-        else:
-            # If no category column, just add all rows without subtotals
-            for _, row in df_rubric_body.iterrows():
+    final_report_rows_list = []
+   
+    # Only group and create subtotals if a category column was identified
+    if actual_category_col_name and actual_category_col_name in df_rubric_body.columns:
+        grouped = df_rubric_body.groupby(actual_category_col_name, sort=False)
+        for category_name, group_df in grouped:
+            for _, row in group_df.iterrows():
                 final_report_rows_list.append(row.to_dict())
+           
+            category_achieved = safe_numeric_score(pd.to_numeric(group_df['AI Score'], errors='coerce').sum())
+            category_max = safe_numeric_score(pd.to_numeric(group_df[actual_max_score_col_name], errors='coerce').sum())
+            subtotal_row = {col: "" for col in report_columns}
+            subtotal_row[actual_category_col_name] = f"{category_name} Total"
+            if actual_max_score_col_name: subtotal_row[actual_max_score_col_name] = category_max
+            subtotal_row['AI Score'] = category_achieved
+            final_report_rows_list.append(subtotal_row)
+    else:
+        # If no category column, just add all rows without subtotals
+        for _, row in df_rubric_body.iterrows():
+            final_report_rows_list.append(row.to_dict())
  
-        report_df = pd.DataFrame(final_report_rows_list, columns=report_columns).fillna('')
-       
-        overall_achieved = safe_numeric_score(pd.to_numeric(df_rubric_body['AI Score'], errors='coerce').sum())
-        overall_max = safe_numeric_score(pd.to_numeric(df_rubric_body[actual_max_score_col_name], errors='coerce').sum()) if actual_max_score_col_name else 0
+    report_df = pd.DataFrame(final_report_rows_list, columns=report_columns).fillna('')
+   
+    overall_achieved = safe_numeric_score(pd.to_numeric(df_rubric_body['AI Score'], errors='coerce').sum())
+    overall_max = safe_numeric_score(pd.to_numeric(df_rubric_body[actual_max_score_col_name], errors='coerce').sum()) if actual_max_score_col_name else 0
+ 
+    feedback_row = {col: "" for col in report_columns}; feedback_row[actual_criteria_col_name] = "Overall Feedback"; feedback_row['AI Comments'] = overall_result.get('overall_feedback', 'N/A')
+    total_row = {col: "" for col in report_columns}; total_row[actual_criteria_col_name] = f"TOTAL MARKS OUT OF {int(overall_max)}"; total_row['AI Score'] = overall_achieved
+    report_df = pd.concat([report_df, pd.DataFrame([feedback_row, total_row])], ignore_index=True)
+    return report_df
  
-        feedback_row = {col: "" for col in report_columns}; feedback_row[actual_criteria_col_name] = "Overall Feedback"; feedback_row['AI Comments'] = overall_result.get('overall_feedback', 'N/A')
-        total_row = {col: "" for col in report_columns}; total_row[actual_criteria_col_name] = f"TOTAL MARKS OUT OF {int(overall_max)}"; total_row['AI Score'] = overall_achieved
-        report_df = pd.concat([report_df, pd.DataFrame([feedback_row, total_row])], ignore_index=True)
+def report_dataframe_to_compact_json(report_df, original_rubric_dataframe):
+    """
+    Serializes a report DataFrame as {"columns": [...], "rows": [[...]], "row_kinds": [...]} for client-side
+    rendering; row_kinds marks 'subtotal', 'feedback' and 'total' rows so the browser can style them.
+    """
+    col_map = getattr(original_rubric_dataframe, '_identified_columns', {})
+    actual_criteria_col_name = col_map.get('criterion_col', 'Criterion')
+    actual_category_col_name = col_map.get('category_col')
+    split = json.loads(report_df.to_json(orient='split', index=False, default_handler=str))
+    row_kinds = []
+    for row in report_df.itertuples(index=False):
+        row_dict = dict(zip(report_df.columns, row))
+        criterion_cell_val = str(row_dict.get(actual_criteria_col_name, '')).lower().strip()
+        cat_cell_val = str(row_dict.get(actual_category_col_name, '')).lower().strip() if actual_category_col_name else ''
+        if "total marks out of" in criterion_cell_val: row_kinds.append('total')
+        elif criterion_cell_val == "overall feedback": row_kinds.append('feedback')
+        elif cat_cell_val.endswith(" total"): row_kinds.append('subtotal')
+        else: row_kinds.append('criterion')
+    return {"columns": split["columns"], "rows": split["data"], "row_kinds": row_kinds}
+ 
+def generate_styled_excel_report(original_rubric_dataframe, grading_breakdown, overall_result):
+    """
+    Generates a styled Excel report with correct coloring, now fully dynamic.
+    """
+    output = io.BytesIO()
+    report_df = build_report_dataframe(original_rubric_dataframe, grading_breakdown, overall_result)
+    col_map = getattr(original_rubric_dataframe, '_identified_columns', {})
+    actual_criteria_col_name = col_map.get('criterion_col', 'Criterion')
+    actual_category_col_name = col_map.get('category_col') # Might be None
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        workbook, worksheet = writer.book, writer.book.add_worksheet('Analysis Results')
  
         # Define formats
         header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'vcenter', 'bg_color': '#D9D9D9', 'text_wrap': True})
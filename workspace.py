@@ -0,0 +1,253 @@
+import os
+import glob
+import time
+import uuid
+import queue
+import shutil
+import threading
+from job_checkpoints import load_job
+
+# --- Job Workspaces ---
+# WorkspaceManager hands out the per-job directories of the web app and takes them back. Releasing a
+# directory renames it to a hidden ".reclaim-*" sibling (instant, on the same filesystem) and a background
+# thread deletes it, so responses never wait on rmtree of a large extracted tree. A sweeper runs at
+# startup and every sweep interval: it removes expired retained jobs, reclaim directories left by a crash
+# and stale leftovers of older versions under uploads/ (extracted_project_*, extracted_projects/*, old
+# reports), expires what has outlived its own retention in the registered expiring roots (e.g. profiles), then runs the sweep hooks other components register (e.g. expiring idle chunked uploads). Job directories can live on a tmpfs (WORKSPACE_TMPFS_DIR) while it has room, and a global
+# quota (WORKSPACE_QUOTA_MB) applies backpressure: a new job waits briefly for reclamation to free space
+# and is refused with WorkspaceFullError (HTTP 503 + Retry-After) if it still does not fit.
+
+RECLAIM_PREFIX = ".reclaim-"
+# Leftovers of earlier versions of the app, relative to the upload folder; removed once older than the retention window
+STALE_UPLOAD_PATTERNS = ('extracted_project_*', 'extracted_projects/*', 'downloads/*', 'rubrics/*', 'projects/*', 'requirements/*')
+
+class WorkspaceFullError(Exception):
+    """Raised when a new job does not fit in the workspace quota, even after waiting for reclamation."""
+
+    def __init__(self, message, retry_after_seconds):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+def path_size_bytes(path):
+    """Total size of a file or directory tree (entries that vanish while walking are ignored)."""
+    if os.path.isfile(path):
+        try: return os.path.getsize(path)
+        except OSError: return 0
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try: total += os.lstat(os.path.join(root, name)).st_size
+            except OSError: pass
+    return total
+
+class WorkspaceManager:
+    """Allocates job directories, reclaims them asynchronously, sweeps stale ones and enforces the disk quota."""
+
+    def __init__(self, jobs_root, upload_root, retention_seconds, quota_bytes=0, tmpfs_root=None, tmpfs_min_free_bytes=256 * 1024 * 1024,
+                 quota_wait_seconds=10.0, sweep_interval_seconds=600.0):
+        self.jobs_root = jobs_root
+        self.upload_root = upload_root
+        self.retention_seconds = retention_seconds
+        self.quota_bytes = quota_bytes # 0: unlimited
+        self.tmpfs_root = tmpfs_root
+        self.tmpfs_min_free_bytes = tmpfs_min_free_bytes
+        self.quota_wait_seconds = quota_wait_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._condition = threading.Condition()
+        self._reserved = {} # job_dir -> estimated bytes, for jobs that are running
+        self._retained = {} # job_dir -> measured bytes, for finished jobs kept for retry
+        self._reclaiming_bytes = 0 # Renamed away, not yet deleted
+        self._reclaim_queue = queue.Queue()
+        self._sweep_hooks = []
+        self._expiring_roots = [] # (root, retention_seconds): current artifacts with a retention of their own
+        self._started = False
+        self.allocated = self.tmpfs_allocations = self.reclaimed = self.swept = self.quota_waits = self.quota_rejections = 0
+
+    @property
+    def roots(self):
+        return [root for root in (self.tmpfs_root, self.jobs_root) if root]
+
+    def start(self):
+        """Sweeps once, then starts the reclaimer and the periodic sweeper (both daemon threads)."""
+        if self._started: return
+        self._started = True
+        for root in self.roots: os.makedirs(root, exist_ok=True)
+        threading.Thread(target=self._reclaim_loop, daemon=True, name="workspace-reclaimer").start()
+        self.sweep()
+        threading.Thread(target=self._sweep_loop, daemon=True, name="workspace-sweeper").start()
+
+    def add_sweep_hook(self, hook):
+        """Registers a callable that every sweep runs after its own work (errors are logged, not raised)."""
+        self._sweep_hooks.append(hook)
+
+    def add_expiring_root(self, root, retention_seconds):
+        """Has every sweep reclaim the entries directly under root that were last modified more than retention_seconds ago."""
+        self._expiring_roots.append((root, retention_seconds))
+
+    def _usage_bytes(self):
+        return sum(self._reserved.values()) + sum(self._retained.values()) + self._reclaiming_bytes
+
+    def allocate(self, job_id, expected_bytes=0):
+        """
+        Creates the directory of a new job and reserves expected_bytes of the quota for it. Waits up to
+        quota_wait_seconds for reclamation when the quota is exhausted, then raises WorkspaceFullError.
+        """
+        with self._condition:
+            if self.quota_bytes:
+                deadline = time.monotonic() + self.quota_wait_seconds
+                waited = False
+                # A job larger than the whole quota still runs when nothing else holds space
+                while self._usage_bytes() and self._usage_bytes() + expected_bytes > self.quota_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.quota_rejections += 1
+                        raise WorkspaceFullError("The grading server is out of workspace disk space; please retry shortly.",
+                                                 retry_after_seconds=max(5, int(self.quota_wait_seconds)))
+                    waited = True
+                    self._condition.wait(remaining)
+                self.quota_waits += waited
+            job_dir = os.path.join(self._root_for(expected_bytes), job_id)
+            os.makedirs(job_dir, exist_ok=True)
+            self._reserved[job_dir] = expected_bytes
+            self.allocated += 1
+        return job_dir
+
+    def _root_for(self, expected_bytes):
+        if self.tmpfs_root:
+            try:
+                if shutil.disk_usage(self.tmpfs_root).free - expected_bytes >= self.tmpfs_min_free_bytes:
+                    self.tmpfs_allocations += 1
+                    return self.tmpfs_root
+            except OSError as e:
+                print(f"Workspace tmpfs {self.tmpfs_root} is unavailable ({e}); using {self.jobs_root}.")
+        return self.jobs_root
+
+    def find(self, job_id):
+        """The directory of an existing job, on whichever root it was allocated (None if there is none)."""
+        for root in self.roots:
+            job_dir = os.path.join(root, job_id)
+            if os.path.isdir(job_dir): return job_dir
+        return None
+
+    def activate(self, job_dir, expected_bytes=None):
+        """Marks a retained job (or one left by an earlier run) as running again, so the sweeper leaves it alone."""
+        with self._condition:
+            retained_bytes = self._retained.pop(job_dir, 0)
+            self._reserved[job_dir] = retained_bytes if expected_bytes is None else expected_bytes
+
+    def release(self, job_dir, keep=False):
+        """Ends a job: kept jobs stay on disk (and count against the quota); the others are reclaimed in the background."""
+        retained_bytes = path_size_bytes(job_dir) if keep else None
+        with self._condition:
+            reserved_bytes = self._reserved.pop(job_dir, 0)
+            if keep:
+                self._retained[job_dir] = retained_bytes
+                self._condition.notify_all()
+                return
+        self.reclaim(job_dir, reserved_bytes)
+
+    def reclaim(self, path, size_bytes=None):
+        """Renames path out of the way and queues it for deletion; returns False if it no longer exists."""
+        reclaim_path = os.path.join(os.path.dirname(path), f"{RECLAIM_PREFIX}{uuid.uuid4().hex[:12]}")
+        try:
+            os.replace(path, reclaim_path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print(f"Could not move {path} aside for reclamation ({e}); deleting it in place.")
+            reclaim_path = path
+        with self._condition:
+            retained_bytes = self._retained.pop(path, None)
+            size_bytes = retained_bytes if size_bytes is None else size_bytes
+            self._reclaiming_bytes += size_bytes or 0
+        self._reclaim_queue.put((reclaim_path, size_bytes or 0))
+        if not self._started: self._drain_reclaim_queue() # No background thread (e.g. in scripts): delete now
+        return True
+
+    def _delete(self, path, size_bytes):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+            else: os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error reclaiming {path}: {e}")
+        with self._condition:
+            self._reclaiming_bytes = max(0, self._reclaiming_bytes - size_bytes)
+            self.reclaimed += 1
+            self._condition.notify_all()
+
+    def _drain_reclaim_queue(self):
+        while True:
+            try: path, size_bytes = self._reclaim_queue.get_nowait()
+            except queue.Empty: return
+            self._delete(path, size_bytes)
+
+    def _reclaim_loop(self):
+        while True:
+            self._delete(*self._reclaim_queue.get())
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval_seconds)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Workspace sweep failed: {e}")
+
+    def sweep(self):
+        """Reclaims expired jobs, crash leftovers and stale legacy uploads, and re-measures retained jobs. Returns the count."""
+        now, removed, retained = time.time(), 0, {}
+        with self._condition:
+            running = set(self._reserved)
+        for root in self.roots:
+            if not os.path.isdir(root): continue
+            for entry in os.scandir(root):
+                if entry.name.startswith(RECLAIM_PREFIX): # Renamed, but the process died before deleting it
+                    self._reclaim_queue.put((entry.path, 0))
+                    removed += 1
+                elif entry.is_dir() and entry.path not in running:
+                    job = load_job(entry.path)
+                    last_touched = (job or {}).get('updated_at') or entry.stat().st_mtime
+                    if now - last_touched > self.retention_seconds:
+                        removed += self.reclaim(entry.path)
+                    else:
+                        retained[entry.path] = path_size_bytes(entry.path)
+        leftovers = set(glob.glob(os.path.join(self.upload_root, RECLAIM_PREFIX + '*')) + glob.glob(os.path.join(self.upload_root, '*', RECLAIM_PREFIX + '*')))
+        for path in leftovers - {os.path.join(root, name) for root in self.roots if os.path.isdir(root) for name in os.listdir(root)}:
+            self._reclaim_queue.put((path, 0))
+            removed += 1
+        for pattern in STALE_UPLOAD_PATTERNS:
+            for path in glob.glob(os.path.join(self.upload_root, pattern)):
+                try: stale = now - os.path.getmtime(path) > self.retention_seconds
+                except OSError: continue
+                if stale: removed += self.reclaim(path, 0)
+        for expiring_root, retention_seconds in self._expiring_roots:
+            if not os.path.isdir(expiring_root): continue
+            for entry in os.scandir(expiring_root):
+                if entry.name.startswith(RECLAIM_PREFIX): continue
+                try: stale = now - entry.stat().st_mtime > retention_seconds
+                except OSError: continue
+                if stale: removed += self.reclaim(entry.path, 0)
+        with self._condition:
+            self._retained = {path: size for path, size in retained.items() if path not in self._reserved}
+            self.swept += removed
+            self._condition.notify_all()
+        if not self._started: self._drain_reclaim_queue()
+        if removed: print(f"Workspace sweep reclaimed {removed} stale directories and files.")
+        for hook in list(self._sweep_hooks):
+            try:
+                hook()
+            except Exception as e:
+                print(f"Workspace sweep hook {getattr(hook, '__name__', hook)} failed: {e}")
+        return removed
+
+    def stats(self):
+        with self._condition:
+            return {
+                "quota_bytes": self.quota_bytes or None, "used_bytes": self._usage_bytes(),
+                "running_jobs": len(self._reserved), "retained_jobs": len(self._retained),
+                "reclaim_pending": self._reclaim_queue.qsize(), "reclaiming_bytes": self._reclaiming_bytes,
+                "tmpfs_root": self.tmpfs_root, "allocated": self.allocated, "tmpfs_allocations": self.tmpfs_allocations,
+                "reclaimed": self.reclaimed, "swept": self.swept, "quota_waits": self.quota_waits, "quota_rejections": self.quota_rejections,
+            }